@@ -0,0 +1,73 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Compare the benchmark results of two commits written by `run.py`. Cases are
+matched by benchmark, number of particles and threads, and the exit code is
+non-zero if any case got slower by more than the tolerance.
+
+    python benchmarks/compare.py benchmarks.jsonl BASE_COMMIT NEW_COMMIT
+"""
+import json
+import sys
+from argparse import ArgumentParser
+
+
+def load_results(fname, commit):
+    """
+    Results of a commit, keyed by `(benchmark, npart, threads)`. If a case
+    was run several times, the latest result is kept. The commit may be
+    abbreviated.
+    """
+    results = {}
+    with open(fname, "r") as f:
+        for line in f:
+            result = json.loads(line)
+            if (result["commit"] or "").startswith(commit):
+                key = (result["benchmark"], result["npart"],
+                       result["threads"])
+                results[key] = result
+    return results
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Compare benchmark results of two commits.")  # noqa
+    parser.add_argument("results", type=str,
+                        help="JSON lines file written by `run.py`.")
+    parser.add_argument("base", type=str, help="Base commit.")
+    parser.add_argument("new", type=str, help="New commit.")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="Relative slowdown reported as a regression.")
+    args = parser.parse_args()
+
+    base = load_results(args.results, args.base)
+    new = load_results(args.results, args.new)
+
+    regressions = 0
+    for key in sorted(set(base) & set(new)):
+        ratio = new[key]["throughput"] / base[key]["throughput"]
+        memory = new[key]["peak_rss_MB"] / base[key]["peak_rss_MB"]
+        flag = ""
+        if ratio < 1 - args.tolerance:
+            flag = "  REGRESSION"
+            regressions += 1
+        name, npart, threads = key
+        print(f"{name:>24} npart={npart:<10} threads={threads:<3} "
+              f"speedup {ratio:6.2f}x, peak memory {memory:6.2f}x{flag}")
+
+    missing = set(base) ^ set(new)
+    if missing:
+        print(f"{len(missing)} cases were only run for one of the commits.")
+
+    sys.exit(1 if regressions > 0 else 0)
@@ -0,0 +1,202 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Synthetic TNG-like data for the benchmarks: clustered particle positions
+and mock simulation directories with FoF-ordered snapshot chunk files and
+group catalogues laid out like TNG, i.e.
+`output/snapdir_XXX/snap_XXX.N.hdf5` and
+`output/groups_XXX/fof_subhalo_tab_XXX.N.hdf5`.
+"""
+import os
+from os.path import join
+
+import numpy
+from h5py import File
+
+
+def halo_lengths(npart, nhalos, fuzz=0.3, slope=-1.9, seed=0):
+    """
+    Number of particles of FoF haloes drawn from a power-law mass function,
+    sorted in decreasing order like the TNG group catalogues.
+
+    Parameters
+    ----------
+    npart : int
+        Total number of particles.
+    nhalos : int
+        Number of haloes.
+    fuzz : float, optional
+        Fraction of particles outside of haloes.
+    slope : float, optional
+        Slope of the halo mass function.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    lengths : 1-dimensional array of shape (nhalos,)
+    """
+    gen = numpy.random.default_rng(seed)
+    # Inverse transform sampling of a power law above 1.
+    mass = (1 - gen.random(nhalos))**(1 / (slope + 1))
+    lengths = numpy.floor(mass / mass.sum() * npart * (1 - fuzz))
+    lengths = numpy.maximum(lengths.astype(numpy.int64), 1)
+    return numpy.sort(lengths)[::-1]
+
+
+def clustered_positions(npart, boxsize, nhalos=1000, fuzz=0.3, seed=0,
+                        return_lengths=False):
+    """
+    Particle positions clustered in haloes with a radius growing as the
+    cube root of their number of particles, followed by uniformly
+    distributed particles. The particles are ordered by halo.
+
+    Parameters
+    ----------
+    npart : int
+        Number of particles.
+    boxsize : float
+        Size of the periodic box.
+    nhalos : int, optional
+        Number of haloes.
+    fuzz : float, optional
+        Fraction of particles outside of haloes.
+    seed : int, optional
+        Random seed.
+    return_lengths : bool, optional
+        Whether to also return the haloes' lengths and centres.
+
+    Returns
+    -------
+    pos : 2-dimensional array of shape (npart, 3)
+    lengths : 1-dimensional array of shape (nhalos,), optional
+    centres : 2-dimensional array of shape (nhalos, 3), optional
+    """
+    gen = numpy.random.default_rng(seed)
+    lengths = halo_lengths(npart, nhalos, fuzz, seed=seed)
+    if lengths.sum() > npart:
+        raise ValueError("Too many haloes for the number of particles.")
+    centres = gen.uniform(0, boxsize, (nhalos, 3))
+
+    pos = numpy.empty((npart, 3), dtype=numpy.float32)
+    # Radius of a halo of 1000 particles, similar to TNG300-1-Dark at z = 0.
+    r0 = 1e-3 * boxsize
+    start = 0
+    for n, centre in zip(lengths, centres):
+        r = r0 * (n / 1e3)**(1 / 3)
+        pos[start:start + n] = centre + gen.normal(0, r, (n, 3))
+        start += n
+    pos[start:] = gen.uniform(0, boxsize, (npart - start, 3))
+    pos %= boxsize
+
+    if return_lengths:
+        return pos, lengths, centres
+    return pos
+
+
+def make_mock_simulation(basepath, npart, snap=99, nhalos=1000, nfiles=8,
+                         boxsize=75000., seed=0):
+    """
+    Write a mock dark matter only simulation with FoF-ordered snapshot
+    chunk files and a group catalogue with a single subhalo per halo.
+
+    Parameters
+    ----------
+    basepath : str
+        Simulation directory, the files are written under `output`.
+    npart : int
+        Number of particles.
+    snap : int, optional
+        Snapshot number.
+    nhalos : int, optional
+        Number of haloes.
+    nfiles : int, optional
+        Number of snapshot and group catalogue chunk files.
+    boxsize : float, optional
+        Size of the periodic box.
+    seed : int, optional
+        Random seed.
+
+    Returns
+    -------
+    lengths : 1-dimensional array of shape (nhalos,)
+        Number of particles of each halo.
+    """
+    gen = numpy.random.default_rng(seed + 1)
+    pos, lengths, centres = clustered_positions(
+        npart, boxsize, nhalos, seed=seed, return_lengths=True)
+
+    s = str(snap).zfill(3)
+    snapdir = join(basepath, "output", f"snapdir_{s}")
+    groupdir = join(basepath, "output", f"groups_{s}")
+    os.makedirs(snapdir, exist_ok=True)
+    os.makedirs(groupdir, exist_ok=True)
+
+    numpart_total = numpy.zeros(6, dtype=numpy.int64)
+    numpart_total[1] = npart
+    mass_table = numpy.zeros(6)
+    mass_table[1] = 1e-3
+
+    edges = numpy.linspace(0, npart, nfiles + 1).astype(numpy.int64)
+    for i in range(nfiles):
+        a, b = edges[i], edges[i + 1]
+        numpart = numpy.zeros(6, dtype=numpy.int64)
+        numpart[1] = b - a
+        with File(join(snapdir, f"snap_{s}.{i}.hdf5"), "w") as f:
+            header = f.create_group("Header")
+            header.attrs["NumPart_ThisFile"] = numpart
+            header.attrs["NumPart_Total"] = numpart_total
+            header.attrs["NumPart_Total_HighWord"] = numpy.zeros(6, dtype=numpy.int64)  # noqa
+            header.attrs["NumFilesPerSnapshot"] = nfiles
+            header.attrs["BoxSize"] = boxsize
+            header.attrs["MassTable"] = mass_table
+            grp = f.create_group("PartType1")
+            grp.create_dataset("Coordinates", data=pos[a:b])
+            grp.create_dataset("Velocities", data=gen.normal(
+                0, 200, (b - a, 3)).astype(numpy.float32))
+            grp.create_dataset("Potential", data=gen.normal(
+                0, 1e4, b - a).astype(numpy.float32))
+            grp.create_dataset("ParticleIDs",
+                               data=numpy.arange(a, b, dtype=numpy.uint64))
+
+    length_type = numpy.zeros((nhalos, 6), dtype=numpy.int32)
+    length_type[:, 1] = lengths
+    mass_type = (length_type * mass_table).astype(numpy.float32)
+    edges = numpy.linspace(0, nhalos, nfiles + 1).astype(numpy.int64)
+    for i in range(nfiles):
+        a, b = edges[i], edges[i + 1]
+        with File(join(groupdir, f"fof_subhalo_tab_{s}.{i}.hdf5"), "w") as f:
+            header = f.create_group("Header")
+            header.attrs["Ngroups_ThisFile"] = b - a
+            header.attrs["Ngroups_Total"] = nhalos
+            header.attrs["Nsubgroups_ThisFile"] = b - a
+            header.attrs["Nsubgroups_Total"] = nhalos
+            header.attrs["NumFiles"] = nfiles
+            grp = f.create_group("Group")
+            grp.create_dataset("GroupLen", data=lengths[a:b].astype(numpy.int32))  # noqa
+            grp.create_dataset("GroupLenType", data=length_type[a:b])
+            grp.create_dataset("GroupPos", data=centres[a:b].astype(numpy.float32))  # noqa
+            grp.create_dataset("GroupFirstSub", data=numpy.arange(a, b, dtype=numpy.int32))  # noqa
+            grp.create_dataset("GroupNsubs", data=numpy.ones(b - a, dtype=numpy.int32))  # noqa
+            sub = f.create_group("Subhalo")
+            sub.create_dataset("SubhaloLen", data=lengths[a:b].astype(numpy.int32))  # noqa
+            sub.create_dataset("SubhaloLenType", data=length_type[a:b])
+            sub.create_dataset("SubhaloGrNr", data=numpy.arange(a, b, dtype=numpy.int32))  # noqa
+            sub.create_dataset("SubhaloPos", data=centres[a:b].astype(numpy.float32))  # noqa
+            sub.create_dataset("SubhaloFlag", data=numpy.ones(b - a, dtype=numpy.int32))  # noqa
+            sub.create_dataset("SubhaloMassType", data=mass_type[a:b])
+            sub.create_dataset("SubhaloMass", data=mass_type[a:b].sum(axis=1))  # noqa
+
+    return lengths
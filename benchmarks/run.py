@@ -0,0 +1,300 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Benchmarks of the sub-box selection, gridding, radial profile, sorting and
+downsampling hot paths on synthetic data, so that no TNG data is needed.
+Each benchmark is run for every number of particles and threads in a fresh
+process, which reports its throughput and peak memory. The results are
+appended to a JSON lines file together with the git commit, so that they
+can be compared across commits with `compare.py`.
+
+Usage, with `tngsorted` installed:
+
+    python benchmarks/run.py --sizes 1000000 4000000 --threads 1 4
+"""
+import json
+import multiprocessing
+import resource
+import socket
+import subprocess
+import tempfile
+from argparse import ArgumentParser
+from datetime import datetime
+from os.path import abspath, dirname, getsize, join
+from time import perf_counter
+
+import numpy
+import tngsorted
+from numba import set_num_threads
+from tngsorted.downsample import downsample_snapshot
+from tngsorted.sort_by_halo import build_sorted_halos
+
+from mock import clustered_positions, make_mock_simulation
+
+BOXSIZE = 75000.
+SUBBOX_SIZE = 4000.
+NGRID = 64
+NCENTERS = 32
+
+
+def _peak_rss():
+    """Peak resident memory of this process in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _centers(pos, ncenters, seed=1):
+    """Sub-box centres on randomly chosen particles, i.e. in haloes."""
+    gen = numpy.random.default_rng(seed)
+    return pos[gen.choice(len(pos), ncenters, replace=False)].astype(float)
+
+
+###############################################################################
+#                               Benchmarks                                    #
+###############################################################################
+
+# Each benchmark takes the number of particles and a scratch directory and
+# returns a setup function and a timed function. The timed function returns
+# the number of processed items, their unit and optionally the number of
+# bytes written.
+
+
+def bench_find_boxed(npart, workdir):
+    def setup():
+        pos = clustered_positions(npart, BOXSIZE)
+        return pos, _centers(pos, 1)[0]
+
+    def run(pos, center):
+        tngsorted.find_boxed(pos, center, SUBBOX_SIZE, BOXSIZE)
+        return npart, "particles"
+
+    return setup, run
+
+
+def bench_box_index_query(npart, workdir):
+    def setup():
+        pos = clustered_positions(npart, BOXSIZE)
+        index = tngsorted.BoxIndex.build(pos, BOXSIZE, 64)
+        return index, _centers(pos, NCENTERS)
+
+    def run(index, centers):
+        for center in centers:
+            index.query(center, SUBBOX_SIZE)
+        return len(centers), "centres"
+
+    return setup, run
+
+
+def bench_density_field(npart, workdir):
+    def setup():
+        # All particles within a single sub-box.
+        gen = numpy.random.default_rng(0)
+        pos = gen.uniform(0, SUBBOX_SIZE, (npart, 3)).astype(numpy.float32)
+        return pos, numpy.full(3, SUBBOX_SIZE / 2)
+
+    def run(pos, center):
+        tngsorted.positions_to_density_field(NGRID, pos, center, SUBBOX_SIZE,
+                                             BOXSIZE, MAS="PCS")
+        return npart, "particles"
+
+    return setup, run
+
+
+def bench_density_field_channels(npart, workdir):
+    def setup():
+        gen = numpy.random.default_rng(0)
+        pos = gen.uniform(0, SUBBOX_SIZE, (npart, 3)).astype(numpy.float32)
+        weights = gen.normal(size=(npart, 4))
+        return pos, weights, numpy.full(3, SUBBOX_SIZE / 2)
+
+    def run(pos, weights, center):
+        tngsorted.density_field_channels(NGRID, pos, weights, center,
+                                         SUBBOX_SIZE, BOXSIZE, MAS="PCS")
+        return npart, "particles"
+
+    return setup, run
+
+
+def bench_density_fields_many(npart, workdir):
+    def setup():
+        pos = clustered_positions(npart, BOXSIZE)
+        return pos, _centers(pos, NCENTERS)
+
+    def run(pos, centers):
+        tngsorted.density_fields_many(NGRID, pos, centers, SUBBOX_SIZE,
+                                      BOXSIZE, MAS="PCS")
+        return len(centers), "centres"
+
+    return setup, run
+
+
+def bench_radial_profiles(npart, workdir):
+    def setup():
+        pos = clustered_positions(npart, BOXSIZE)
+        return pos, _centers(pos, NCENTERS)
+
+    def run(pos, centers):
+        tngsorted.radial_profiles(pos, centers, 10., SUBBOX_SIZE / 2, 20,
+                                  BOXSIZE)
+        return len(centers), "centres"
+
+    return setup, run
+
+
+def bench_sort_by_halo(npart, workdir):
+    fout = join(workdir, "sorted_halos.hdf5")
+
+    def setup():
+        make_mock_simulation(workdir, npart, boxsize=BOXSIZE)
+        return ()
+
+    def run():
+        build_sorted_halos(workdir, 99, fout, minpart=100, verbose=False)
+        return npart, "particles", getsize(fout)
+
+    return setup, run
+
+
+def bench_downsample(npart, workdir):
+    fout = join(workdir, "downsampled.hdf5")
+
+    def setup():
+        make_mock_simulation(workdir, npart, boxsize=BOXSIZE)
+        return (tngsorted.get_snapshot_files(workdir, 99), )
+
+    def run(files):
+        downsample_snapshot(files, fout, [8, 4, 1], verbose=False)
+        return npart, "particles", getsize(fout)
+
+    return setup, run
+
+
+BENCHMARKS = {"find_boxed": bench_find_boxed,
+              "box_index_query": bench_box_index_query,
+              "density_field": bench_density_field,
+              "density_field_channels": bench_density_field_channels,
+              "density_fields_many": bench_density_fields_many,
+              "radial_profiles": bench_radial_profiles,
+              "sort_by_halo": bench_sort_by_halo,
+              "downsample": bench_downsample,
+              }
+
+
+###############################################################################
+#                                Runner                                       #
+###############################################################################
+
+
+def _run_case(name, npart, nthreads, repeat, queue):
+    """Run a single benchmark in a fresh process and report the result."""
+    set_num_threads(nthreads)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        setup, run = BENCHMARKS[name](npart, workdir)
+        args = setup()
+        setup_rss = _peak_rss()
+
+        # Warm up on the same inputs to exclude the compilation time.
+        run(*args)
+
+        times = []
+        for __ in range(repeat):
+            start = perf_counter()
+            out = run(*args)
+            times.append(perf_counter() - start)
+
+    nitems, unit = out[:2]
+    nbytes = out[2] if len(out) > 2 else None
+    time = min(times)
+    queue.put({"benchmark": name, "npart": npart, "threads": nthreads,
+               "time": time, "times": times, "unit": unit,
+               "throughput": nitems / time,
+               "write_GBps": None if nbytes is None else nbytes / time / 1e9,
+               "setup_rss_MB": setup_rss, "peak_rss_MB": _peak_rss()})
+
+
+def run_case(name, npart, nthreads, repeat=3):
+    """
+    Run a benchmark in a spawned process, so that the peak memory and the
+    number of threads are those of this case only.
+
+    Parameters
+    ----------
+    name : str
+        Benchmark name, see `BENCHMARKS`.
+    npart : int
+        Number of particles.
+    nthreads : int
+        Number of numba threads.
+    repeat : int, optional
+        Number of timed repetitions, the fastest is reported.
+
+    Returns
+    -------
+    result : dict
+    """
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_run_case,
+                       args=(name, npart, nthreads, repeat, queue))
+    proc.start()
+    proc.join()
+    if proc.exitcode != 0:
+        raise RuntimeError(f"Benchmark `{name}` failed with exit code {proc.exitcode}.")  # noqa
+    return queue.get()
+
+
+def git_commit():
+    """Commit of the repository, with a `-dirty` suffix if modified."""
+    root = dirname(dirname(abspath(__file__)))
+    try:
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=root, text=True).strip()
+        dirty = subprocess.check_output(
+            ["git", "status", "--porcelain", "--untracked-files=no"],
+            cwd=root, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return commit + ("-dirty" if dirty else "")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Benchmark the hot paths on synthetic data.")  # noqa
+    parser.add_argument("--benchmarks", type=str, nargs="+",
+                        default=list(BENCHMARKS), choices=list(BENCHMARKS),
+                        help="Benchmarks to run, by default all.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10**6],
+                        help="Numbers of particles.")
+    parser.add_argument("--threads", type=int, nargs="+", default=[1],
+                        help="Numbers of numba threads.")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of timed repetitions of each case.")
+    parser.add_argument("--output", type=str, default="benchmarks.jsonl",
+                        help="JSON lines file the results are appended to.")
+    args = parser.parse_args()
+
+    meta = {"commit": git_commit(), "host": socket.gethostname(),
+            "date": datetime.now().isoformat(timespec="seconds")}
+
+    with open(args.output, "a") as f:
+        for name in args.benchmarks:
+            for npart in args.sizes:
+                for nthreads in args.threads:
+                    result = {**meta, **run_case(name, npart, nthreads,
+                                                 args.repeat)}
+                    f.write(json.dumps(result) + "\n")
+                    f.flush()
+                    print(f"{name:>24} npart={npart:<10} threads={nthreads:<3} "  # noqa
+                          f"{result['throughput']:.3e} {result['unit']}/s, "
+                          f"peak {result['peak_rss_MB']:.0f} MB", flush=True)
@@ -1,83 +1,110 @@
-import numpy as np
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Script to check a snapshot's files and downsample its particles, see
+`tngsorted.downsample.downsample_snapshot`.
+"""
 from datetime import datetime
-import h5py
 import os
-from tqdm import tqdm
 from argparse import ArgumentParser
 
 from os.path import join
 
-import illustris_python as il
+import tngsorted
+from tngsorted.downsample import downsample_snapshot
+from tngsorted.instrument import RunMetrics, print_report, write_report
+from tngsorted.integrity import check_files
 
 
-def downsample_particles(dm_pos, rate):
-    """Note that `dm_pos` is shuffled in-place."""
-    print(f"{datetime.now()}:   shuffling particles.", flush=True)
-    np.random.shuffle(dm_pos)
-    print(f"{datetime.now()}:   finished shuffling particles.", flush=True)
-
-    return dm_pos[::rate]
-
-
-def check_hdf5_files(directory):
-    """Check if all HDF5 files in a directory are readable."""
-    corrupted_files = []
-
-    files = [f for f in os.listdir(directory) if f.endswith('.hdf5')]
-    for file in tqdm(files, desc="Checking HDF5 files"):
-        filepath = os.path.join(directory, file)
-        try:
-            # Try opening the file with h5py
-            with h5py.File(filepath, 'r'):
-                pass
-        except Exception as e:  # noqa
-            # If there's an error, add the file to the corrupted list
-            corrupted_files.append(filepath)
+def check_hdf5_files(directory, checksum=False, nproc=1, manifest=None):
+    """
+    Check if all HDF5 files in a directory are readable and that their
+    datasets match the header counts.
+    """
+    files = sorted(join(directory, f) for f in os.listdir(directory)
+                   if f.endswith('.hdf5'))
+    results = check_files(files, checksum=checksum, nproc=nproc,
+                          manifest=manifest)
 
+    corrupted_files = [f for f, res in results.items() if not res["ok"]]
     if corrupted_files:
         print("The following files appear to be corrupted:")
         for f in corrupted_files:
             print(f)
+            for error in results[f]["errors"]:
+                print(f"    {error}")
     else:
         print("All HDF5 files in the directory seem to be fine.")
 
 
 if __name__ == "__main__":
     parser = ArgumentParser()
-    parser.add_argument("--rate", type=int, required=True,
-                        help="Downsampling rate.")
+    parser.add_argument("--rates", type=int, nargs="+", default=None,
+                        help="Downsampling rates, written as nested subsamples in a single file.")  # noqa
     parser.add_argument("--basepath", type=str,
-                        default="/mnt/extraspace/rstiskalek/TNG50-1/output",
-                        help="Basepath to the simulation output.")
+                        default="/mnt/extraspace/rstiskalek/TNG50-1",
+                        help="Path to the simulation directory.")
     parser.add_argument("--nsnap", type=int, default=99,
                         help="Snapshot number.")
     parser.add_argument("--check_corrupt", action="store_true",
                         help="Check for corrupt HDF5 files in the directory.")
+    parser.add_argument("--checksum", action="store_true",
+                        help="When checking for corrupt files, read all datasets and record their checksums.")  # noqa
+    parser.add_argument("--method", type=str, default="bernoulli",
+                        choices=["bernoulli", "exact"],
+                        help="Keep each particle with probability 1 / rate or keep exactly N // rate particles.")  # noqa
+    parser.add_argument("--seed", type=int, default=42,
+                        help="Random seed.")
+    parser.add_argument("--pkind", type=int, default=1,
+                        help="Particle type, e.g. 0 for gas or 1 for dark matter.")  # noqa
+    parser.add_argument("--extra_fields", type=str, nargs="*", default=[],
+                        help="Additional fields of the subsampled particles, e.g. `Velocities` or, for gas, `Masses NeutralHydrogenAbundance`.")  # noqa
+    parser.add_argument("--nproc", type=int, default=1,
+                        help="Number of processes reading or checking the snapshot files.")  # noqa
     args = parser.parse_args()
 
     if args.check_corrupt:
-        fpath = join(args.basepath, f"snapdir_{args.nsnap}")
-        check_hdf5_files(fpath)
+        fpath = join(args.basepath, "output",
+                     f"snapdir_{str(args.nsnap).zfill(3)}")
+        manifest = join(args.basepath, "output",
+                        f"integrity_{str(args.nsnap).zfill(3)}.json")
+        check_hdf5_files(fpath, checksum=args.checksum, nproc=args.nproc,
+                         manifest=manifest)
         quit()
 
-    if args.rate < 0:
-        raise ValueError("The downsampling rate must be non-negative.")
+    if args.rates is None:
+        raise ValueError("`--rates` must be given when downsampling.")
+    if any(rate < 1 for rate in args.rates):
+        raise ValueError("The downsampling rates must be at least 1.")
 
-    print(f"{datetime.now()}: loading the DM particle positions.", flush=True)
-    pos = il.snapshot.loadSubset(args.basepath, args.nsnap, "dm",
-                                 fields=["Coordinates"], float32=True)
-    print(f"{datetime.now()}: finished loading the DM particle positions.",
-          flush=True)
+    kind = {0: "gas", 1: "dm"}.get(args.pkind, f"type{args.pkind}")
+    fout = join(args.basepath, "output",
+                f"{kind}pos_{args.nsnap}_downsampled.hdf5")
 
-    print(f"{datetime.now()}: downsampling the DM particle positions.",
+    print(f"{datetime.now()}: downsampling the {kind} particle positions.",
           flush=True)
-    if args.rate > 0:
-        pos = downsample_particles(pos, args.rate)
-
-    fout = join(args.basepath,
-                f"dmpos_{args.nsnap}_downsampled_{args.rate}.hdf5")
-    with h5py.File(fout, 'w') as f:
-        f.create_dataset("pos", data=pos)
-
-    print(f"{datetime.now()}: wrote the DM particle positions to {fout}.",
+    metrics = RunMetrics("downsample", rates=args.rates, pkind=args.pkind,
+                         extra_fields=args.extra_fields, nproc=args.nproc)
+    files = tngsorted.get_snapshot_files(args.basepath, args.nsnap)
+    downsample_snapshot(files, fout, args.rates, pkind=args.pkind,
+                        extra_fields=args.extra_fields, seed=args.seed,
+                        method=args.method, nproc=args.nproc,
+                        metrics=metrics)
+
+    print(f"{datetime.now()}: wrote the {kind} particle positions to {fout}.",
           flush=True)
+    report = metrics.reduce()
+    write_report(fout.replace(".hdf5", "_report.json"), report)
+    print_report(report)
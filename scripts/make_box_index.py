@@ -0,0 +1,52 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Script to build a periodic cell index of particle positions, which is then
+used by `subbox_make.py` to only visit particles near each sub-box.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+
+import tngsorted
+from h5py import File
+from tngsorted.downsample import read_rate
+from tngsorted.field_cache import source_fingerprint
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Build a cell index of positions.")
+    parser.add_argument("pospath", type=str,
+                        help="File written by `downsample.py`.")
+    parser.add_argument("fout", type=str, help="Output HDF5 file.")
+    parser.add_argument("--boxsize", type=float, default=35000.,
+                        help="Size of the simulation box.")
+    parser.add_argument("--ncells", type=int, default=128,
+                        help="Number of cells per dimension.")
+    parser.add_argument("--rate", type=int, required=True,
+                        help="Downsampling rate of the indexed positions.")
+    args = parser.parse_args()
+
+    print(f"{datetime.now()}: loading particle positions.", flush=True)
+    npart, __ = read_rate(args.pospath, args.rate)
+    with File(args.pospath, 'r') as f:
+        pos = f["pos"][:npart]
+
+    print(f"{datetime.now()}: building the index.", flush=True)
+    index = tngsorted.BoxIndex.build(pos, args.boxsize, args.ncells)
+    del pos
+
+    print(f"{datetime.now()}: writing the index to {args.fout}.", flush=True)
+    # The positions the index was built from, checked by `subbox_make.py`.
+    index.write(args.fout, rate=args.rate, npart=npart,
+                source=source_fingerprint(args.pospath, args.rate))
@@ -18,9 +18,8 @@ Script to combine the subfind catalogue and supplementary catalogues.
 from argparse import ArgumentParser
 from os.path import join
 
-import h5py
 import illustris_python as il
-import numpy as np
+from tngsorted.catalogue import JoinSpec, join_catalogues, write_catalogue
 
 
 def load_subfind(basepath, snap, fields):
@@ -33,33 +32,26 @@ def load_subfind(basepath, snap, fields):
     return il.groupcat.loadSubhalos(path, snap, fields=fields)
 
 
-def append_neutral_hydrogen(data, basepath, snap):
+def join_specs(basepath, snap, joins):
     """
-    Append neutral hydrogen mass to the subfind catalogue.
+    Supplementary catalogue specs from `--join` arguments, whose file paths
+    are relative to the postprocessing directory and may contain `{snap}`.
     """
-    path = join(basepath, "postprocessing",
-                "hih2_galaxy", f"hih2_galaxy_{str(snap).zfill(3)}.hdf5")
-    with h5py.File(path, "r") as f:
-        subhalo_id = f["id_subhalo"][:].astype(int)
-
-    keys_extract = ["m_neutral_H"]
-
-    with h5py.File(path, "r") as f:
-        for key in keys_extract:
-            _x = f[key][:]
-
-            x = np.full(data["count"], np.nan, dtype=_x.dtype)
-            for i, j in enumerate(subhalo_id):
-                x[j] = _x[i]
-
-            data[key] = x
-
-    return data
+    specs = []
+    for join_args in joins:
+        if len(join_args) < 2:
+            raise ValueError("`--join` takes a file, an ID key and optionally columns.")  # noqa
+        fname, id_key, *columns = join_args
+        fname = join(basepath, "postprocessing",
+                     fname.format(snap=str(snap).zfill(3)))
+        specs.append(JoinSpec(fname, id_key, columns if columns else None))
+    return specs
 
 
 def write_dict_to_hdf5(data, basepath, snap):
     """
-    Write a dictionary to an HDF5 file.
+    Write a dictionary to an HDF5 file with chunked, compressed columns and
+    zone maps, which can be queried with `tngsorted.catalogue.select`.
     """
     fname = join(basepath,
                  "postprocessing",
@@ -67,11 +59,7 @@ def write_dict_to_hdf5(data, basepath, snap):
                  )
 
     print(f"Writing to `{fname}`.")
-    with h5py.File(fname, "w") as f:
-        for key, val in data.items():
-            if key == "count":
-                continue
-            f.create_dataset(key, data=val)
+    write_catalogue(fname, data)
 
 
 if __name__ == "__main__":
@@ -82,11 +70,18 @@ if __name__ == "__main__":
                         help="Path to the simulation directory.")
     parser.add_argument("--snap", type=int, default=99,
                         help="Snapshot number.")
+    parser.add_argument("--join", type=str, nargs="+", action="append",
+                        default=None, metavar="FILE ID_KEY [COLUMN ...]",
+                        help="Supplementary catalogue to join, relative to `postprocessing` with `{snap}` replaced by the zero-padded snapshot number. If no columns are given, all columns are joined. May be repeated.")  # noqa
     args = parser.parse_args()
 
     subfind_fields = ["SubhaloMass", "SubhaloPos", "SubhaloMassType"]
 
     data = load_subfind(args.basepath, args.snap, subfind_fields)
-    data = append_neutral_hydrogen(data, args.basepath, args.snap)
+    joins = args.join
+    if joins is None:
+        joins = [["hih2_galaxy/hih2_galaxy_{snap}.hdf5", "id_subhalo",
+                  "m_neutral_H"]]
+    data = join_catalogues(data, join_specs(args.basepath, args.snap, joins))
 
     write_dict_to_hdf5(data, args.basepath, args.snap)
@@ -0,0 +1,85 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Script to select sub-box centres from the merged subfind catalogue written
+by `make_subfind_catalogue.py`. The centres are written to an HDF5 table
+that is read by `subbox_make.py`.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+
+from tngsorted.centres import (estimate_costs, remove_overlapping,
+                               select_centres, write_centres)
+
+
+def parse_cuts(cuts):
+    """
+    Parse `--cut` arguments, where a column of a 2-dimensional dataset is
+    given as `name:index`.
+    """
+    where = []
+    for key, op, value in cuts:
+        if ":" in key:
+            key, index = key.split(":")
+            key = (key, int(index))
+        where.append((key, op, float(value)))
+    return where
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Select sub-box centres.")
+    parser.add_argument("catalogue", type=str,
+                        help="Catalogue written by `make_subfind_catalogue.py`.")  # noqa
+    parser.add_argument("fout", type=str, help="Output HDF5 file.")
+    parser.add_argument("--cut", type=str, nargs=3, action="append",
+                        default=None, metavar=("COLUMN", "OP", "VALUE"),
+                        help="Cut on a catalogue column, e.g. `SubhaloMassType:1 '>' 10`. May be repeated. By default, `M_dm > 1e11 Msun / h` and `M_HI > 1e4 Msun / h`.")  # noqa
+    parser.add_argument("--boxsize", type=float, default=35000.,
+                        help="Size of the simulation box.")
+    parser.add_argument("--subbox_size", type=float, default=2000.,
+                        help="Size of the sub-boxes.")
+    parser.add_argument("--remove_overlap", action="store_true",
+                        help="Remove sub-boxes overlapping a more massive one.")  # noqa
+    parser.add_argument("--index_file", type=str, default=None,
+                        help="Cell index built by `make_box_index.py` to estimate the cost of each sub-box.")  # noqa
+    args = parser.parse_args()
+
+    cuts = args.cut
+    if cuts is None:
+        # Masses in the subfind catalogue are in units of 1e10 Msun / h.
+        cuts = [["SubhaloMassType:1", ">", "10"],
+                ["m_neutral_H", ">", "1e4"]]
+    where = parse_cuts(cuts)
+
+    ids, centers, columns = select_centres(args.catalogue, where)
+    print(f"{datetime.now()}: selected {len(ids)} centres.", flush=True)
+
+    if args.remove_overlap:
+        mass = columns["SubhaloMassType"][:, 1] if "SubhaloMassType" in columns else None  # noqa
+        keep = remove_overlapping(centers, args.subbox_size, args.boxsize,
+                                  priority=mass)
+        ids, centers = ids[keep], centers[keep]
+        columns = {key: val[keep] for key, val in columns.items()}
+        print(f"{datetime.now()}: kept {len(ids)} non-overlapping centres.",
+              flush=True)
+
+    cost = None
+    if args.index_file is not None:
+        cost = estimate_costs(centers, args.subbox_size, args.index_file)
+
+    write_centres(args.fout, ids, centers, cost=cost, columns=columns,
+                  boxsize=args.boxsize, subbox_size=args.subbox_size,
+                  cuts=str(where))
+    print(f"{datetime.now()}: wrote the centres to {args.fout}.", flush=True)
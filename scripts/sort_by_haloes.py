@@ -17,60 +17,32 @@ Script to load haloes from a TNG simulation and store them in a HDF5 file.
 This is motivated by the fact that the default way of accessing haloes'
 particles is very slow.
 
-Stores particle coordinates and velocities in a dataset called "particles" and
-the offsets of each halo in the dataset called "halomap".
+Stores each particle field of each particle type in a separate dataset, e.g.
+"PartType1/Coordinates", and the offsets of each halo in the dataset called
+"PartType1/halomap".
 
 
 The data can then be accessed as follows:
-particles = f["particles"]
-halomap = f["halomap"]
+pos = f["PartType1/Coordinates"]
+halomap = f["PartType1/halomap"]
 
 Choose som halo...
-start, end = halomap[21, :]
-halo = particles[start:end, :]
-"""
-from argparse import ArgumentParser
-from os.path import join
+hid, start, end = halomap[21, :]
+halo_pos = pos[start:end, :]
 
-import h5py
-import illustris_python as il
-import numpy
-from tqdm import trange
+Subhaloes of the stored haloes are indexed in "PartType1/subhalomap" with
+rows of (sid, hid, start, end), so a subhalo is also a single slice:
+sid, hid, start, end = subhalomap[42, :]
 
+or, with caching and batched reads, through
+`tngsorted.sort_by_halo.SortedHaloReader`.
 """
-This probably doesn't work!
-"""
-
-
-def load_halo(hid, basepath, snap, pkind):
-    fields = ['Coordinates', 'Velocities', 'Potential', 'SubfindVelDisp']
-    try:
-        data = il.snapshot.loadHalo(basepath, 99, hid, 1, fields=fields)
-    except OSError:
-        return None
-
-    out = numpy.zeros((data['count'], 7), dtype=numpy.float32)
-    out[:, :3] = data['Coordinates']
-    out[:, 3:6] = data['Velocities']
-    out[:, 6] = data['Potential']
-
-    return out
-
-
-def append_to_h5py(filename, hid, data):
-    with h5py.File(filename, 'a') as f:
-        parts = f["particles"]
-
-        nparts_before = parts.shape[0]
-        nparts_new = data.shape[0]
-
-        parts.resize((nparts_before + nparts_new, parts.shape[1]))
-        parts[-nparts_new:, :] = data
-
-        offsets = f["halomap"]
-        offsets.resize((offsets.shape[0] + 1, 3))
-        offsets[-1, :] = [hid, nparts_before, nparts_before + nparts_new - 1]
+from argparse import ArgumentParser
+from datetime import datetime
+from os.path import join
 
+from tngsorted.instrument import RunMetrics, print_report, write_report
+from tngsorted.sort_by_halo import build_sorted_halos
 
 if __name__ == "__main__":
     parser = ArgumentParser()
@@ -79,49 +51,44 @@ if __name__ == "__main__":
         help="Minimum number of particles in a halo to be processed.")
     parser.add_argument(
         "--basepath", type=str,
-        default="/mnt/extraspace/rstiskalek/TNG300-1-Dark/output",
-        help="Basepath of the TNG simulation")
+        default="/mnt/extraspace/rstiskalek/TNG300-1-Dark",
+        help="Path to the TNG simulation directory.")
     parser.add_argument(
         "--fout_folder", type=str,
         default="/mnt/extraspace/rstiskalek/TNG300-1-Dark",
         help="Folder where the output file will be stored")
+    parser.add_argument("--snap", type=int, default=99,
+                        help="Snapshot number.")
+    parser.add_argument("--pkinds", type=int, nargs="+", default=[1],
+                        help="Particle types.")
+    parser.add_argument("--fields", type=str, nargs="+",
+                        default=["Coordinates", "Velocities", "Potential"],
+                        help="Particle fields, must exist for all types.")
+    parser.add_argument("--float16_coords", action="store_true",
+                        help="Store coordinates as half precision offsets from the halo position.")  # noqa
+    parser.add_argument("--mpi", action="store_true",
+                        help="Split the snapshot files between MPI ranks. Requires h5py built with MPI support.")  # noqa
     args = parser.parse_args()
 
-    lengths = il.groupcat.loadHalos(args.basepath, 99, fields="GroupLen")
-    mask = lengths > args.minpart
-
-    ntot = numpy.sum(mask)
-    nparts = numpy.sum(lengths[mask])
-    size = nparts * 6 * 4 / 1024**3
-    size = float("%.4g" % size)
-    est_time = ntot * 250 / 1000 / 60**2
-    est_time = float("%.4g" % est_time)
-
-    print(f"Number of halos to be processed:   {ntot}.")
-    print(f"Total number of particles:         {nparts}.")
-    print(f"Estimated size of the output file: {size} GB.")
-    print(f"Estimated time to process:         {est_time} hours.")
-    print()
+    comm = None
+    if args.mpi:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
 
     fout = join(args.fout_folder, "sorted_halos.hdf5")
-    f = h5py.File(fout, 'w')
-    dset = f.create_dataset("particles", shape=(0, 7), maxshape=(None, 7),
-                            dtype=numpy.float32)
-    dset = f.create_dataset("halomap", shape=(0, 3), maxshape=(None, 3),
-                            dtype=numpy.int64)
-    f.close()
-
-    skipped_halos = []
-
-    for hid in trange(ntot, mininterval=5):
-        halo = load_halo(hid, args.basepath)
-        if halo is None:
-            skipped_halos.append(hid)
-            continue
-
-        append_to_h5py(fout, hid, halo)
-
-    with h5py.File(fout, 'a') as f:
-        f.create_dataset("skipped_halos", data=skipped_halos)
-
-    print(f"Skipped {len(skipped_halos)} halos.")
+    metrics = RunMetrics("sort_by_halo", comm, minpart=args.minpart,
+                         snap=args.snap, pkinds=args.pkinds,
+                         fields=args.fields,
+                         float16_coords=args.float16_coords)
+    build_sorted_halos(args.basepath, args.snap, fout, args.minpart,
+                       pkinds=args.pkinds, fields=args.fields,
+                       float16_coords=args.float16_coords, comm=comm,
+                       metrics=metrics)
+
+    report = metrics.reduce()
+    if comm is None or comm.Get_rank() == 0:
+        print(f"{datetime.now()}: wrote the sorted haloes to {fout}.",
+              flush=True)
+        write_report(join(args.fout_folder, "sorted_halos_report.json"),
+                     report)
+        print_report(report)
@@ -14,84 +14,376 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 """
 Script to select particles within a sub-box of a simulation snapshot.
+
+With `--tracks`, the centres are those of subhaloes followed across
+snapshots by `track_centres.py`. The snapshots are processed one after
+another, loading each snapshot's positions or index once for all tracked
+objects, and each snapshot has its own output file.
 """
 from argparse import ArgumentParser
-from datetime import datetime
 from os.path import join
 
 import numpy
 import tngsorted
 from h5py import File
 from mpi4py import MPI
+from tngsorted.centres import read_centres
+from tngsorted.channels import (CHANNEL_FIELDS, channel_weights,
+                                required_fields)
+from tngsorted.downsample import read_masses, read_rate
+from tngsorted.field_cache import FieldCache, source_fingerprint
+from tngsorted.field_io import (FieldSlabWriter, finalize_field_file,
+                                start_run)
+from tngsorted.instrument import RunMetrics, print_report, write_report
+from tngsorted.parallel import (TaskQueue, load_shared_dataset,
+                                load_shared_index)
+from tngsorted.tracking import read_tracks, tracked_snapshots
 
 
-def load_centers(centers_file, boxsize):
-    """Load box centers from a file."""
-    data = numpy.genfromtxt(centers_file, delimiter=", ", skip_header=1)
+def load_centers(centers_file, boxsize, snap=None):
+    """
+    Load box centers written by `pick_centres.py` or, if `snap` is given,
+    the centers at that snapshot of the tracks written by
+    `track_centres.py`. Tracked objects are labelled by their subhalo IDs
+    at the reference snapshot.
+    """
+    if snap is None:
+        ids, centers, cost = read_centres(centers_file)
+    else:
+        ids, __, centers = read_tracks(centers_file, snap)
+        centers, cost = centers.astype(numpy.float64) % boxsize, None
 
     # Shuffle so that the zeroth rank does not have the most massive haloes.
     gen = numpy.random.default_rng(seed=42)
-    gen.shuffle(data)
-
-    ids = data[:, 0].astype(int)
-    centers = data[:, 1:4]
+    order = gen.permutation(len(ids))
+    ids, centers = ids[order], centers[order]
+    if cost is not None:
+        cost = cost[order]
 
     if not (numpy.all(centers > 0) and numpy.all(centers < boxsize)):
         raise ValueError("All centers must be within the box.")
 
-    return ids, centers.reshape(-1, 3)
+    return ids, centers, cost
 
 
-if __name__ == "__main__":
-    parser = ArgumentParser(description="Make density fields around haloes.")
-    parser.add_argument("centers_file", type=str,
-                        help="File with box centers. Delimiter expected to be ', ', no header and rows of the form 'x, y, z'.")  # noqa
-    args = parser.parse_args()
+def check_index(index_file, pospath, rate, npart):
+    """
+    Check that an index written by `make_box_index.py` was built from the
+    subsample of `rate` in `pospath`, so that the particle masses and the
+    per-particle fields match the indexed positions. Returns an error
+    message or `None`. Indices written before the rate was stored are only
+    checked by their number of particles.
+    """
+    with File(index_file, "r") as f:
+        nindexed = int(f["offsets"][-1])
+        attrs = dict(f.attrs.items())
+
+    if "rate" in attrs and int(attrs["rate"]) != rate:
+        return f"`{index_file}` indexes the subsample of rate {attrs['rate']}, but rate {rate} is used."  # noqa
+    if nindexed != npart:
+        return f"`{index_file}` indexes {nindexed} particles, but the subsample of rate {rate} in `{pospath}` has {npart}."  # noqa
+    if ("source" in attrs
+            and attrs["source"] != source_fingerprint(pospath, rate)):
+        return f"`{index_file}` was built from a different file than `{pospath}`."  # noqa
+    return None
 
-    pospath = "/mnt/extraspace/rstiskalek/TNG50-1/output/dmpos_99_downsampled_4.hdf5"  # noqa
-    # pospath = "/mnt/extraspace/rstiskalek/TNG50-1/output/dm_pos_128.hdf5"
+
+def make_fields(args, comm, snap=None):
+    """
+    Compute and write the fields of all centers, or of the tracked centers
+    at snapshot `snap`, with the positions or index of that snapshot.
+    """
+    pospath, index_file = args.pospath, args.index_file
+    if snap is not None:
+        pospath = pospath.format(snap=snap)
+        if index_file is not None:
+            index_file = index_file.format(snap=snap)
     dumpfolder = "/mnt/extraspace/rstiskalek/TNG50-1/postprocessing/density_field"  # noqa
     rate = 4
     boxsize = 35000.
     subbox_size = 2000.
-    mpart = 3.07367708626464e-05 * 1e10 * rate
+    npart, __ = read_rate(pospath, rate)
+    mpart = read_masses(pospath, rate)
     ngrid = 128
     MAS = "PCS"
+    channels = args.channels
+    # Per-particle weights are needed for several channels or masses.
+    use_weights = channels != ["mass"] or numpy.ndim(mpart) > 0
 
-    comm = MPI.COMM_WORLD
     rank, size = comm.Get_rank(), comm.Get_size()
+    if index_file is not None:
+        error = None
+        if rank == 0:
+            # Raised on all ranks, so that none waits for the zeroth rank.
+            try:
+                error = check_index(index_file, pospath, rate, npart)
+            except (OSError, KeyError) as err:
+                error = f"Cannot read `{index_file}`: {err}"
+        error = comm.bcast(error, root=0)
+        if error is not None:
+            raise ValueError(error)
+    # Only one rank per node reads the data loaded into shared memory. The
+    # node communicator is freed with the shared memory at the end.
+    node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED) if args.shared else None
+    is_reader = node_comm is None or node_comm.Get_rank() == 0
+    metrics = RunMetrics("subbox_make", comm, pospath=pospath, rate=rate,
+                         ngrid=ngrid, MAS=MAS, channels=channels,
+                         index_file=index_file, snap=snap,
+                         batch_size=args.batch_size, shared=args.shared,
+                         schedule=args.schedule)
 
-    if rank == 0:
-        print(f"{datetime.now()}: loading particle positions.", flush=True)
-    with File(pospath, 'r') as f:
-        pos = f["pos"][:]
+    ids, centers, cost = load_centers(args.centers_file, boxsize, snap)
+    dynamic = args.schedule == "dynamic"
 
-    comm.Barrier()
+    suffix = "" if channels == ["mass"] else "_" + "_".join(channels)
+    if snap is not None:
+        suffix += f"_snap{str(snap).zfill(3)}"
+    fname_out = join(dumpfolder,
+                     f"fields_rate_{rate}_ngrid_{ngrid}_MAS_{MAS}{suffix}.hdf5")  # noqa
+    # If the output file exists, only the missing fields are computed.
+    run, done = None, None
     if rank == 0:
-        print(f"{datetime.now()}: all ranks loaded particle positions.",
-              flush=True)
+        run, done = start_run(fname_out, ids, centers, ngrid, subbox_size,
+                              MAS, validate=not args.no_validate,
+                              boxsize=boxsize, nchannels=len(channels),
+                              channels=channels,
+                              **({} if snap is None else {"snap": snap}),
+                              **({} if use_weights else {"mpart": mpart}))
+        metrics.log(f"starting run {run}, {done.sum()}/{len(done)} fields already done.")  # noqa
+    run, done = comm.bcast((run, done), root=0)
+
+    # Rows of this rank's centers in the output file.
+    rows = numpy.where(~done)[0]
+    ids, centers = ids[rows], centers[rows]
+    if cost is not None:
+        cost = cost[rows]
+
+    if not dynamic:
+        # Split centers and ids into chunks for each rank.
+        chunk_size = len(centers) // size
+        extra_tasks = len(centers) % size
+        start_idx = rank * chunk_size + min(rank, extra_tasks)
+        end_idx = start_idx + chunk_size + (1 if rank < extra_tasks else 0)
+
+        centers = centers[start_idx:end_idx]
+        ids = ids[start_idx:end_idx]
+        rows = rows[start_idx:end_idx]
+
+    metrics.log("loading particle positions.")
+    wins = []
+    with metrics.phase("load"):
+        if index_file is None and args.shared:
+            pos, win = load_shared_dataset(comm, pospath, "pos", node_comm,
+                                           nrows=npart)
+            wins.append(win)
+        elif index_file is None:
+            with File(pospath, 'r') as f:
+                pos = f["pos"][:npart]
+        elif args.shared:
+            index, wins = load_shared_index(comm, index_file,
+                                            load_order=use_weights,
+                                            node_comm=node_comm)
+        elif dynamic:
+            # Any rank may get any center, so the whole index is needed.
+            index = tngsorted.BoxIndex.from_hdf5(index_file,
+                                                 load_order=use_weights)
+        else:
+            index = tngsorted.BoxIndex.from_hdf5(
+                index_file, load_order=use_weights, centers=centers,
+                subbox_size=subbox_size)
+
+        # Fields of the subsampled particles needed by the channels.
+        with File(pospath, 'r') as f:
+            data = {key: f[f"fields/{key}"][:npart]
+                    for key in required_fields(channels)}
+
+    if is_reader:
+        loaded = [pos] if index_file is None else [
+            index.pos, index.offsets, index.order]
+        metrics.count("bytes_read", sum(arr.nbytes for arr in loaded
+                                        if arr is not None))
+    metrics.count("bytes_read", sum(arr.nbytes for arr in data.values()))
+
+    with metrics.phase("wait"):
+        comm.Barrier()
+    metrics.log("all ranks loaded particle positions.")
+
+    # Each task is a batch of centers, by default a single center.
+    batch_size = max(args.batch_size, 1)
+    batches = [numpy.arange(i, min(i + batch_size, len(centers)))
+               for i in range(0, len(centers), batch_size)]
 
-    ids, centers = load_centers(args.centers_file, boxsize)
+    if dynamic:
+        if cost is None and index_file is not None:
+            cost = index.estimate_counts(centers, subbox_size)
+        if cost is not None:
+            cost = numpy.array([cost[batch].sum() for batch in batches])
+        tasks = TaskQueue(comm, len(batches), cost=cost)
+    else:
+        tasks = range(len(batches))
 
-    # Split centers and ids into chunks for each rank.
-    chunk_size = len(centers) // size
-    extra_tasks = len(centers) % size
-    start_idx = rank * chunk_size + min(rank, extra_tasks)
-    end_idx = start_idx + chunk_size + (1 if rank < extra_tasks else 0)
+    if args.batch_size > 0 and use_weights:
+        weights = channel_weights(channels, mpart, data, numpy.arange(npart))
 
-    centers = centers[start_idx:end_idx]
-    ids = ids[start_idx:end_idx]
+    def compute(batch):
+        """Fields of a batch of centers."""
+        if args.batch_size > 0:
+            # Selection and deposit are fused in a single pass.
+            with metrics.phase("deposit"):
+                if use_weights:
+                    fields = tngsorted.density_fields_many(
+                        ngrid, pos, centers[batch], subbox_size, boxsize,
+                        MAS=MAS, weights=weights)
+                else:
+                    fields = tngsorted.density_fields_many(
+                        ngrid, pos, centers[batch], subbox_size, boxsize,
+                        MAS=MAS, mpart=mpart)
+            metrics.count("particles_scanned", len(pos))
+        else:
+            center = centers[batch[0]]
+            with metrics.phase("select"):
+                if index_file is None:
+                    subpos, indxs = tngsorted.find_boxed(
+                        pos, center, subbox_size, boxsize,
+                        return_indices=True)
+                elif use_weights:
+                    subpos, indxs = index.query(center, subbox_size,
+                                                return_indices=True)
+                else:
+                    subpos = index.query(center, subbox_size)
+            metrics.count("particles_scanned", len(pos)
+                          if index_file is None else len(subpos))
+            metrics.count("particles_selected", len(subpos))
 
-    for i in range(len(centers)):
-        center = centers[i]
-        print(f"Rank {rank}, {datetime.now()}: processing center {i+1}/{len(centers)}.", flush=True)  # noqa
-        fname_out = join(dumpfolder, f"subhalo_{ids[i]}.npz")
+            with metrics.phase("deposit"):
+                if use_weights:
+                    fields = [tngsorted.density_field_channels(
+                        ngrid, subpos,
+                        channel_weights(channels, mpart, data, indxs), center,
+                        subbox_size, boxsize, MAS=MAS)]
+                else:
+                    fields = [tngsorted.positions_to_density_field(
+                        ngrid, subpos, center, subbox_size, boxsize,
+                        mpart=mpart, MAS=MAS)]
 
-        subpos = tngsorted.find_boxed(pos, center, subbox_size, boxsize)
+        if len(channels) == 1 and use_weights:
+            fields = [field[0] for field in fields]
+        return fields
 
-        field = tngsorted.positions_to_density_field(
-            ngrid, subpos, center, subbox_size, boxsize, mpart=mpart,
-            MAS=MAS, verbose=False)
+    cache = None
+    if args.cache_dir is not None:
+        source = source_fingerprint(pospath, rate) if rank == 0 else None
+        cache = FieldCache(
+            args.cache_dir, comm.bcast(source, root=0), subbox_size, boxsize,
+            MAS, restrict=args.cache_restrict, nwriters=size,
+            max_bytes=None if args.cache_GB is None else int(args.cache_GB * 1024**3),  # noqa
+            channels=channels, per_particle_mass=numpy.ndim(mpart) > 0)
+        if not cache.can_restrict:
+            metrics.log(f"restricting cached finer fields is off for `{MAS}` with `--cache_restrict {args.cache_restrict}`, only cached fields of {ngrid} cells are used.")  # noqa
 
-        numpy.savez(fname_out, field=field, center=center,
-                    subbox_size=subbox_size, ngrid=ngrid, MAS=MAS)
+    writer = FieldSlabWriter(fname_out, rank, run, ngrid,
+                             nchannels=len(channels),
+                             compression=args.compression)
+    position = (lambda: tasks.position) if dynamic else None
+    for k in metrics.track(tasks, len(batches), desc="tasks",
+                           position=position):
+        batch = batches[k]
+
+        if cache is None:
+            fields = compute(batch)
+        else:
+            fields, nhits = cache.fields(centers[batch], ngrid,
+                                         lambda sel: compute(batch[sel]))
+            metrics.count("cache_hits", nhits)
+
+        with metrics.phase("write"):
+            for i, field in zip(batch, fields):
+                writer.write(rows[i], field)
+                metrics.count("bytes_written", field.nbytes)
+        metrics.count("fields", len(batch))
+
+    writer.close()
+    if cache is not None and cache.nskipped > 0:
+        metrics.count("cache_restrict_skipped", cache.nskipped)
+        metrics.log(f"skipped {cache.nskipped} finer cached fields with an even ratio of the grid sizes, which `--cache_restrict exact` does not restrict.", all_ranks=True)  # noqa
+    if dynamic:
+        tasks.report()
+
+    with metrics.phase("wait"):
+        comm.Barrier()
+    if rank == 0:
+        with metrics.phase("finalize"):
+            finalize_field_file(fname_out, validate=False)
+        metrics.log(f"wrote the fields to {fname_out}.")
+
+    report = metrics.reduce()
+    if rank == 0:
+        fname_report = fname_out.replace(".hdf5", f"_run{run}_report.json")
+        write_report(fname_report, report)
+        print_report(report)
+        metrics.log(f"wrote the run report to {fname_report}.")
+
+    # Release the shared memory before the next snapshot is loaded.
+    for win in wins:
+        win.Free()
+    if node_comm is not None:
+        node_comm.Free()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Make density fields around haloes.")
+    parser.add_argument("centers_file", type=str,
+                        help="HDF5 table of box centers written by `pick_centres.py` or, with `--tracks`, tracks written by `track_centres.py`.")  # noqa
+    parser.add_argument("--tracks", action="store_true",
+                        help="Follow the tracked centers across snapshots. With several snapshots `--pospath` and `--index_file` must contain `{snap}`.")  # noqa
+    parser.add_argument("--snaps", type=int, nargs="+", default=None,
+                        help="Snapshots processed with `--tracks`, by default all tracked snapshots.")  # noqa
+    parser.add_argument("--index_file", type=str, default=None,
+                        help="Cell index built by `make_box_index.py`. If not given, all positions are scanned for each center.")  # noqa
+    parser.add_argument("--batch_size", type=int, default=0,
+                        help="If positive, the fields of this many centers are computed in a single pass over all positions.")  # noqa
+    parser.add_argument("--shared", action="store_true",
+                        help="Load the positions or the index once per node into shared memory. Otherwise, each rank loads all positions or only the cells of the index overlapping its centers.")  # noqa
+    parser.add_argument("--schedule", type=str, default="dynamic",
+                        choices=["static", "dynamic"],
+                        help="Static splits the centers into contiguous chunks, dynamic hands out centers on demand in order of decreasing estimated cost.")  # noqa
+    parser.add_argument("--compression", type=str, default=None,
+                        choices=["gzip", "lzf"],
+                        help="HDF5 compression of the fields.")
+    parser.add_argument("--no_validate", action="store_true",
+                        help="On restart, trust the recorded fields of previous runs without checking their checksums.")  # noqa
+    parser.add_argument("--pospath", type=str,
+                        default="/mnt/extraspace/rstiskalek/TNG50-1/output/dmpos_99_downsampled.hdf5",  # noqa
+                        help="File written by `downsample.py`, including the fields needed by the channels.")  # noqa
+    parser.add_argument("--channels", type=str, nargs="+", default=["mass"],
+                        choices=list(CHANNEL_FIELDS),
+                        help="Quantities deposited in a single pass, each stored as a channel of the fields.")  # noqa
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="Directory of cached fields shared between runs. Only fields missing from it are computed.")  # noqa
+    parser.add_argument("--cache_GB", type=float, default=None,
+                        help="Size cap of the cache, the least recently used fields are evicted beyond it.")  # noqa
+    parser.add_argument("--cache_restrict", type=str, default="exact",
+                        choices=["exact", "always", "never"],
+                        help="When to restrict cached finer fields to `ngrid`: only if exact, i.e. for NGP and an odd ratio of the grid sizes, always or never. With the default PCS and power-of-two grids `exact` never restricts, so only fields of the same `ngrid` are reused; use `always` to reuse finer fields smoothed to `ngrid`.")  # noqa
+    args = parser.parse_args()
+
+    if args.batch_size > 0 and args.index_file is not None:
+        raise ValueError("`--batch_size` scans all positions and cannot be combined with `--index_file`.")  # noqa
+
+    comm = MPI.COMM_WORLD
+    if not args.tracks:
+        make_fields(args, comm)
+    else:
+        snaps = args.snaps
+        if snaps is None:
+            snaps = tracked_snapshots(args.centers_file)
+        # Otherwise all snapshots would be gridded from the same particles.
+        if len(snaps) > 1:
+            for name in ("pospath", "index_file"):
+                path = getattr(args, name)
+                if path is not None and "{snap}" not in path:
+                    raise ValueError(f"`--{name}` must contain `{{snap}}` when `--tracks` covers several snapshots, got `{path}`.")  # noqa
+        # Latest snapshots first, as they usually have the most particles in
+        # the sub-boxes.
+        for snap in sorted(snaps, reverse=True):
+            make_fields(args, comm, int(snap))
@@ -0,0 +1,63 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Script to follow the subhaloes of a centres table written by
+`pick_centres.py` across snapshots along their merger trees. The tracks
+are read by `subbox_make.py --tracks`.
+"""
+from argparse import ArgumentParser
+from datetime import datetime
+
+import numpy
+from tngsorted.centres import read_centres
+from tngsorted.tracking import build_tracks, write_tracks
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Follow sub-box centres across snapshots.")  # noqa
+    parser.add_argument("centers_file", type=str,
+                        help="HDF5 table of box centers written by `pick_centres.py`.")  # noqa
+    parser.add_argument("fout", type=str, help="Output HDF5 file.")
+    parser.add_argument("--basepath", type=str,
+                        default="/mnt/extraspace/rstiskalek/TNG50-1",
+                        help="Path to the simulation directory.")
+    parser.add_argument("--snap", type=int, default=99,
+                        help="Snapshot of the subhalo IDs of the centres.")
+    parser.add_argument("--snaps", type=int, nargs="+", required=True,
+                        help="Snapshots to follow the subhaloes to.")
+    parser.add_argument("--tree", type=str, default="SubLink",
+                        help="Merger tree name.")
+    parser.add_argument("--nproc", type=int, default=1,
+                        help="Number of processes reading the merger trees.")
+    args = parser.parse_args()
+
+    ids, centers, __ = read_centres(args.centers_file)
+    snaps = numpy.sort(numpy.unique(args.snaps))
+    print(f"{datetime.now()}: following {len(ids)} subhaloes to {len(snaps)} snapshots.", flush=True)  # noqa
+
+    track_ids, pos = build_tracks(args.basepath, args.snap, ids, snaps,
+                                  tree=args.tree, nproc=args.nproc)
+    # The reference snapshot keeps the centres of the table.
+    if args.snap in snaps:
+        k = numpy.where(snaps == args.snap)[0][0]
+        track_ids[:, k] = ids
+        pos[:, k] = centers
+
+    found = numpy.mean(track_ids >= 0, axis=0)
+    for snap, frac in zip(snaps, found):
+        print(f"Snapshot {snap}: {frac:.1%} of the subhaloes found.")
+
+    write_tracks(args.fout, ids, snaps, track_ids, pos, snap=args.snap,
+                 tree=args.tree)
+    print(f"{datetime.now()}: wrote the tracks to {args.fout}.", flush=True)
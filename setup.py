@@ -3,11 +3,11 @@ from setuptools import find_packages, setup
 
 BUILD_REQ = ["numpy"]
 INSTALL_REQ = BUILD_REQ
-INSTALL_REQ += ["Pylians",
-                "numba",
+INSTALL_REQ += ["numba",
                 "tqdm",
                 "h5py",
                 "mpi4py",
+                "scipy",
                 ]
 
 setup(
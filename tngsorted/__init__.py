@@ -18,7 +18,7 @@ from os.path import join
 
 def get_snapshot_files(basepath, snap):
     """
-    List all files for a given snapshot.
+    List all files for a given snapshot, ordered by their chunk number.
 
     Parameters
     ----------
@@ -33,7 +33,12 @@ def get_snapshot_files(basepath, snap):
     """
     snap = str(snap).zfill(3)
     fpath = join(basepath, "output", f"snapdir_{snap}", f"snap_{snap}*.hdf5")
-    return glob(fpath)
+    # Files are named `snap_XXX.N.hdf5`, sort by `N` rather than as strings.
+    return sorted(glob(fpath), key=lambda f: int(f.split(".")[-2]))
 
 
-from .select_box import find_boxed, positions_to_density_field                  # noqa
+from .select_box import (find_boxed, find_boxed_many, density_fields_many,       # noqa
+                         density_field_channels, positions_to_density_field,    # noqa
+                         find_sphere, radial_profiles)                          # noqa
+from .box_index import BoxIndex                                                 # noqa
+from .snapshot import SnapshotReader                                            # noqa
@@ -0,0 +1,295 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Periodic cell index of particle positions. The particles are sorted by the
+cell they belong to so that a sub-box query only has to visit the particles
+in the cells overlapping the sub-box.
+"""
+import numpy
+from h5py import File
+from numba import jit
+
+from .select_box import _cell_keys, _counting_sort, in_box
+
+
+@jit(nopython=True, fastmath=True, boundscheck=False)
+def _query_cells(pos, offsets, cells, x0, y0, z0, half_width, boxsize):
+    """
+    Indices of particles in a sub-box, only looking at particles in `cells`.
+    First counts the matches and then fills a preallocated array.
+    """
+    count = 0
+    for k in cells:
+        for n in range(offsets[k], offsets[k + 1]):
+            if in_box(pos[n, 0], pos[n, 1], pos[n, 2], x0, y0, z0,
+                      half_width, boxsize):
+                count += 1
+
+    indxs = numpy.empty(count, dtype=numpy.int64)
+    count = 0
+    for k in cells:
+        for n in range(offsets[k], offsets[k + 1]):
+            if in_box(pos[n, 0], pos[n, 1], pos[n, 2], x0, y0, z0,
+                      half_width, boxsize):
+                indxs[count] = n
+                count += 1
+    return indxs
+
+
+def _axis_cells(x0, half_width, cellsize, ncells):
+    """Periodic cell indices along one axis overlapping `x0 +- half_width`."""
+    imin = int(numpy.floor((x0 - half_width) / cellsize))
+    imax = int(numpy.floor((x0 + half_width) / cellsize))
+    if imax - imin + 1 >= ncells:
+        return numpy.arange(ncells)
+    return numpy.arange(imin, imax + 1) % ncells
+
+
+def overlapping_cells(center, subbox_size, boxsize, ncells):
+    """
+    Flattened indices of cells overlapping a periodic sub-box.
+
+    Parameters
+    ----------
+    center : 1-dimensional array
+        Center of the sub-box.
+    subbox_size : float
+        Size of the sub-box.
+    boxsize : float
+        Size of the simulation box.
+    ncells : int
+        Number of cells per dimension.
+
+    Returns
+    -------
+    cells : 1-dimensional array
+    """
+    cellsize = boxsize / ncells
+    i, j, k = (_axis_cells(x, subbox_size / 2, cellsize, ncells)
+               for x in center)
+    cells = (i[:, None, None] * ncells + j[None, :, None])
+    cells = cells * ncells + k[None, None, :]
+    return cells.ravel()
+
+
+class BoxIndex:
+    """
+    Periodic cell index of particle positions. Particles are sorted by their
+    cell, with `offsets[k]:offsets[k + 1]` being the particles in the `k`-th
+    cell, where `k = (i * ncells + j) * ncells + l`.
+
+    Parameters
+    ----------
+    pos : 2-dimensional array of shape (nsamples, 3)
+        Cell-sorted particle positions.
+    offsets : 1-dimensional array of shape (ncells**3 + 1,)
+        Cumulative number of particles in the cells.
+    boxsize : float
+        Size of the simulation box.
+    order : 1-dimensional array of shape (nsamples,), optional
+        Indices of the sorted particles in the original, unsorted array.
+    """
+
+    def __init__(self, pos, offsets, boxsize, order=None):
+        ncells = int(round((len(offsets) - 1)**(1 / 3)))
+        if ncells**3 + 1 != len(offsets):
+            raise ValueError("`offsets` must have `ncells**3 + 1` elements.")
+
+        self.pos = pos
+        self.offsets = offsets
+        self.boxsize = boxsize
+        self.order = order
+        self.ncells = ncells
+
+    @classmethod
+    def build(cls, pos, boxsize, ncells, keep_order=True):
+        """
+        Build the index by sorting particles by their cell.
+
+        Parameters
+        ----------
+        pos : 2-dimensional array of shape (nsamples, 3)
+            Particle positions.
+        boxsize : float
+            Size of the simulation box.
+        ncells : int
+            Number of cells per dimension.
+        keep_order : bool, optional
+            Whether to keep the permutation back to the unsorted array.
+
+        Returns
+        -------
+        index : :py:class:`BoxIndex`
+        """
+        keys = _cell_keys(pos, ncells, boxsize)
+        counts = numpy.bincount(keys, minlength=ncells**3)
+        offsets = numpy.zeros(ncells**3 + 1, dtype=numpy.int64)
+        numpy.cumsum(counts, out=offsets[1:])
+
+        order = _counting_sort(keys, offsets)
+        del keys
+
+        return cls(pos[order], offsets, boxsize,
+                   order if keep_order else None)
+
+    def query(self, center, subbox_size, return_indices=False):
+        """
+        Find positions of particles in a box of size `subbox_size` centered
+        on `center`. Only particles in the overlapping cells are visited.
+
+        Parameters
+        ----------
+        center : 1-dimensional array
+            Center of the sub-box.
+        subbox_size : float
+            Size of the sub-box.
+        return_indices : bool, optional
+            Whether to also return the indices of the particles in the
+            original, unsorted array.
+
+        Returns
+        -------
+        pos : 2-dimensional array of shape (nsubsamples, 3)
+        indxs : 1-dimensional array of shape (nsubsamples,), optional
+        """
+        if return_indices and self.order is None:
+            raise ValueError("The index was built without `order`.")
+
+        cells = overlapping_cells(center, subbox_size, self.boxsize,
+                                  self.ncells)
+        indxs = _query_cells(self.pos, self.offsets, cells, *center,
+                             subbox_size / 2, self.boxsize)
+
+        if return_indices:
+            return self.pos[indxs], self.order[indxs]
+        return self.pos[indxs]
+
+    def estimate_counts(self, centers, subbox_size):
+        """
+        Upper bound on the number of particles in sub-boxes from the number
+        of particles in the overlapping cells. Does not visit the particles,
+        so it is cheap enough to estimate the cost of many sub-boxes.
+
+        Parameters
+        ----------
+        centers : 2-dimensional array of shape (ncenters, 3)
+            Centers of the sub-boxes.
+        subbox_size : float
+            Size of the sub-boxes.
+
+        Returns
+        -------
+        counts : 1-dimensional array of shape (ncenters,)
+        """
+        cell_counts = numpy.diff(self.offsets)
+        centers = numpy.asanyarray(centers).reshape(-1, 3)
+        return numpy.array(
+            [cell_counts[overlapping_cells(center, subbox_size, self.boxsize,
+                                           self.ncells)].sum()
+             for center in centers], dtype=numpy.int64)
+
+    def write(self, fname, **attrs):
+        """
+        Write the index to an HDF5 file.
+
+        Parameters
+        ----------
+        fname : str
+            Output file name.
+        **attrs : dict
+            Attributes to store, e.g. the downsampling rate of the indexed
+            positions.
+
+        Returns
+        -------
+        None
+        """
+        with File(fname, "w") as f:
+            f.create_dataset("pos", data=self.pos)
+            f.create_dataset("offsets", data=self.offsets)
+            if self.order is not None:
+                f.create_dataset("order", data=self.order)
+            f.attrs["boxsize"] = self.boxsize
+            f.attrs["ncells"] = self.ncells
+            for key, val in attrs.items():
+                f.attrs[key] = val
+
+    @classmethod
+    def from_hdf5(cls, fname, load_order=False, centers=None,
+                  subbox_size=None):
+        """
+        Load an index written by :py:meth:`BoxIndex.write`. If `centers` are
+        given, only the particles in cells overlapping the sub-boxes are read
+        and the remaining cells are left empty. Because the particles are
+        stored sorted by cell, this reads only a few contiguous slabs.
+
+        Parameters
+        ----------
+        fname : str
+            Input file name.
+        load_order : bool, optional
+            Whether to load the permutation back to the unsorted array.
+        centers : 2-dimensional array of shape (ncenters, 3), optional
+            Centers of the sub-boxes that will be queried.
+        subbox_size : float, optional
+            Size of the sub-boxes that will be queried. Required if
+            `centers` are given.
+
+        Returns
+        -------
+        index : :py:class:`BoxIndex`
+        """
+        with File(fname, "r") as f:
+            offsets = f["offsets"][:]
+            boxsize = float(f.attrs["boxsize"])
+            load_order = load_order and "order" in f
+
+            if centers is None:
+                pos = f["pos"][:]
+                order = f["order"][:] if load_order else None
+                return cls(pos, offsets, boxsize, order)
+
+            if subbox_size is None:
+                raise ValueError("`subbox_size` must be given with `centers`.")
+
+            ncells = int(f.attrs["ncells"])
+            mask = numpy.zeros(ncells**3, dtype=bool)
+            for center in numpy.asanyarray(centers).reshape(-1, 3):
+                mask[overlapping_cells(center, subbox_size, boxsize,
+                                       ncells)] = True
+
+            counts = numpy.where(mask, numpy.diff(offsets), 0)
+            new_offsets = numpy.zeros_like(offsets)
+            numpy.cumsum(counts, out=new_offsets[1:])
+
+            # Runs of consecutive selected cells are contiguous on disk.
+            edges = numpy.diff(numpy.concatenate([[0], mask, [0]]).astype(int))
+            run_starts = numpy.where(edges == 1)[0]
+            run_ends = numpy.where(edges == -1)[0]
+
+            dset = f["pos"]
+            pos = numpy.empty((new_offsets[-1], 3), dtype=dset.dtype)
+            order = (numpy.empty(new_offsets[-1], dtype=numpy.int64)
+                     if load_order else None)
+            for i, j in zip(run_starts, run_ends):
+                if offsets[j] == offsets[i]:
+                    continue
+                src = numpy.s_[offsets[i]:offsets[j]]
+                dest = numpy.s_[new_offsets[i]:new_offsets[j]]
+                dset.read_direct(pos, src, dest)
+                if load_order:
+                    f["order"].read_direct(order, src, dest)
+
+        return cls(pos, offsets=new_offsets, boxsize=boxsize, order=order)
@@ -0,0 +1,303 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Joins of supplementary catalogues keyed by subhalo ID into the subfind
+catalogue. Each supplementary column is scattered into a subhalo-indexed
+array one block of rows at a time, so only the subhalo IDs and the output
+column are held in memory.
+
+The merged catalogue is written with chunked, compressed columns and a
+per-chunk min/max zone map of each numeric column. A selection first
+discards the chunks whose zone maps cannot satisfy the cuts and then only
+reads the remaining chunks. Subfind orders subhaloes by group and by mass
+within a group, so the mass columns are close to sorted and most chunks
+are discarded by mass cuts.
+"""
+import operator
+from collections import namedtuple
+
+import numpy
+from h5py import File
+
+JoinSpec = namedtuple("JoinSpec", ["fname", "id_key", "columns"])
+JoinSpec.__doc__ = """
+Supplementary catalogue to join into the subfind catalogue.
+
+Parameters
+----------
+fname : str
+    Path to the HDF5 file.
+id_key : str
+    Dataset with the subhalo ID of each row.
+columns : list of str, optional
+    Datasets to join. If `None`, all datasets with one row per subhalo ID
+    are joined.
+"""
+JoinSpec.__new__.__defaults__ = (None,)
+
+
+def _fill_value(dtype):
+    """Value of subhaloes missing from a supplementary catalogue."""
+    if numpy.issubdtype(dtype, numpy.floating):
+        return numpy.nan
+    if numpy.issubdtype(dtype, numpy.signedinteger):
+        return -1
+    if numpy.issubdtype(dtype, numpy.bool_):
+        return False
+    return 0
+
+
+def _default_columns(f, id_key, nrows):
+    """Datasets of a file with one row per subhalo ID."""
+    columns = []
+
+    def visit(name, obj):
+        if (name != id_key and hasattr(obj, "shape") and len(obj.shape) > 0
+                and obj.shape[0] == nrows):
+            columns.append(name)
+
+    f.visititems(visit)
+    return columns
+
+
+def join_column(dset, subhalo_id, count, block_size=2**22):
+    """
+    Scatter a supplementary column into a subhalo-indexed array.
+
+    Parameters
+    ----------
+    dset : h5py.Dataset
+        Supplementary column with one row per `subhalo_id`.
+    subhalo_id : 1-dimensional array of shape (nrows,)
+        Subhalo ID of each row.
+    count : int
+        Number of subhaloes in the subfind catalogue.
+    block_size : int, optional
+        Number of rows read at a time.
+
+    Returns
+    -------
+    out : array of shape (count, ...)
+        Subhaloes missing from the supplementary catalogue are filled with
+        NaN for floating point columns and -1 for signed integer columns.
+    """
+    if dset.shape[0] != len(subhalo_id):
+        raise ValueError(f"`{dset.name}` has {dset.shape[0]} rows, but there are {len(subhalo_id)} subhalo IDs.")  # noqa
+
+    out = numpy.full((count, ) + dset.shape[1:], _fill_value(dset.dtype),
+                     dtype=dset.dtype)
+    for start in range(0, len(subhalo_id), block_size):
+        end = min(start + block_size, len(subhalo_id))
+        out[subhalo_id[start:end]] = dset[start:end]
+
+    return out
+
+
+def join_catalogues(data, specs, block_size=2**22, verbose=True):
+    """
+    Join supplementary catalogues keyed by subhalo ID into the subfind
+    catalogue, one column at a time.
+
+    Parameters
+    ----------
+    data : dict
+        Subfind catalogue as returned by `illustris_python`, including the
+        number of subhaloes under `count`. Modified in place.
+    specs : list of :py:class:`JoinSpec` or tuples
+        Supplementary catalogues given as `(fname, id_key, columns)`.
+    block_size : int, optional
+        Number of rows read at a time.
+    verbose : bool, optional
+        Verbosity flag.
+
+    Returns
+    -------
+    data : dict
+    """
+    count = int(data["count"])
+    for spec in specs:
+        spec = JoinSpec(*spec)
+        with File(spec.fname, "r") as f:
+            subhalo_id = f[spec.id_key][:].astype(numpy.int64)
+            if subhalo_id.size > 0 and (subhalo_id.min() < 0
+                                        or subhalo_id.max() >= count):
+                raise ValueError(f"`{spec.fname}` has subhalo IDs outside of the subfind catalogue.")  # noqa
+            if len(numpy.unique(subhalo_id)) != len(subhalo_id):
+                raise ValueError(f"`{spec.fname}` has duplicate subhalo IDs.")  # noqa
+
+            columns = spec.columns
+            if columns is None:
+                columns = _default_columns(f, spec.id_key, len(subhalo_id))
+
+            for key in columns:
+                if key in data:
+                    raise ValueError(f"Column `{key}` of `{spec.fname}` is already in the catalogue.")  # noqa
+                if verbose:
+                    print(f"Joining `{key}` from `{spec.fname}`.", flush=True)
+                data[key] = join_column(f[key], subhalo_id, count, block_size)
+
+    return data
+
+
+###############################################################################
+#                        Columnar catalogue output                            #
+###############################################################################
+
+
+OPERATORS = {">": operator.gt, ">=": operator.ge, "<": operator.lt,
+             "<=": operator.le, "==": operator.eq, "!=": operator.ne}
+
+
+def _zone_map(x, chunk_rows):
+    """Per-chunk minimum and maximum of a column, ignoring NaNs."""
+    nchunks = -(-len(x) // chunk_rows)
+    zmap = numpy.empty((nchunks, 2) + x.shape[1:], dtype=x.dtype)
+    for i in range(nchunks):
+        chunk = x[i * chunk_rows:(i + 1) * chunk_rows]
+        zmap[i, 0] = numpy.fmin.reduce(chunk, axis=0)
+        zmap[i, 1] = numpy.fmax.reduce(chunk, axis=0)
+    return zmap
+
+
+def write_catalogue(fname, data, chunk_rows=2**16, compression="gzip"):
+    """
+    Write a catalogue with chunked, compressed columns and per-chunk
+    min/max zone maps of the numeric columns under `zonemaps`.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    data : dict
+        Catalogue columns, all with the same number of rows. The `count`
+        key is written as an attribute.
+    chunk_rows : int, optional
+        Number of rows per chunk.
+    compression : str, optional
+        HDF5 compression filter, e.g. `gzip` or `lzf`.
+
+    Returns
+    -------
+    None
+    """
+    columns = {key: numpy.asanyarray(val) for key, val in data.items()
+               if key != "count"}
+    nrows = {len(val) for val in columns.values()}
+    if len(nrows) > 1:
+        raise ValueError("All columns must have the same number of rows.")
+    count = nrows.pop() if nrows else 0
+    chunk_rows = max(min(chunk_rows, count), 1)
+
+    with File(fname, "w") as f:
+        f.attrs["count"] = count
+        f.attrs["chunk_rows"] = chunk_rows
+        for key, val in columns.items():
+            f.create_dataset(key, data=val, chunks=(chunk_rows, ) + val.shape[1:],  # noqa
+                             compression=compression, shuffle=True)
+            if val.dtype.kind in "biuf":
+                f.create_dataset(f"zonemaps/{key}",
+                                 data=_zone_map(val, chunk_rows))
+
+
+def _parse_condition(condition):
+    """Split a `(column, op, value)` condition, where `column` may be a
+    `(name, index)` tuple to select a column of a 2-dimensional dataset."""
+    key, op, value = condition
+    if op not in OPERATORS:
+        raise ValueError(f"Unknown operator `{op}`, must be one of {list(OPERATORS)}.")  # noqa
+    if isinstance(key, tuple):
+        key, index = key
+    else:
+        index = None
+    return key, index, OPERATORS[op], value
+
+
+def _candidate_chunks(zmap, op, value):
+    """Chunks whose `(min, max)` range can contain rows satisfying a cut."""
+    zmin, zmax = zmap[:, 0], zmap[:, 1]
+    if op in (operator.gt, operator.ge):
+        return op(zmax, value)
+    if op in (operator.lt, operator.le):
+        return op(zmin, value)
+    if op is operator.eq:
+        return (zmin <= value) & (zmax >= value)
+    return numpy.ones(len(zmap), dtype=bool)
+
+
+def select(fname, where, columns=None):
+    """
+    Select rows of a catalogue written by :py:func:`write_catalogue` that
+    satisfy all cuts, reading only the chunks whose zone maps allow it.
+
+    Parameters
+    ----------
+    fname : str
+        Catalogue file name.
+    where : list of tuples
+        Cuts `(column, op, value)` that are combined with a logical and,
+        e.g. `[(("SubhaloMassType", 1), ">", 10.), ("m_neutral_H", ">",
+        1e4)]`. `op` is one of `>`, `>=`, `<`, `<=`, `==` and `!=`, and
+        `column` is either a dataset name or a `(name, index)` tuple.
+    columns : list of str, optional
+        Columns to return. If `None`, all columns are returned.
+
+    Returns
+    -------
+    out : dict
+        Selected rows of the columns, and their row indices, i.e. the
+        subhalo IDs, under `index`.
+    """
+    conditions = [_parse_condition(cond) for cond in where]
+
+    with File(fname, "r") as f:
+        count = int(f.attrs["count"])
+        chunk_rows = int(f.attrs["chunk_rows"])
+        if columns is None:
+            columns = [key for key in f.keys() if key != "zonemaps"]
+
+        nchunks = -(-count // chunk_rows)
+        candidates = numpy.ones(nchunks, dtype=bool)
+        for key, index, op, value in conditions:
+            if f"zonemaps/{key}" not in f:
+                continue
+            zmap = f[f"zonemaps/{key}"][:]
+            if index is not None:
+                zmap = zmap[:, :, index]
+            candidates &= _candidate_chunks(zmap, op, value)
+
+        out = {key: [] for key in ["index"] + list(columns)}
+        for i in numpy.where(candidates)[0]:
+            rows = numpy.s_[i * chunk_rows:min((i + 1) * chunk_rows, count)]
+            mask = numpy.ones(rows.stop - rows.start, dtype=bool)
+            for key, index, op, value in conditions:
+                x = f[key][rows]
+                mask &= op(x if index is None else x[:, index], value)
+
+            if not mask.any():
+                continue
+            out["index"].append(numpy.arange(rows.start, rows.stop)[mask])
+            for key in columns:
+                out[key].append(f[key][rows][mask])
+
+        for key in out:
+            if len(out[key]) > 0:
+                out[key] = numpy.concatenate(out[key])
+            elif key == "index":
+                out[key] = numpy.empty(0, dtype=numpy.int64)
+            else:
+                out[key] = numpy.empty((0, ) + f[key].shape[1:],
+                                       dtype=f[key].dtype)
+
+    return out
@@ -0,0 +1,192 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Selection of sub-box centres from the merged subfind catalogue. The centres
+are written to an HDF5 table with the subhalo IDs, the centres, the columns
+used in the cuts and optionally the estimated cost of each sub-box, which
+is read directly by `subbox_make.py`.
+"""
+import numpy
+from h5py import File
+from scipy.spatial import cKDTree
+
+from .box_index import BoxIndex
+from .catalogue import select
+
+
+def select_centres(catalogue, where, pos_key="SubhaloPos"):
+    """
+    Select sub-box centres from a catalogue written by
+    :py:func:`tngsorted.catalogue.write_catalogue`.
+
+    Parameters
+    ----------
+    catalogue : str
+        Catalogue file name.
+    where : list of tuples
+        Cuts `(column, op, value)`, see :py:func:`tngsorted.catalogue.select`.
+    pos_key : str, optional
+        Column with the positions of the subhaloes.
+
+    Returns
+    -------
+    ids : 1-dimensional array of shape (ncenters,)
+        Subhalo IDs.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Sub-box centers.
+    columns : dict
+        Columns used in the cuts of the selected subhaloes.
+    """
+    keys = []
+    for key, __, __ in where:
+        key = key[0] if isinstance(key, tuple) else key
+        if key not in keys and key != pos_key:
+            keys.append(key)
+
+    out = select(catalogue, where, columns=[pos_key] + keys)
+    return out["index"], out[pos_key], {key: out[key] for key in keys}
+
+
+def remove_overlapping(centers, subbox_size, boxsize, priority=None):
+    """
+    Remove sub-boxes overlapping a sub-box of higher priority. The
+    neighbours of each sub-box are found with a periodic KD-tree.
+
+    Parameters
+    ----------
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Sub-box centers.
+    subbox_size : float
+        Size of the sub-boxes.
+    boxsize : float
+        Size of the simulation box.
+    priority : 1-dimensional array of shape (ncenters,), optional
+        Sub-boxes of higher priority, e.g. mass, are kept first. By default
+        the sub-boxes are kept in order.
+
+    Returns
+    -------
+    keep : 1-dimensional boolean array of shape (ncenters,)
+    """
+    centers = numpy.asanyarray(centers).reshape(-1, 3)
+    order = numpy.arange(len(centers))
+    if priority is not None:
+        order = numpy.argsort(priority, kind="stable")[::-1]
+
+    # Two cubic sub-boxes overlap if their centres are closer than the
+    # sub-box size along every axis, i.e. in the Chebyshev norm.
+    # The radius is shrunk slightly because touching sub-boxes do not
+    # overlap, but the query includes points at exactly the radius.
+    centers = numpy.mod(centers, boxsize)
+    tree = cKDTree(centers, boxsize=boxsize)
+    neighbours = tree.query_ball_point(centers, subbox_size * (1 - 1e-12),
+                                       p=numpy.inf)
+
+    keep = numpy.zeros(len(centers), dtype=bool)
+    removed = numpy.zeros(len(centers), dtype=bool)
+    for i in order:
+        if removed[i]:
+            continue
+        keep[i] = True
+        removed[neighbours[i]] = True
+
+    return keep
+
+
+def estimate_costs(centers, subbox_size, index_file):
+    """
+    Estimate the cost of each sub-box as the number of particles in the
+    cells of a :py:class:`tngsorted.BoxIndex` overlapping it. Only the cell
+    offsets of the index are read.
+
+    Parameters
+    ----------
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Sub-box centers.
+    subbox_size : float
+        Size of the sub-boxes.
+    index_file : str
+        Index written by :py:meth:`tngsorted.BoxIndex.write`.
+
+    Returns
+    -------
+    cost : 1-dimensional array of shape (ncenters,)
+    """
+    with File(index_file, "r") as f:
+        offsets = f["offsets"][:]
+        boxsize = float(f.attrs["boxsize"])
+
+    index = BoxIndex(None, offsets, boxsize)
+    return index.estimate_counts(centers, subbox_size)
+
+
+def write_centres(fname, ids, centers, cost=None, columns=None, **attrs):
+    """
+    Write sub-box centres to an HDF5 table.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    ids : 1-dimensional array of shape (ncenters,)
+        Subhalo IDs.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Sub-box centers.
+    cost : 1-dimensional array of shape (ncenters,), optional
+        Estimated cost of each sub-box.
+    columns : dict, optional
+        Additional per-centre columns, e.g. the masses used in the cuts.
+    **attrs : dict
+        Attributes to store, e.g. the sub-box size.
+
+    Returns
+    -------
+    None
+    """
+    with File(fname, "w") as f:
+        f.create_dataset("ids", data=ids)
+        f.create_dataset("centers", data=centers)
+        if cost is not None:
+            f.create_dataset("cost", data=cost)
+        for key, val in (columns or {}).items():
+            f.create_dataset(f"columns/{key}", data=val)
+        for key, val in attrs.items():
+            f.attrs[key] = val
+
+
+def read_centres(fname):
+    """
+    Read sub-box centres written by :py:func:`write_centres`.
+
+    Parameters
+    ----------
+    fname : str
+        Input file name.
+
+    Returns
+    -------
+    ids : 1-dimensional array of shape (ncenters,)
+        Subhalo IDs.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Sub-box centers.
+    cost : 1-dimensional array of shape (ncenters,) or None
+        Estimated cost of each sub-box, if it was written.
+    """
+    with File(fname, "r") as f:
+        ids = f["ids"][:]
+        centers = f["centers"][:]
+        cost = f["cost"][:] if "cost" in f else None
+
+    return ids, centers.reshape(-1, 3), cost
@@ -0,0 +1,93 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Per-particle quantities deposited as channels of a sub-box grid by
+:py:func:`tngsorted.density_field_channels`. Each channel is the particle
+mass times some particle field, so that e.g. the velocity field follows
+from dividing the momentum channels by the mass channel.
+"""
+import numpy
+
+# Primordial hydrogen mass fraction, `NeutralHydrogenAbundance` is the
+# neutral fraction of the hydrogen.
+HYDROGEN_FRACTION = 0.76
+
+# Snapshot fields needed by each channel besides the particle mass.
+CHANNEL_FIELDS = {
+    "mass": (),
+    "momentum_x": ("Velocities",),
+    "momentum_y": ("Velocities",),
+    "momentum_z": ("Velocities",),
+    "HI": ("NeutralHydrogenAbundance",),
+    }
+
+
+def required_fields(channels):
+    """
+    Snapshot fields needed to compute the channels.
+
+    Parameters
+    ----------
+    channels : list of str
+        Channel names, see `CHANNEL_FIELDS`.
+
+    Returns
+    -------
+    fields : list of str
+    """
+    fields = []
+    for channel in channels:
+        if channel not in CHANNEL_FIELDS:
+            raise ValueError(f"Unknown channel `{channel}`, must be one of {list(CHANNEL_FIELDS)}.")  # noqa
+        for field in CHANNEL_FIELDS[channel]:
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+
+def channel_weights(channels, mpart, data, indxs):
+    """
+    Quantity of each selected particle deposited onto each channel.
+
+    Parameters
+    ----------
+    channels : list of str
+        Channel names, see `CHANNEL_FIELDS`.
+    mpart : float or 1-dimensional array
+        Mass of a single particle or of each particle.
+    data : dict
+        Particle fields returned by :py:func:`required_fields`.
+    indxs : 1-dimensional array of shape (nsamples,)
+        Indices of the selected particles in `data` and `mpart`.
+
+    Returns
+    -------
+    weights : 2-dimensional array of shape (nsamples, nchannels)
+    """
+    required_fields(channels)
+    mass = mpart[indxs] if numpy.ndim(mpart) > 0 else mpart
+
+    weights = numpy.empty((len(indxs), len(channels)), dtype=numpy.float64)
+    for k, channel in enumerate(channels):
+        if channel == "mass":
+            weights[:, k] = mass
+        elif channel.startswith("momentum_"):
+            axis = "xyz".index(channel[-1])
+            weights[:, k] = mass * data["Velocities"][indxs, axis]
+        elif channel == "HI":
+            weights[:, k] = (mass * HYDROGEN_FRACTION
+                             * data["NeutralHydrogenAbundance"][indxs])
+
+    return weights
@@ -0,0 +1,305 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Streaming random downsampling of snapshot particles. The snapshot files are
+processed one at a time, so the peak memory is set by the largest file
+rather than the whole snapshot. With several processes at most two files
+per process are read or waiting to be written at any time.
+
+Several downsampling rates are produced in a single pass as nested
+subsamples: the output is ordered from the coarsest to the finest rate, so
+that the subsample of any rate is a prefix of the output and contains the
+subsamples of all coarser rates.
+
+The number of particles drawn from each file is fixed from the headers
+before any particles are read and each file has its own random generator
+seeded by `(seed, file index)`. The subsample is therefore reproducible and
+does not depend on the order or number of processes reading the files.
+"""
+from collections import deque
+from contextlib import nullcontext
+from itertools import islice
+from multiprocessing import Pool
+
+import numpy
+from h5py import File
+from tqdm import tqdm
+
+from .instrument import RunMetrics
+from .snapshot import SnapshotReader
+
+
+def sample_counts(counts, rates, seed, method="bernoulli"):
+    """
+    Number of particles to draw from each snapshot file for each level of
+    nested subsamples. Level `k` holds the particles that are in the
+    subsample of the `k`-th rate, sorted in decreasing order, but not in
+    the subsamples of the coarser rates.
+
+    Parameters
+    ----------
+    counts : 1-dimensional array of shape (nfiles,)
+        Number of particles in each file.
+    rates : list of int
+        Downsampling rates, the expected fraction kept is `1 / rate`.
+    seed : int
+        Random seed.
+    method : str, optional
+        Either `bernoulli`, where each particle is kept with probability
+        `1 / rate`, or `exact`, where exactly `sum(counts) // rate` particles
+        are kept.
+
+    Returns
+    -------
+    nsample : 2-dimensional array of shape (nfiles, nrates)
+    """
+    counts = numpy.asarray(counts, dtype=numpy.int64)
+    rates = numpy.sort(numpy.asarray(rates))[::-1]
+    if numpy.any(rates < 1):
+        raise ValueError("The downsampling rates must be at least 1.")
+
+    # Fraction of particles at each level, with the rest discarded.
+    cumfrac = 1 / rates
+    probs = numpy.diff(numpy.concatenate([[0], cumfrac, [1]]))
+
+    if method == "bernoulli":
+        return numpy.array(
+            [numpy.random.default_rng([seed, i]).multinomial(n, probs)[:-1]
+             for i, n in enumerate(counts)], dtype=numpy.int64)
+
+    if method == "exact":
+        gen = numpy.random.default_rng(seed)
+        ntot = counts.sum()
+        level_counts = numpy.diff(
+            numpy.concatenate([[0], ntot // rates]))
+
+        remaining = counts.copy()
+        nsample = numpy.zeros((len(counts), len(rates)), dtype=numpy.int64)
+        for k, nlevel in enumerate(level_counts):
+            nsample[:, k] = gen.multivariate_hypergeometric(remaining, nlevel)
+            remaining -= nsample[:, k]
+        return nsample
+
+    raise ValueError(f"Unknown sampling method `{method}`.")
+
+
+def _sample_arrays(arrays, ifile, nsample, seed, dtype):
+    """
+    Randomly draw the particles of each level from the arrays of a single
+    snapshot file. Within each level the particles stay in the snapshot
+    order. All fields are drawn with the same particles.
+    """
+    npart = len(next(iter(arrays.values())))
+    gen = numpy.random.default_rng([seed, ifile, 1])
+    indxs = gen.permutation(npart)[:nsample.sum()]
+    bounds = numpy.concatenate([[0], numpy.cumsum(nsample)])
+    levels = [numpy.sort(indxs[bounds[k]:bounds[k + 1]])
+              for k in range(len(nsample))]
+    return [[data[level].astype(dtype) for level in levels]
+            for data in arrays.values()]
+
+
+def _sample_file(args):
+    """Read a single snapshot file and sample it, see `_sample_arrays`."""
+    fname, ifile, pkind, fields, nsample, seed, dtype = args
+    with File(fname, "r") as f:
+        arrays = {field: f[f"PartType{pkind}/{field}"][:] for field in fields}
+    return ifile, _sample_arrays(arrays, ifile, nsample, seed, dtype)
+
+
+def _bounded_imap(pool, func, tasks, nahead):
+    """
+    Ordered results of `func` over `tasks` on a process pool, like
+    `pool.imap` but with at most `nahead` tasks submitted and not yet
+    consumed, so that results do not pile up in memory while the consumer is
+    slower than the workers. The next task is submitted once a result has
+    been consumed.
+    """
+    tasks = iter(tasks)
+    pending = deque(pool.apply_async(func, (task,))
+                    for task in islice(tasks, nahead))
+    while pending:
+        yield pending.popleft().get()
+        for task in islice(tasks, 1):
+            pending.append(pool.apply_async(func, (task,)))
+
+
+def downsample_snapshot(files, fout, rates, pkind=1, field="Coordinates",
+                        extra_fields=(), seed=42, method="bernoulli", nproc=1,
+                        dtype=numpy.float32, metrics=None, verbose=True):
+    """
+    Randomly downsample a field of snapshot particles at several nested
+    rates in a single pass, reading one snapshot file at a time and writing
+    into a preallocated `pos` dataset. The subsample of `rates[i]` is
+    `pos[:counts[i]]`, where `rates` and `counts` are stored next to `pos`,
+    together with `mpart`, the mass of a subsampled particle in
+    :math:`M_\\odot / h` such that the total mass is conserved. The same
+    particles of `extra_fields`, e.g. `Velocities`, are written to
+    `fields/<name>`.
+
+    Parameters
+    ----------
+    files : list of str
+        Snapshot files ordered by their chunk number.
+    fout : str
+        Output file name.
+    rates : int or list of int
+        Downsampling rates. A rate of 1 keeps all particles.
+    pkind : int, optional
+        Particle type.
+    field : str, optional
+        Particle field.
+    extra_fields : list of str, optional
+        Additional particle fields of the subsampled particles.
+    seed : int, optional
+        Random seed.
+    method : str, optional
+        Sampling method, see :py:func:`sample_counts`.
+    nproc : int, optional
+        Number of processes reading the files in parallel. At most
+        `2 * nproc` files are read ahead of the writer.
+    dtype : type, optional
+        Data type of the output.
+    metrics : :py:class:`tngsorted.instrument.RunMetrics`, optional
+        Metrics to which the time spent reading and writing and the number
+        of particles and bytes are added.
+    verbose : bool, optional
+        Verbosity flag.
+
+    Returns
+    -------
+    None
+    """
+    if metrics is None:
+        metrics = RunMetrics("downsample")
+    rates = numpy.sort(numpy.atleast_1d(rates))[::-1]
+    reader = SnapshotReader(files)
+    offsets = reader.offsets(pkind)
+    nsample = sample_counts(numpy.diff(offsets), rates, seed, method)
+
+    # Start of each level in the output and of each file within each level.
+    level_starts = numpy.concatenate([[0], numpy.cumsum(nsample.sum(axis=0))])
+    file_starts = (level_starts[:-1]
+                   + numpy.cumsum(nsample, axis=0) - nsample)
+
+    mpart = (reader.header["MassTable"][pkind] * 1e10 * offsets[-1]
+             / level_starts[1:])
+
+    fields = [field] + list(extra_fields)
+    info = [reader.field_info(pkind, key) for key in fields]
+    shapes = [shape for shape, __ in info]
+    row_bytes = sum(dt.itemsize * int(numpy.prod(shape))
+                    for shape, dt in info)
+
+    # Only files with sampled particles are read.
+    ifiles = [i for i in range(len(files)) if nsample[i].sum() > 0]
+
+    with File(fout, "w") as f:
+        dsets = [f.create_dataset("pos" if j == 0 else f"fields/{key}",
+                                  shape=(level_starts[-1],) + shapes[j],
+                                  dtype=dtype)
+                 for j, key in enumerate(fields)]
+        f.create_dataset("rates", data=rates)
+        f.create_dataset("counts", data=level_starts[1:])
+        f.create_dataset("mpart", data=mpart)
+        f.attrs["seed"] = seed
+        f.attrs["method"] = method
+        f.attrs["npart_total"] = offsets[-1]
+
+        # A single process reads the next file while sampling the current
+        # one, several processes each read and sample whole files.
+        with Pool(nproc) if nproc > 1 else nullcontext() as pool:
+            if pool is not None:
+                results = _bounded_imap(
+                    pool, _sample_file,
+                    ((files[i], i, pkind, fields, nsample[i], seed, dtype)
+                     for i in ifiles), 2 * nproc)
+            else:
+                results = ((i, _sample_arrays(arrays, i, nsample[i], seed,
+                                              dtype))
+                           for i, __, arrays in reader.iter_blocks(
+                               pkind, fields, files=ifiles))
+            results = iter(tqdm(results, total=len(ifiles),
+                                disable=not verbose,
+                                desc="Downsampling files"))
+            for __ in range(len(ifiles)):
+                # This is the wait for the next file to be read and sampled.
+                with metrics.phase("read"):
+                    i, out = next(results)
+                metrics.count("particles_scanned",
+                              offsets[i + 1] - offsets[i])
+                metrics.count("bytes_read",
+                              (offsets[i + 1] - offsets[i]) * row_bytes)
+
+                with metrics.phase("write"):
+                    for dset, levels in zip(dsets, out):
+                        for k, data in enumerate(levels):
+                            start = file_starts[i, k]
+                            dset[start:start + len(data)] = data
+                            metrics.count("bytes_written", data.nbytes)
+
+
+def read_rate(fname, rate):
+    """
+    Number of particles and particle mass of a subsample written by
+    :py:func:`downsample_snapshot`. The subsample is `pos[:npart]`.
+
+    Parameters
+    ----------
+    fname : str
+        File written by :py:func:`downsample_snapshot`.
+    rate : int
+        Downsampling rate.
+
+    Returns
+    -------
+    npart : int
+        Number of particles in the subsample.
+    mpart : float
+        Particle mass in :math:`M_\\odot / h`.
+    """
+    with File(fname, "r") as f:
+        rates = f["rates"][:]
+        if rate not in rates:
+            raise ValueError(f"Rate {rate} is not in `{fname}`, available rates are {list(rates)}.")  # noqa
+        k = numpy.where(rates == rate)[0][0]
+        return int(f["counts"][k]), float(f["mpart"][k])
+
+
+def read_masses(fname, rate):
+    """
+    Masses of the particles of a subsample written by
+    :py:func:`downsample_snapshot`, scaled such that the total mass is
+    conserved. Particle types without a fixed mass, such as gas, need the
+    `Masses` field to have been downsampled as an extra field.
+
+    Parameters
+    ----------
+    fname : str
+        File written by :py:func:`downsample_snapshot`.
+    rate : int
+        Downsampling rate.
+
+    Returns
+    -------
+    mpart : float or 1-dimensional array of shape (npart,)
+        Particle mass or masses in :math:`M_\\odot / h`.
+    """
+    npart, mpart = read_rate(fname, rate)
+    with File(fname, "r") as f:
+        if "fields/Masses" not in f:
+            return mpart
+        scale = int(f.attrs["npart_total"]) / npart
+        return f["fields/Masses"][:npart] * (1e10 * scale)
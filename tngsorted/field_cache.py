@@ -0,0 +1,368 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Content-addressed cache of sub-box density fields, so that reruns with an
+overlapping list of centers or a coarser grid only compute the missing
+fields. Each field is a file named by the hash of the inputs of
+:py:func:`tngsorted.positions_to_density_field` and a fingerprint of the
+downsampled particles, followed by the number of grid cells, e.g.
+`<hash>_ngrid128.hdf5`.
+
+A field of `ngrid` cells may be restricted from a cached field of
+`k * ngrid` cells by averaging the density over the `k^3` fine cells
+around each coarse grid point, which conserves the mass. Grid points sit
+at integer positions, so the fine cells nest in the coarse cells only for
+odd `k`, and the restriction is exact only for `NGP` with odd `k`. For the
+other schemes or an even `k` the restricted field is the fine field
+smoothed over the coarse cells rather than the coarse deposit, so it is
+only used if asked for.
+
+The access time of a field is its file's modification time, so that
+several ranks may share a cache directory and the least recently used
+fields are evicted once the cache exceeds its size cap. The directory is
+not listed on every store: each rank scans it when the cache is opened and
+after each eviction, and scans it again once the size at the last scan plus
+the bytes it has stored since, times the number of ranks writing to the
+cache, exceeds the cap. The eviction then frees a tenth of the cap, so that
+a full cache is not rescanned on every store. Temporary files left behind
+by crashed writers are deleted by the eviction once they are stale.
+"""
+import os
+from glob import glob
+from time import time
+from hashlib import blake2b
+from os.path import basename, exists, getmtime, getsize, join
+
+import numpy
+from h5py import File
+
+# Age in seconds after which a temporary file of an unfinished store is
+# considered left behind by a crashed writer.
+STALE_TMP_SECONDS = 3600.
+
+
+def source_fingerprint(fname, rate=None, nrows=1024):
+    """
+    Fingerprint of a file written by
+    :py:func:`tngsorted.downsample.downsample_snapshot`, hashing its
+    attributes, rates, counts, particle masses and the first and last
+    `nrows` positions, so that it changes if the file is rewritten with a
+    different subsample but not if it is copied or touched.
+
+    Parameters
+    ----------
+    fname : str
+        File written by :py:func:`tngsorted.downsample.downsample_snapshot`.
+    rate : int, optional
+        Downsampling rate, included in the fingerprint if given.
+    nrows : int, optional
+        Number of leading and trailing positions hashed.
+
+    Returns
+    -------
+    fingerprint : str
+    """
+    h = blake2b(digest_size=16)
+    with File(fname, "r") as f:
+        for key in sorted(f.attrs):
+            h.update(f"{key}={f.attrs[key]}".encode())
+        for key in ("rates", "counts", "mpart"):
+            if key in f:
+                h.update(numpy.ascontiguousarray(f[key][:]).tobytes())
+        pos = f["pos"]
+        h.update(numpy.ascontiguousarray(pos[:nrows]).tobytes())
+        h.update(numpy.ascontiguousarray(pos[-nrows:]).tobytes())
+        h.update(str(sorted(f["fields"].keys()) if "fields" in f else [])
+                 .encode())
+    if rate is not None:
+        h.update(f"rate={rate}".encode())
+    return h.hexdigest()
+
+
+def restrict_field(field, factor):
+    """
+    Restrict a density field to a grid `factor` times coarser by averaging
+    the `factor^3` cells around each coarse grid point, which is the fine
+    grid point `factor` times its index. For an even `factor` the block is
+    offset by half a fine cell. Leading axes, e.g. channels, are kept.
+
+    Parameters
+    ----------
+    field : array of shape (..., ngrid, ngrid, ngrid)
+        Field to restrict, `ngrid` must be divisible by `factor`.
+    factor : int
+        Restriction factor.
+
+    Returns
+    -------
+    field : array of shape (..., ngrid // factor, ngrid // factor,
+            ngrid // factor)
+    """
+    ngrid = field.shape[-1]
+    if ngrid % factor != 0:
+        raise ValueError(f"Cannot restrict a grid of {ngrid} cells by a factor of {factor}.")  # noqa
+    n = ngrid // factor
+    # Periodic shift such that the block of each coarse grid point starts
+    # at the multiple of `factor`.
+    field = numpy.roll(field, (factor - 1) // 2, axis=(-3, -2, -1))
+    shape = field.shape[:-3] + (n, factor, n, factor, n, factor)
+    axes = tuple(field.ndim - 3 + 2 * i + 1 for i in range(3))
+    out = field.reshape(shape).sum(axis=axes, dtype=numpy.float64)
+    return (out / factor**3).astype(field.dtype)
+
+
+class FieldCache:
+    """
+    Cache of the density fields of sub-boxes of a single set of particles,
+    keyed by the sub-box center and number of grid cells.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory, created if it does not exist.
+    source : str
+        Fingerprint of the particles, see :py:func:`source_fingerprint`.
+    subbox_size : float
+        Size of the sub-boxes.
+    boxsize : float
+        Size of the simulation box.
+    MAS : str
+        Mass assignment scheme.
+    max_bytes : int, optional
+        Size cap of the cache directory. If the estimated size exceeds the
+        cap after storing a field, the least recently used fields are
+        evicted. By default no cap.
+    restrict : str, optional
+        When to restrict cached finer fields: `exact` only for `NGP` and an
+        odd ratio of the grid sizes, `always` or `never`.
+    nwriters : int, optional
+        Number of ranks storing fields in the cache directory at the same
+        time, used to estimate its size between scans.
+    **params : dict
+        Any other inputs the fields depend on, e.g. the channels.
+    """
+
+    def __init__(self, directory, source, subbox_size, boxsize, MAS,
+                 max_bytes=None, restrict="exact", nwriters=1, **params):
+        if restrict not in ("exact", "always", "never"):
+            raise ValueError(f"Unknown restriction policy `{restrict}`.")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.restrict = restrict
+        self.nwriters = nwriters
+        self.MAS = MAS
+        # Cached finer fields skipped because of the restriction policy.
+        self.nskipped = 0
+
+        # Inputs shared by all fields of this cache.
+        self._inputs = [f"source={source}",
+                        f"subbox_size={float(subbox_size)!r}",
+                        f"boxsize={float(boxsize)!r}", f"MAS={MAS}"]
+        self._inputs += [f"{key}={params[key]!r}" for key in sorted(params)]
+        # Size of the cache at the last scan and bytes stored since.
+        self._nbytes = self._scan()[1] if max_bytes is not None else 0
+        self._nstored = 0
+
+    def _stem(self, center):
+        """Hash of the inputs of a field except the number of grid cells."""
+        h = blake2b(digest_size=20)
+        for item in self._inputs:
+            h.update(item.encode())
+        h.update(numpy.asarray(center, dtype=numpy.float64).tobytes())
+        return h.hexdigest()
+
+    def path(self, center, ngrid):
+        """Path to the cached field of a sub-box."""
+        return join(self.directory, f"{self._stem(center)}_ngrid{ngrid}.hdf5")
+
+    @property
+    def can_restrict(self):
+        """
+        Whether finer cached fields may be restricted at all, which under
+        the `exact` policy requires `NGP`, so not for the other schemes.
+        """
+        return self.restrict == "always" or (self.restrict == "exact"
+                                             and self.MAS == "NGP")
+
+    def _finer(self, center, ngrid):
+        """Cached fields of a sub-box on finer grids, coarsest first."""
+        if not self.can_restrict:
+            return []
+
+        paths = []
+        for path in glob(join(self.directory, f"{self._stem(center)}_ngrid*.hdf5")):  # noqa
+            n = int(basename(path)[:-5].split("_ngrid")[-1])
+            if n <= ngrid or n % ngrid != 0:
+                continue
+            if self.restrict == "exact" and (n // ngrid) % 2 == 0:
+                self.nskipped += 1
+                continue
+            paths.append((n, path))
+        return sorted(paths)
+
+    @staticmethod
+    def _load(path):
+        """Read a cached field and mark it as recently used."""
+        try:
+            with File(path, "r") as f:
+                field = f["field"][...]
+            os.utime(path)
+        except (OSError, KeyError):
+            # Evicted by another rank or partially written.
+            return None
+        return field
+
+    def get(self, center, ngrid):
+        """
+        Cached field of a sub-box, possibly restricted from a finer grid.
+
+        Parameters
+        ----------
+        center : 1-dimensional array of shape (3,)
+            Sub-box center.
+        ngrid : int
+            Number of grid cells per dimension.
+
+        Returns
+        -------
+        field : numpy.ndarray or None
+            `None` if the field is not cached.
+        """
+        path = self.path(center, ngrid)
+        if exists(path):
+            field = self._load(path)
+            if field is not None:
+                return field
+
+        for n, path in self._finer(center, ngrid):
+            field = self._load(path)
+            if field is not None:
+                return restrict_field(field, n // ngrid)
+        return None
+
+    def put(self, center, ngrid, field):
+        """
+        Store the field of a sub-box and evict the least recently used
+        fields if the cache exceeds its size cap. The file is written under
+        a temporary name and renamed, so readers never see a partial field.
+
+        Parameters
+        ----------
+        center : 1-dimensional array of shape (3,)
+            Sub-box center.
+        ngrid : int
+            Number of grid cells per dimension.
+        field : numpy.ndarray
+            Density field.
+
+        Returns
+        -------
+        None
+        """
+        path = self.path(center, ngrid)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with File(tmp, "w") as f:
+            f.create_dataset("field", data=field)
+            f.attrs["center"] = numpy.asarray(center, dtype=numpy.float64)
+            f.attrs["ngrid"] = ngrid
+            f.attrs["inputs"] = "\n".join(self._inputs)
+        nbytes = getsize(tmp)
+        if exists(path):
+            nbytes -= getsize(path)
+        os.replace(tmp, path)
+        self._nstored += nbytes
+        if (self.max_bytes is not None and self._nbytes
+                + self.nwriters * self._nstored > self.max_bytes):
+            self.evict(0.9)
+
+    def _scan(self):
+        """Cached fields as `(mtime, size, path)` and their total size."""
+        entries = []
+        for path in glob(join(self.directory, "*_ngrid*.hdf5")):
+            try:
+                entries.append((getmtime(path), getsize(path), path))
+            except OSError:
+                continue
+        return entries, sum(size for __, size, __ in entries)
+
+    def evict(self, fraction=1.):
+        """
+        Delete the least recently used fields until the cache is within a
+        fraction of its size cap and stale temporary files. Lists the cache
+        directory and resets the estimate of its size.
+
+        Parameters
+        ----------
+        fraction : float, optional
+            Fraction of the size cap to evict down to.
+
+        Returns
+        -------
+        nevicted : int
+        """
+        if self.max_bytes is None:
+            return 0
+
+        for path in glob(join(self.directory, "*.tmp")):
+            try:
+                if time() - getmtime(path) > STALE_TMP_SECONDS:
+                    os.remove(path)
+            except OSError:
+                continue
+
+        entries, total = self._scan()
+        nevicted = 0
+        for __, size, path in sorted(entries):
+            if total <= fraction * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+            nevicted += 1
+        self._nbytes = total
+        self._nstored = 0
+        return nevicted
+
+    def fields(self, centers, ngrid, compute):
+        """
+        Fields of several sub-boxes, computing and storing only those that
+        are not cached.
+
+        Parameters
+        ----------
+        centers : 2-dimensional array of shape (ncenters, 3)
+            Sub-box centers.
+        ngrid : int
+            Number of grid cells per dimension.
+        compute : callable
+            Called with the indices of the missing centers, returning their
+            fields.
+
+        Returns
+        -------
+        fields : list of numpy.ndarray
+        nhits : int
+            Number of fields read from the cache.
+        """
+        fields = [self.get(center, ngrid) for center in centers]
+        missing = [i for i, field in enumerate(fields) if field is None]
+        if missing:
+            for i, field in zip(missing, compute(numpy.asarray(missing))):
+                self.put(centers[i], ngrid, field)
+                fields[i] = field
+        return fields, len(centers) - len(missing)
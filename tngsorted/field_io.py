@@ -0,0 +1,335 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Output of sub-box density fields. Each rank appends its fields to its own
+slab file and the output file stitches the slabs together in a virtual
+`fields[ncenters, ngrid, ngrid, ngrid]` dataset, so no combine pass is
+needed and the slabs may be compressed. Fields with several channels have
+an additional channel axis, `fields[ncenters, nchannels, ngrid, ngrid,
+ngrid]`.
+
+The slabs double as a journal of finished fields. A restarted run scans the
+slabs of all previous runs, keeps the fields whose checksums match and
+records them in the `done` bitmap of the output file, so only the missing
+fields are recomputed.
+"""
+from glob import glob
+from os.path import basename, dirname, exists, join, splitext
+
+import numpy
+from h5py import File, VirtualLayout, VirtualSource
+
+
+def slab_path(fname, rank, run):
+    """
+    Path to the slab file of a rank in a given run.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    rank : int
+        MPI rank.
+    run : int
+        Run number, incremented on every restart.
+
+    Returns
+    -------
+    path : str
+    """
+    stem = splitext(basename(fname))[0]
+    return join(dirname(fname), f"{stem}_run{run}_rank{rank}.hdf5")
+
+
+def _slab_paths(fname):
+    """Paths to all slab files of an output file, ordered by run."""
+    stem = splitext(basename(fname))[0]
+    paths = glob(join(dirname(fname), f"{stem}_run*_rank*.hdf5"))
+
+    def run_rank(path):
+        run, rank = splitext(path)[0].split("_run")[-1].split("_rank")
+        return int(run), int(rank)
+
+    return sorted(paths, key=run_rank)
+
+
+def create_field_file(fname, ids, centers, ngrid, subbox_size, MAS,
+                      **attrs):
+    """
+    Create the output file with the sub-box IDs and centers. The `fields`
+    and `done` datasets are added by :py:func:`finalize_field_file`.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    ids : 1-dimensional array of shape (ncenters,)
+        Sub-box IDs.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Sub-box centers.
+    ngrid : int
+        Number of grid cells per dimension.
+    subbox_size : float
+        Size of the sub-boxes.
+    MAS : str
+        Mass assignment scheme.
+    **attrs : dict
+        Additional attributes to store, e.g. the particle mass.
+
+    Returns
+    -------
+    None
+    """
+    with File(fname, "w") as f:
+        f.create_dataset("ids", data=ids)
+        f.create_dataset("centers", data=centers)
+        f.attrs["ngrid"] = ngrid
+        f.attrs["subbox_size"] = subbox_size
+        f.attrs["MAS"] = MAS
+        f.attrs["nruns"] = 0
+        for key, val in attrs.items():
+            f.attrs[key] = val
+
+
+def _checksum(field):
+    """Checksum of a field to validate it after a restart."""
+    return numpy.sum(field, dtype=numpy.float64)
+
+
+def _field_shape(ngrid, nchannels):
+    """Shape of a single row of the `fields` dataset."""
+    shape = (ngrid, ngrid, ngrid)
+    return shape if nchannels == 1 else (nchannels, ) + shape
+
+
+class FieldSlabWriter:
+    """
+    Append sub-box fields of a single rank to its slab file, recording the
+    row of the output file and the checksum of each field. Each field is a
+    single chunk.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name, the slab file name is derived from it.
+    rank : int
+        MPI rank.
+    run : int
+        Run number returned by :py:func:`start_run`.
+    ngrid : int
+        Number of grid cells per dimension.
+    nchannels : int, optional
+        Number of channels of each field. If larger than 1, each field has
+        shape `(nchannels, ngrid, ngrid, ngrid)`.
+    compression : str, optional
+        HDF5 compression filter, e.g. `gzip` or `lzf`.
+    dtype : type, optional
+        Data type of the fields.
+    """
+
+    def __init__(self, fname, rank, run, ngrid, nchannels=1,
+                 compression=None, dtype=numpy.float32):
+        shape = _field_shape(ngrid, nchannels)
+        self._f = File(slab_path(fname, rank, run), "w")
+        self._fields = self._f.create_dataset(
+            "fields", shape=(0, ) + shape, maxshape=(None, ) + shape,
+            chunks=(1, ) + shape, dtype=dtype, compression=compression)
+        self._checksums = self._f.create_dataset(
+            "checksums", shape=(0,), maxshape=(None,), dtype=numpy.float64)
+        # A row is only set once its field and checksum are written, so a
+        # field interrupted mid-write keeps the fill value and is skipped.
+        self._rows = self._f.create_dataset(
+            "rows", shape=(0,), maxshape=(None,), dtype=numpy.int64,
+            fillvalue=-1)
+
+    def write(self, row, field):
+        """
+        Append a field.
+
+        Parameters
+        ----------
+        row : int
+            Row of the field in the output file.
+        field : array of shape (ngrid, ngrid, ngrid)
+            Density field, with a leading channel axis if there are several
+            channels.
+
+        Returns
+        -------
+        None
+        """
+        n = self._rows.shape[0]
+        self._fields.resize(n + 1, axis=0)
+        self._fields[n] = field
+        self._checksums.resize(n + 1, axis=0)
+        self._checksums[n] = _checksum(field)
+        self._f.flush()
+        self._rows.resize(n + 1, axis=0)
+        self._rows[n] = row
+        self._f.flush()
+
+    def close(self):
+        """Close the slab file."""
+        self._f.close()
+
+
+def completed_rows(fname, validate=True):
+    """
+    Find the fields written to the slab files of all runs so far. If a row
+    was written more than once, the field of the latest run is used.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    validate : bool, optional
+        Whether to re-read each field and compare it to its checksum.
+        Otherwise only the recorded rows are trusted.
+
+    Returns
+    -------
+    rows : dict
+        Maps each completed row to its slab file path and index within it.
+    """
+    rows = {}
+    for path in _slab_paths(fname):
+        try:
+            with File(path, "r") as f:
+                slab_rows = f["rows"][:]
+                checksums = f["checksums"][:len(slab_rows)]
+                for j, row in enumerate(slab_rows):
+                    if row < 0 or j >= len(checksums):
+                        continue
+                    if validate:
+                        field = f["fields"][j]
+                        if not (numpy.all(numpy.isfinite(field))
+                                and _checksum(field) == checksums[j]):
+                            continue
+                    rows[int(row)] = (path, j)
+        except (OSError, KeyError):
+            # The slab file itself is unreadable, e.g. the job died before
+            # its metadata was written.
+            continue
+
+    return rows
+
+
+def finalize_field_file(fname, validate=True):
+    """
+    Add the virtual `fields` dataset and the `done` bitmap to the output
+    file, mapping each completed row to its field in the slab files. Rows
+    without a field are filled with NaNs.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    validate : bool, optional
+        Whether to validate the fields against their checksums.
+
+    Returns
+    -------
+    done : 1-dimensional boolean array of shape (ncenters,)
+    """
+    with File(fname, "r") as f:
+        ncenters = len(f["ids"])
+        field_shape = _field_shape(int(f.attrs["ngrid"]),
+                                   int(f.attrs.get("nchannels", 1)))
+
+    rows = completed_rows(fname, validate)
+
+    layout, sources = None, {}
+    for row, (path, j) in rows.items():
+        if path not in sources:
+            with File(path, "r") as f:
+                shape, dtype = f["fields"].shape, f["fields"].dtype
+            # Relative paths are resolved relative to the output file.
+            sources[path] = VirtualSource(basename(path), "fields",
+                                          shape=shape, dtype=dtype)
+        if layout is None:
+            layout = VirtualLayout(shape=(ncenters, ) + field_shape,
+                                   dtype=sources[path].dtype)
+        layout[row] = sources[path][j]
+
+    if layout is None:
+        layout = VirtualLayout(shape=(ncenters, ) + field_shape,
+                               dtype=numpy.float32)
+
+    done = numpy.zeros(ncenters, dtype=bool)
+    done[list(rows.keys())] = True
+
+    with File(fname, "a") as f:
+        for key in ("fields", "done"):
+            if key in f:
+                del f[key]
+        f.create_virtual_dataset("fields", layout, fillvalue=numpy.nan)
+        f.create_dataset("done", data=done)
+
+    return done
+
+
+def start_run(fname, ids, centers, ngrid, subbox_size, MAS, validate=True,
+              **attrs):
+    """
+    Start a new run, creating the output file if it does not exist. If it
+    does, the fields of the previous runs are validated and recorded and
+    the run number is incremented. Must be called by a single rank.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    ids : 1-dimensional array of shape (ncenters,)
+        Sub-box IDs.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Sub-box centers.
+    ngrid : int
+        Number of grid cells per dimension.
+    subbox_size : float
+        Size of the sub-boxes.
+    MAS : str
+        Mass assignment scheme.
+    validate : bool, optional
+        Whether to validate the fields of previous runs.
+    **attrs : dict
+        Additional attributes to store, e.g. the particle mass.
+
+    Returns
+    -------
+    run : int
+        Run number.
+    done : 1-dimensional boolean array of shape (ncenters,)
+        Whether the field of each row is already written.
+    """
+    if not exists(fname):
+        create_field_file(fname, ids, centers, ngrid, subbox_size, MAS,
+                          **attrs)
+    else:
+        with File(fname, "r") as f:
+            if not (numpy.array_equal(f["ids"][:], ids)
+                    and numpy.allclose(f["centers"][:], centers)
+                    and int(f.attrs["ngrid"]) == ngrid
+                    and float(f.attrs["subbox_size"]) == subbox_size
+                    and f.attrs["MAS"] == MAS
+                    and int(f.attrs.get("nchannels", 1))
+                    == int(attrs.get("nchannels", 1))):
+                raise ValueError(f"`{fname}` exists but was produced with different centers or settings.")  # noqa
+
+    done = finalize_field_file(fname, validate)
+    with File(fname, "a") as f:
+        run = int(f.attrs["nruns"])
+        f.attrs["nruns"] = run + 1
+
+    return run, done
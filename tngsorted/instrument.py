@@ -0,0 +1,221 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Progress and timing instrumentation of the pipelines. Each rank accumulates
+the time spent in named phases, e.g. `load`, `select`, `deposit` and
+`write`, and counters such as the number of particles scanned or bytes read
+and written. At the end of a run the metrics are gathered on the zeroth
+rank into a report, which is written as JSON or HDF5 to see where the
+cluster hours go and to size future allocations.
+
+The communicator is only used through its Python methods, so the metrics
+also work without MPI and importing this module does not initialise it.
+"""
+import json
+import socket
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from time import perf_counter
+
+import numpy
+from h5py import File
+
+
+def _format_seconds(seconds):
+    """Seconds as `H:MM:SS`."""
+    return str(timedelta(seconds=round(seconds)))
+
+
+class RunMetrics:
+    """
+    Phase timers and counters of a single rank.
+
+    Parameters
+    ----------
+    name : str
+        Name of the pipeline.
+    comm : mpi4py.MPI.Intracomm, optional
+        Communicator of all ranks. If not given, the run is serial.
+    **meta
+        Run parameters stored in the report.
+    """
+
+    def __init__(self, name, comm=None, **meta):
+        self.name = name
+        self.comm = comm
+        self.rank, self.size = (0, 1) if comm is None else (comm.Get_rank(),
+                                                            comm.Get_size())
+        self.meta = meta
+        self.phases = {}
+        self.calls = {}
+        self.counters = {}
+        self.date = datetime.now().isoformat(timespec="seconds")
+        self._start = perf_counter()
+
+    @contextmanager
+    def phase(self, name):
+        """Context manager adding the time spent in its body to a phase."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = (self.phases.get(name, 0.)
+                                 + perf_counter() - start)
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def count(self, name, value=1):
+        """Add `value` to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + int(value)
+
+    def log(self, msg, all_ranks=False):
+        """Print a time-stamped message, by default only on the zeroth rank."""
+        if all_ranks:
+            print(f"Rank {self.rank}, {datetime.now()}: {msg}", flush=True)
+        elif self.rank == 0:
+            print(f"{datetime.now()}: {msg}", flush=True)
+
+    def track(self, iterable, total, desc="tasks", position=None, every=1):
+        """
+        Iterate while printing the progress and estimated time remaining of
+        this rank after every `every` items.
+
+        Parameters
+        ----------
+        iterable : iterable
+            Items to iterate over.
+        total : int
+            Total number of items.
+        desc : str, optional
+            Description of the items.
+        position : callable, optional
+            Returning the number of items started by all ranks, e.g. the
+            position of a :py:class:`tngsorted.parallel.TaskQueue`. If given,
+            the progress and remaining time are those of the whole run
+            rather than of `iterable`.
+        every : int, optional
+            Number of items between printouts.
+
+        Returns
+        -------
+        item : generator
+        """
+        start = perf_counter()
+        for n, item in enumerate(iterable):
+            yield item
+
+            if (n + 1) % every != 0:
+                continue
+            ndone = n + 1 if position is None else min(position(), total)
+            elapsed = perf_counter() - start
+            eta = elapsed / max(ndone, 1) * (total - ndone)
+            self.log(f"{desc} {ndone}/{total}, elapsed {_format_seconds(elapsed)}, ETA {_format_seconds(eta)}.", all_ranks=True)  # noqa
+
+    def reduce(self):
+        """
+        Gather the metrics of all ranks on the zeroth rank. Must be called
+        by all ranks.
+
+        Returns
+        -------
+        report : dict
+            The run report on the zeroth rank, otherwise `None`. Phase times
+            are summarised by their total, minimum, mean and maximum over
+            the ranks and counters are summed.
+        """
+        local = {"rank": self.rank, "host": socket.gethostname(),
+                 "wall_time": perf_counter() - self._start,
+                 "phases": self.phases, "calls": self.calls,
+                 "counters": self.counters}
+        ranks = [local] if self.comm is None else self.comm.gather(local,
+                                                                   root=0)
+        if self.rank != 0:
+            return None
+
+        wall = numpy.array([r["wall_time"] for r in ranks])
+        names = []
+        for r in ranks:
+            names += [key for key in r["phases"] if key not in names]
+
+        phases = {}
+        for key in names:
+            times = numpy.array([r["phases"].get(key, 0.) for r in ranks])
+            phases[key] = {
+                "total": float(times.sum()), "min": float(times.min()),
+                "mean": float(times.mean()), "max": float(times.max()),
+                "calls": int(sum(r["calls"].get(key, 0) for r in ranks)),
+                "fraction": float(times.sum() / wall.sum())
+                if wall.sum() > 0 else 0.}
+
+        counters = {}
+        for r in ranks:
+            for key, val in r["counters"].items():
+                counters[key] = counters.get(key, 0) + val
+
+        return {"name": self.name, "date": self.date, "nranks": self.size,
+                "meta": self.meta, "wall_time": float(wall.max()),
+                "core_hours": float(wall.sum() / 60**2),
+                "phases": phases, "counters": counters,
+                "rates": {key: val / max(wall.max(), 1e-9)
+                          for key, val in counters.items()},
+                "ranks": ranks}
+
+
+def print_report(report):
+    """Print a summary of a report returned by :py:meth:`RunMetrics.reduce`."""
+    print(f"Run `{report['name']}` on {report['nranks']} ranks: wall time "
+          f"{_format_seconds(report['wall_time'])}, "
+          f"{report['core_hours']:.3g} core hours.")
+    for key, val in report["phases"].items():
+        print(f"    {key:>12}: total {val['total']:10.1f} s ({val['fraction']:6.1%}), per rank min {val['min']:.1f} s, mean {val['mean']:.1f} s, max {val['max']:.1f} s.", flush=True)  # noqa
+    for key, val in report["counters"].items():
+        print(f"    {key:>24}: {val:.4g} ({report['rates'][key]:.4g} / s).",
+              flush=True)
+
+
+def write_report(fname, report):
+    """
+    Write a report returned by :py:meth:`RunMetrics.reduce`. Files ending in
+    `.hdf5` or `.h5` store the summary as attributes and the per-rank phase
+    times and counters as datasets, otherwise the report is written as JSON.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    report : dict
+        Run report.
+
+    Returns
+    -------
+    None
+    """
+    if not fname.endswith((".hdf5", ".h5")):
+        with open(fname, "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        return
+
+    ranks = report["ranks"]
+    with File(fname, "w") as f:
+        for key in ("name", "date", "nranks", "wall_time", "core_hours"):
+            f.attrs[key] = report[key]
+        f.attrs["meta"] = json.dumps(report["meta"], default=str)
+        f.create_dataset("hosts", data=[r["host"] for r in ranks])
+        f.create_dataset("wall_time", data=[r["wall_time"] for r in ranks])
+        for key in report["phases"]:
+            f.create_dataset(f"phases/{key}",
+                             data=[r["phases"].get(key, 0.) for r in ranks])
+        for key in report["counters"]:
+            f.create_dataset(f"counters/{key}",
+                             data=[r["counters"].get(key, 0) for r in ranks])
@@ -0,0 +1,178 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Integrity checks of snapshot and group catalogue chunk files. Besides
+opening each file, the length of every dataset is compared to the particle
+or object count in the header and the last row of every dataset is read,
+which catches files truncated after their metadata was written. Optionally,
+every dataset is read in full and its checksum recorded.
+
+Results are cached in a JSON manifest keyed by the file's modification time
+and size, so that only new or changed files are checked again.
+"""
+import json
+from hashlib import blake2b
+from multiprocessing import Pool
+from os import stat
+from os.path import exists
+
+from h5py import Dataset, File
+from tqdm import tqdm
+
+# Header attribute holding the number of rows of each group's datasets.
+HEADER_COUNTS = {"Group": "Ngroups_ThisFile",
+                 "Subhalo": "Nsubgroups_ThisFile"}
+
+
+def _expected_counts(f):
+    """Expected number of rows of the datasets of each group in a file."""
+    header = f["Header"].attrs
+    counts = {}
+    if "NumPart_ThisFile" in header:
+        for pkind, n in enumerate(header["NumPart_ThisFile"]):
+            counts[f"PartType{pkind}"] = int(n)
+    for grp, key in HEADER_COUNTS.items():
+        if key in header:
+            counts[grp] = int(header[key])
+    return counts
+
+
+def check_file(fname, checksum=False, block_size=2**24):
+    """
+    Check a single snapshot or group catalogue chunk file.
+
+    Parameters
+    ----------
+    fname : str
+        File name.
+    checksum : bool, optional
+        Whether to read every dataset in full and compute its checksum.
+    block_size : int, optional
+        Number of rows read at once when computing checksums.
+
+    Returns
+    -------
+    result : dict
+        With keys `ok`, `errors` and, if `checksum`, `checksums` mapping
+        dataset names to hexadecimal digests.
+    """
+    errors, checksums = [], {}
+    try:
+        with File(fname, "r") as f:
+            counts = _expected_counts(f) if "Header" in f else {}
+            for grp, n in counts.items():
+                if n > 0 and grp not in f:
+                    errors.append(f"Missing group `{grp}` with {n} rows.")
+
+            for grp in counts:
+                if grp not in f:
+                    continue
+                for key, dset in f[grp].items():
+                    if not isinstance(dset, Dataset):
+                        continue
+                    name = f"{grp}/{key}"
+                    if dset.shape[0] != counts[grp]:
+                        errors.append(f"`{name}` has {dset.shape[0]} rows, header has {counts[grp]}.")  # noqa
+                        continue
+                    if dset.shape[0] == 0:
+                        continue
+
+                    if checksum:
+                        h = blake2b(digest_size=16)
+                        for i in range(0, dset.shape[0], block_size):
+                            h.update(dset[i:i + block_size].tobytes())
+                        checksums[name] = h.hexdigest()
+                    else:
+                        dset[-1]
+    except Exception as e:  # noqa
+        errors.append(f"{type(e).__name__}: {e}")
+
+    result = {"ok": len(errors) == 0, "errors": errors}
+    if checksum:
+        result["checksums"] = checksums
+    return result
+
+
+def _check_task(args):
+    fname, checksum = args
+    return fname, check_file(fname, checksum)
+
+
+def check_files(files, checksum=False, nproc=1, manifest=None,
+                verbose=True):
+    """
+    Check many snapshot or group catalogue files in parallel, skipping
+    files whose modification time and size match the manifest.
+
+    Parameters
+    ----------
+    files : list of str
+        File names.
+    checksum : bool, optional
+        Whether to compute checksums of all datasets.
+    nproc : int, optional
+        Number of processes.
+    manifest : str, optional
+        Path to a JSON manifest of previous results. It is created if it
+        does not exist and updated with the new results.
+    verbose : bool, optional
+        Verbosity flag.
+
+    Returns
+    -------
+    results : dict
+        Result of :py:func:`check_file` for each file.
+    """
+    cached = {}
+    if manifest is not None and exists(manifest):
+        with open(manifest, "r") as f:
+            cached = json.load(f)
+
+    results, todo = {}, []
+    for fname in files:
+        st = stat(fname)
+        entry = cached.get(fname)
+        if (entry is not None and entry["mtime"] == st.st_mtime
+                and entry["size"] == st.st_size
+                and (not checksum or "checksums" in entry)):
+            results[fname] = entry
+        else:
+            todo.append(fname)
+
+    tasks = [(fname, checksum) for fname in todo]
+    if nproc > 1:
+        pool = Pool(nproc)
+        it = pool.imap_unordered(_check_task, tasks)
+    else:
+        pool = None
+        it = map(_check_task, tasks)
+
+    for fname, result in tqdm(it, total=len(tasks), disable=not verbose,
+                              desc="Checking HDF5 files"):
+        st = stat(fname)
+        result["mtime"] = st.st_mtime
+        result["size"] = st.st_size
+        results[fname] = result
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if manifest is not None:
+        cached.update(results)
+        with open(manifest, "w") as f:
+            json.dump(cached, f, indent=1)
+
+    return {fname: results[fname] for fname in files}
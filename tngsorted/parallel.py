@@ -0,0 +1,248 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+MPI utilities. Not imported by `tngsorted` itself so that importing the
+package does not initialise MPI.
+"""
+from time import perf_counter
+
+import numpy
+from h5py import File
+from mpi4py import MPI
+
+from .box_index import BoxIndex
+
+
+def shared_array(node_comm, shape, dtype):
+    """
+    Allocate an array shared by all ranks of a node communicator. The memory
+    is allocated by the zeroth rank of `node_comm`. The returned window must
+    be kept alive for as long as the array is used.
+
+    Parameters
+    ----------
+    node_comm : mpi4py.MPI.Intracomm
+        Communicator of ranks sharing memory, e.g. from
+        `comm.Split_type(MPI.COMM_TYPE_SHARED)`.
+    shape : tuple of int
+        Shape of the array.
+    dtype : type
+        Data type of the array.
+
+    Returns
+    -------
+    arr : numpy.ndarray
+    win : mpi4py.MPI.Win
+    """
+    dtype = numpy.dtype(dtype)
+    nbytes = int(numpy.prod(shape)) * dtype.itemsize
+    if node_comm.Get_rank() != 0:
+        nbytes = 0
+
+    win = MPI.Win.Allocate_shared(nbytes, dtype.itemsize, comm=node_comm)
+    buf, __ = win.Shared_query(0)
+    return numpy.ndarray(buffer=buf, dtype=dtype, shape=shape), win
+
+
+def load_shared_dataset(comm, fname, key, node_comm=None, nrows=None):
+    """
+    Load an HDF5 dataset, or its first `nrows` rows, once per node into
+    memory shared by all ranks of that node.
+
+    Parameters
+    ----------
+    comm : mpi4py.MPI.Intracomm
+        Communicator of all ranks.
+    fname : str
+        HDF5 file name.
+    key : str
+        Dataset name.
+    node_comm : mpi4py.MPI.Intracomm, optional
+        Communicator of ranks sharing memory. If not given, it is created
+        from `comm` and freed once the dataset is loaded.
+    nrows : int, optional
+        Number of leading rows to load. By default the whole dataset.
+
+    Returns
+    -------
+    arr : numpy.ndarray
+    win : mpi4py.MPI.Win
+    """
+    own_comm = node_comm is None
+    if own_comm:
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+    is_reader = node_comm.Get_rank() == 0
+
+    meta = None
+    if is_reader:
+        with File(fname, "r") as f:
+            shape = f[key].shape
+            if nrows is not None:
+                shape = (min(nrows, shape[0]),) + shape[1:]
+            meta = (shape, f[key].dtype)
+    shape, dtype = node_comm.bcast(meta, root=0)
+
+    arr, win = shared_array(node_comm, shape, dtype)
+    if is_reader and arr.size > 0:
+        with File(fname, "r") as f:
+            f[key].read_direct(arr, numpy.s_[:shape[0]])
+    node_comm.Barrier()
+    if own_comm:
+        node_comm.Free()
+
+    return arr, win
+
+
+def load_shared_index(comm, fname, load_order=False, node_comm=None):
+    """
+    Load a :py:class:`tngsorted.BoxIndex` once per node into memory shared
+    by all ranks of that node.
+
+    Parameters
+    ----------
+    comm : mpi4py.MPI.Intracomm
+        Communicator of all ranks.
+    fname : str
+        File written by :py:meth:`tngsorted.BoxIndex.write`.
+    load_order : bool, optional
+        Whether to load the permutation back to the unsorted array.
+    node_comm : mpi4py.MPI.Intracomm, optional
+        Communicator of ranks sharing memory. If not given, it is created
+        from `comm` and freed once the index is loaded.
+
+    Returns
+    -------
+    index : :py:class:`tngsorted.BoxIndex`
+    wins : list of mpi4py.MPI.Win
+    """
+    own_comm = node_comm is None
+    if own_comm:
+        node_comm = comm.Split_type(MPI.COMM_TYPE_SHARED)
+
+    keys = ["pos", "offsets"] + (["order"] if load_order else [])
+    arrs, wins = {}, []
+    for key in keys:
+        arrs[key], win = load_shared_dataset(comm, fname, key, node_comm)
+        wins.append(win)
+    if own_comm:
+        node_comm.Free()
+
+    with File(fname, "r") as f:
+        boxsize = float(f.attrs["boxsize"])
+
+    index = BoxIndex(arrs["pos"], arrs["offsets"], boxsize, arrs.get("order"))
+    return index, wins
+
+
+class TaskQueue:
+    """
+    Queue handing out task indices to ranks on demand, in order of
+    decreasing estimated cost. The position in the queue is an MPI
+    one-sided counter hosted by `root`, so no rank is reserved as a master.
+    Iterating over the queue yields the task indices picked by this rank.
+
+    Parameters
+    ----------
+    comm : mpi4py.MPI.Intracomm
+        Communicator of all ranks.
+    ntasks : int
+        Number of tasks.
+    cost : 1-dimensional array of shape (ntasks,), optional
+        Estimated cost of each task. If not given, the tasks are handed out
+        in order.
+    root : int, optional
+        Rank hosting the counter.
+    """
+
+    def __init__(self, comm, ntasks, cost=None, root=0):
+        self.comm = comm
+        self.ntasks = ntasks
+        self.root = root
+
+        if cost is None:
+            self.order = numpy.arange(ntasks)
+        else:
+            self.order = numpy.argsort(-numpy.asanyarray(cost),
+                                       kind="stable")
+
+        if comm.Get_rank() == root:
+            self._counter = numpy.zeros(1, dtype=numpy.int64)
+            self._win = MPI.Win.Create(self._counter, disp_unit=8, comm=comm)
+        else:
+            self._win = MPI.Win.Create(None, comm=comm)
+
+        self.ndone = 0
+        # Number of tasks handed out to all ranks when this rank last fetched.
+        self.position = 0
+        self.busy_time = 0.
+        self.wall_time = 0.
+        comm.Barrier()
+
+    def _fetch(self):
+        """Atomically increment the counter and return its old value."""
+        one = numpy.ones(1, dtype=numpy.int64)
+        out = numpy.empty(1, dtype=numpy.int64)
+        self._win.Lock(self.root, MPI.LOCK_SHARED)
+        self._win.Fetch_and_op(one, out, self.root, 0, MPI.SUM)
+        self._win.Unlock(self.root)
+        return int(out[0])
+
+    def __iter__(self):
+        start = perf_counter()
+        while True:
+            i = self._fetch()
+            self.position = min(i + 1, self.ntasks)
+            if i >= self.ntasks:
+                break
+
+            task_start = perf_counter()
+            yield int(self.order[i])
+            self.busy_time += perf_counter() - task_start
+            self.ndone += 1
+
+        self.wall_time = perf_counter() - start
+
+    def report(self, verbose=True):
+        """
+        Gather the per-rank number of tasks, busy and wall time and free the
+        counter. Must be called by all ranks after the iteration.
+
+        Parameters
+        ----------
+        verbose : bool, optional
+            Whether the root rank prints the utilisation.
+
+        Returns
+        -------
+        stats : 2-dimensional array of shape (nranks, 3)
+            Number of tasks, busy and wall time of each rank. Only returned
+            on the root rank, otherwise `None`.
+        """
+        stats = self.comm.gather((self.ndone, self.busy_time, self.wall_time),
+                                 root=self.root)
+        self.comm.Barrier()
+        self._win.Free()
+
+        if self.comm.Get_rank() != self.root:
+            return None
+
+        stats = numpy.asarray(stats, dtype=numpy.float64)
+        if verbose:
+            wall = stats[:, 2].max()
+            util = stats[:, 1] / wall if wall > 0 else numpy.ones(len(stats))
+            for rank, (ndone, busy, __) in enumerate(stats):
+                print(f"Rank {rank}: {int(ndone)} tasks, busy {busy:.1f} s, utilisation {util[rank]:.1%}.")  # noqa
+            print(f"Utilisation: min {util.min():.1%}, mean {util.mean():.1%}, max {util.max():.1%} over {wall:.1f} s.", flush=True)  # noqa
+        return stats
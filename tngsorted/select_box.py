@@ -15,12 +15,13 @@
 """
 Script to select particles within a sub-box of a simulation snapshot.
 """
-import MAS_library as MASL
 import numpy
-from numba import jit
+from numba import get_num_threads, jit, prange
 
 
-@jit(nopython=True, fastmath=True, boundscheck=False)
+# The membership tests are compiled without `fastmath`, so that the count
+# and fill passes of the selection kernels accept the same particles.
+@jit(nopython=True, boundscheck=False)
 def pbc_distance(x1, x2, boxsize):
     """Calculate periodic distance between two points."""
     delta = abs(x1 - x2)
@@ -28,24 +29,125 @@ def pbc_distance(x1, x2, boxsize):
 
 
 @jit(nopython=True, fastmath=True, boundscheck=False)
-def find_next_particle(start_index, end_index, pos, x0, y0, z0,
-                       half_width, boxsize):
+def _cell_keys(pos, ncells, boxsize):
+    """Flattened cell index of each particle."""
+    cellsize = boxsize / ncells
+    keys = numpy.empty(len(pos), dtype=numpy.int64)
+    for n in range(len(pos)):
+        k = 0
+        for j in range(3):
+            i = int(pos[n, j] / cellsize)
+            # Guard against particles exactly at the box edge.
+            i = min(max(i, 0), ncells - 1)
+            k = k * ncells + i
+        keys[n] = k
+    return keys
+
+
+@jit(nopython=True, boundscheck=False)
+def _counting_sort(keys, offsets):
+    """Permutation that sorts `keys`, given the cumulative cell counts."""
+    fill = offsets[:-1].copy()
+    order = numpy.empty(len(keys), dtype=numpy.int64)
+    for n in range(len(keys)):
+        k = keys[n]
+        order[fill[k]] = n
+        fill[k] += 1
+    return order
+
+
+@jit(nopython=True, boundscheck=False)
+def in_box(x, y, z, x0, y0, z0, half_width, boxsize):
+    """
+    Check whether a point is in a box of size `2 * half_width` centered on
+    `x0`, `y0`, `z0`, where the periodic simulation box size is `boxsize`.
+    """
+    return ((pbc_distance(x, x0, boxsize) < half_width) and (pbc_distance(y, y0, boxsize) < half_width) and (pbc_distance(z, z0, boxsize) < half_width))  # noqa
+
+
+@jit(nopython=True, boundscheck=False)
+def in_sphere(x, y, z, x0, y0, z0, radius, boxsize):
+    """
+    Check whether a point is in a sphere of radius `radius` centered on
+    `x0`, `y0`, `z0`, where the periodic simulation box size is `boxsize`.
+    """
+    dx = pbc_distance(x, x0, boxsize)
+    dy = pbc_distance(y, y0, boxsize)
+    dz = pbc_distance(z, z0, boxsize)
+    return dx * dx + dy * dy + dz * dz < radius * radius
+
+
+@jit(nopython=True, boundscheck=False)
+def _inside(x, y, z, x0, y0, z0, size, boxsize, spherical):
+    """
+    Whether a point is in a sub-box of half-width `size` or, if
+    `spherical`, in a sphere of radius `size`.
+    """
+    if spherical:
+        return in_sphere(x, y, z, x0, y0, z0, size, boxsize)
+    return in_box(x, y, z, x0, y0, z0, size, boxsize)
+
+
+@jit(nopython=True, fastmath=True, boundscheck=False, parallel=True)
+def _count_boxed(pos, x0, y0, z0, size, boxsize, spherical, nchunks):
+    """Number of particles of each chunk of `pos` in a sub-box or sphere."""
+    counts = numpy.zeros(nchunks, dtype=numpy.int64)
+    chunk_size = (len(pos) + nchunks - 1) // nchunks
+    for ichunk in prange(nchunks):
+        count = 0
+        for n in range(ichunk * chunk_size,
+                       min((ichunk + 1) * chunk_size, len(pos))):
+            if _inside(pos[n, 0], pos[n, 1], pos[n, 2], x0, y0, z0, size,
+                       boxsize, spherical):
+                count += 1
+        counts[ichunk] = count
+    return counts
+
+
+@jit(nopython=True, fastmath=True, boundscheck=False, parallel=True)
+def _fill_boxed(pos, x0, y0, z0, size, boxsize, spherical, starts, counts,
+                indxs):
     """
-    Find the next particle in a box of size `half_width` centered on `x0`,
-    `y0`, `z0`, where the periodic simulation box size is `boxsize`.
+    Write indices of particles in a sub-box or sphere to `indxs`, where
+    chunk `i` writes its `counts[i]` particles starting at `starts[i]`.
     """
-    for i in range(start_index, end_index):
-        x, y, z = pos[i]
-        if ((pbc_distance(x, x0, boxsize) < half_width) and (pbc_distance(y, y0, boxsize) < half_width) and (pbc_distance(z, z0, boxsize) < half_width)):  # noqa
-            return i
+    nchunks = len(starts)
+    chunk_size = (len(pos) + nchunks - 1) // nchunks
+    for ichunk in prange(nchunks):
+        fill = starts[ichunk]
+        # Never write past the particles counted by `_count_boxed`.
+        end = fill + counts[ichunk]
+        for n in range(ichunk * chunk_size,
+                       min((ichunk + 1) * chunk_size, len(pos))):
+            if fill < end and _inside(pos[n, 0], pos[n, 1], pos[n, 2], x0,
+                                      y0, z0, size, boxsize, spherical):
+                indxs[fill] = n
+                fill += 1
+
+
+def _find_inside(pos, center, size, boxsize, spherical, return_indices):
+    """Count and then write the particles in a sub-box or sphere."""
+    if isinstance(center, list):
+        center = numpy.asanyarray(center)
+
+    args = (pos, *center, size, boxsize, spherical)
+    counts = _count_boxed(*args, get_num_threads())
+    starts = numpy.cumsum(counts) - counts
 
-    return None
+    indxs = numpy.empty(counts.sum(), dtype=numpy.int64)
+    _fill_boxed(*args, starts, counts, indxs)
+
+    if return_indices:
+        return pos[indxs], indxs
+    return pos[indxs]
 
 
-def find_boxed(pos, center, subbox_size, boxsize):
+def find_boxed(pos, center, subbox_size, boxsize, return_indices=False):
     """
     Find positions of particles in a box of size `subbox_size` centered on
-    `center`, where the simulation box size is `boxsize`.
+    `center`, where the simulation box size is `boxsize`. The particles are
+    first counted and then written to a preallocated array, both in
+    parallel over chunks of `pos`.
 
     Parameters
     ----------
@@ -57,35 +159,244 @@ def find_boxed(pos, center, subbox_size, boxsize):
         Size of the sub-box.
     boxsize : float
         Size of the simulation box.
+    return_indices : bool, optional
+        Whether to also return the indices of the particles in `pos`, e.g.
+        to select their velocities or masses.
 
     Returns
     -------
     pos : 2-dimensional array of shape (nsubsamples, 3)
+    indxs : 1-dimensional array of shape (nsubsamples,), optional
     """
-    if isinstance(center, list):
-        center = numpy.asanyarray(center)
+    return _find_inside(pos, center, subbox_size / 2., boxsize, False,
+                        return_indices)
 
-    half_width = subbox_size / 2.
 
-    indxs, start_index, end_index = [], 0, len(pos)
-    while True:
-        i = find_next_particle(start_index, end_index, pos,
-                               *center, half_width, boxsize)
+def find_sphere(pos, center, radius, boxsize, return_indices=False):
+    """
+    Find positions of particles in a sphere of radius `radius` centered on
+    `center`, where the simulation box size is `boxsize`, in the same way
+    as :py:func:`find_boxed`.
+
+    Parameters
+    ----------
+    pos : 2-dimensional array of shape (nsamples, 3)
+        Positions of all particles in the simulation.
+    center : 1-dimensional array
+        Center of the sphere.
+    radius : float
+        Radius of the sphere.
+    boxsize : float
+        Size of the simulation box.
+    return_indices : bool, optional
+        Whether to also return the indices of the particles in `pos`.
+
+    Returns
+    -------
+    pos : 2-dimensional array of shape (nsubsamples, 3)
+    indxs : 1-dimensional array of shape (nsubsamples,), optional
+    """
+    return _find_inside(pos, center, radius, boxsize, True, return_indices)
+
 
-        if i is None:
-            break
+###############################################################################
+#                            Mass assignment                                  #
+###############################################################################
 
-        indxs.append(i)
-        start_index = i + 1
+MAS_ORDER = {"NGP": 1, "CIC": 2, "TSC": 3, "PCS": 4}
+# Minimum number of particles deposited by a thread onto its private grid
+# and maximum memory of all private grids of a sub-box.
+MIN_CHUNK_PARTICLES = 2**15
+MAX_PRIVATE_BYTES = 2**31
 
-    return pos[indxs]
+
+def _mas_order(MAS, ngrid):
+    """
+    Order of a mass assignment scheme, i.e. the width of its stencil in
+    cells. The stencil wraps around the grid at most once, so the grid must
+    be at least as wide.
+    """
+    if MAS not in MAS_ORDER:
+        raise ValueError(f"Unknown mass assignment scheme `{MAS}`.")
+    p = MAS_ORDER[MAS]
+    if ngrid < p:
+        raise ValueError(f"`{MAS}` requires at least {p} grid cells per dimension, got {ngrid}.")  # noqa
+    return p
+
+
+@jit(nopython=True, fastmath=True, boundscheck=False)
+def _stencil(ngrid, x, y, z, p, wbuf, ibuf):
+    """
+    Write the weights and grid indices of the grid points a particle at `x`,
+    `y`, `z` (in units of the cell size) is deposited onto along each axis
+    to the (3, 4) work arrays `wbuf` and `ibuf`. Follows the Pylians
+    conventions: grid points sit at integer positions and the grid is
+    periodic.
+    """
+    for j in range(3):
+        dist = x if j == 0 else (y if j == 1 else z)
+        first = int(numpy.floor(dist - p / 2)) + 1
+        # Offset of the particle from the grid point `first + (p - 1) // 2`.
+        t = dist - first - (p - 1) // 2
+        if p == 1:
+            wbuf[j, 0] = 1.
+        elif p == 2:
+            wbuf[j, 0] = 1. - t
+            wbuf[j, 1] = t
+        elif p == 3:
+            wbuf[j, 0] = 0.5 * (0.5 - t)**2
+            wbuf[j, 1] = 0.75 - t * t
+            wbuf[j, 2] = 0.5 * (0.5 + t)**2
+        else:
+            s = 1. - t
+            wbuf[j, 0] = s * s * s / 6.
+            wbuf[j, 1] = (4. - 6. * t * t + 3. * t * t * t) / 6.
+            wbuf[j, 2] = (4. - 6. * s * s + 3. * s * s * s) / 6.
+            wbuf[j, 3] = t * t * t / 6.
+
+        for a in range(p):
+            # Grid points are at most `p` cells outside of the grid.
+            i = first + a
+            if i < 0:
+                i += ngrid
+            elif i >= ngrid:
+                i -= ngrid
+            ibuf[j, a] = i
+
+
+@jit(nopython=True, fastmath=True, boundscheck=False)
+def _scatter(field, ngrid, weight, p, wbuf, ibuf):
+    """Add the stencil in `wbuf` and `ibuf` times `weight` to the flattened
+    `field`."""
+    # Indexing the flattened field avoids recomputing the strides.
+    for a in range(p):
+        wa = weight * wbuf[0, a]
+        ia = ibuf[0, a] * ngrid
+        for b in range(p):
+            wab = wa * wbuf[1, b]
+            iab = (ia + ibuf[1, b]) * ngrid
+            for c in range(p):
+                field[iab + ibuf[2, c]] += wab * wbuf[2, c]
+
+
+@jit(nopython=True, fastmath=True, boundscheck=False, parallel=True)
+def _deposit_subbox(pos, weights, x0, y0, z0, half_width, boxsize, p,
+                    fields):
+    """
+    Periodically shift particles into a sub-box and deposit their weights
+    onto the channels of `fields`, with chunk `i` of `pos` depositing onto
+    `fields[i]`. If `weights` has no rows, all particles have unit weight.
+    Returns the number of particles outside of the sub-box, which are not
+    deposited.
+    """
+    nchunks, nchannels, ngrid = fields.shape[0], fields.shape[1], fields.shape[2]  # noqa
+    flat = fields.reshape(nchunks, nchannels, -1)
+    cell_inv = ngrid / (2 * half_width)
+    shift = boxsize / 2 - half_width
+    chunk_size = (len(pos) + nchunks - 1) // nchunks
+    nout = numpy.zeros(nchunks, dtype=numpy.int64)
+    for ichunk in prange(nchunks):
+        wbuf = numpy.empty((3, 4), dtype=numpy.float64)
+        ibuf = numpy.empty((3, 4), dtype=numpy.int64)
+        for n in range(ichunk * chunk_size,
+                       min((ichunk + 1) * chunk_size, len(pos))):
+            # Periodic shift such that the sub-box spans [0, subbox_size].
+            dx = (pos[n, 0] - x0 + boxsize / 2) % boxsize - shift
+            dy = (pos[n, 1] - y0 + boxsize / 2) % boxsize - shift
+            dz = (pos[n, 2] - z0 + boxsize / 2) % boxsize - shift
+            if not (0 <= dx <= 2 * half_width and 0 <= dy <= 2 * half_width
+                    and 0 <= dz <= 2 * half_width):
+                nout[ichunk] += 1
+                continue
+
+            # The stencil is shared by all channels.
+            _stencil(ngrid, dx * cell_inv, dy * cell_inv, dz * cell_inv, p,
+                     wbuf, ibuf)
+            for k in range(nchannels):
+                weight = weights[n, k] if weights.shape[0] > 0 else 1.
+                _scatter(flat[ichunk, k], ngrid, weight, p, wbuf, ibuf)
+    return nout.sum()
+
+
+def _check_weights(weights, npart):
+    """Weights as a 2-dimensional array of shape (npart, nchannels)."""
+    weights = numpy.asanyarray(weights)
+    if weights.ndim == 1:
+        weights = weights.reshape(-1, 1)
+    if weights.ndim != 2 or len(weights) != npart:
+        raise ValueError("`weights` must have shape (nsamples, nchannels).")
+    return weights
+
+
+def density_field_channels(ngrid, pos, weights, center, subbox_size,
+                           box_size, MAS="PCS", dtype=numpy.float32):
+    """
+    Deposit several per-particle quantities, e.g. mass, momentum components
+    or HI mass, onto the grid of a sub-box in a single pass. The particles
+    are periodically shifted into the sub-box, checked to lie within it and
+    deposited without copying `pos`, with each thread depositing onto its
+    own grids. The mass assignment weights of a particle are computed once
+    and shared by all channels.
+
+    Parameters
+    ----------
+    ngrid : int
+        Number of grid cells per dimension.
+    pos : 2-dimensional array of shape (nsamples, 3)
+        Particle positions.
+    weights : 2-dimensional array of shape (nsamples, nchannels)
+        Quantity of each particle deposited onto each channel.
+    center : 1-dimensional array
+        Center of the sub-box.
+    subbox_size : float
+        Size of the sub-box.
+    box_size : float
+        Size of the simulation box.
+    MAS : str, optional
+        Mass assignment scheme. Must be one of `NGP`, `CIC`, `TSC` or `PCS`.
+    dtype : type, optional
+        Data type to use for the output array.
+
+    Returns
+    -------
+    fields : 4-dimensional array of shape (nchannels, ngrid, ngrid, ngrid)
+        Density of each quantity, i.e. divided by the cell volume.
+    """
+    p = _mas_order(MAS, ngrid)
+    weights = _check_weights(weights, len(pos))
+    return _grid_subbox(ngrid, pos, weights, weights.shape[1], center,
+                        subbox_size, box_size, p, dtype)
+
+
+def _grid_subbox(ngrid, pos, weights, nchannels, center, subbox_size,
+                 box_size, p, dtype):
+    """Deposit onto thread-private grids and sum them."""
+    # Enough particles per thread to amortise clearing and summing its grid,
+    # with the private grids bounded in memory.
+    grid_bytes = nchannels * ngrid**3 * numpy.dtype(dtype).itemsize
+    nchunks = max(min(get_num_threads(), len(pos) // MIN_CHUNK_PARTICLES,
+                      MAX_PRIVATE_BYTES // grid_bytes), 1)
+    fields = numpy.zeros((nchunks, nchannels, ngrid, ngrid, ngrid),
+                         dtype=dtype)
+    nout = _deposit_subbox(pos, weights, *numpy.asanyarray(center, dtype=numpy.float64),  # noqa
+                           subbox_size / 2, box_size, p, fields)
+    if nout > 0:
+        raise ValueError(f"{nout} particles are not within the sub-box.")
+
+    field = fields[0]
+    for i in range(1, nchunks):
+        field += fields[i]
+
+    field *= 1 / (subbox_size / ngrid)**3
+    return field
 
 
 def positions_to_density_field(ngrid, pos, center, subbox_size, box_size,
-                               MAS="PCS", mpart=1., verbose=True,
+                               MAS="PCS", mpart=1., verbose=False,
                                dtype=numpy.float32):
     """
-    Convert a set of particle positions to a density field.
+    Convert a set of particle positions to a density field, see
+    :py:func:`density_field_channels`.
 
     Parameters
     ----------
@@ -97,12 +408,15 @@ def positions_to_density_field(ngrid, pos, center, subbox_size, box_size,
         Center of the sub-box.
     subbox_size : float
         Size of the sub-box.
+    box_size : float
+        Size of the simulation box.
     MAS : str, optional
-        Mass assignment scheme.
-    mpart : float, optional
-        Mass of a single particle.
+        Mass assignment scheme. Must be one of `NGP`, `CIC`, `TSC` or `PCS`.
+    mpart : float or 1-dimensional array of shape (nsamples,), optional
+        Mass of a single particle or of each particle.
     verbose : bool, optional
-        Verbosity flag.
+        Ignored, kept for backwards compatibility. The deposit no longer
+        prints its progress.
     dtype : type, optional
         Data type to use for the output array.
 
@@ -110,19 +424,378 @@ def positions_to_density_field(ngrid, pos, center, subbox_size, box_size,
     -------
     field : 3-dimensional array of shape (ngrid, ngrid, ngrid)
     """
-    pos, center = pos.astype(dtype), center.astype(dtype)
+    p = _mas_order(MAS, ngrid)
+    if numpy.ndim(mpart) > 0:
+        weights, mpart = _check_weights(mpart, len(pos)), 1.
+    else:
+        weights = numpy.empty((0, 1), dtype=numpy.float64)
+
+    field = _grid_subbox(ngrid, pos, weights, 1, center, subbox_size,
+                         box_size, p, dtype)[0]
+    field *= mpart
+    return field
+
+
+###############################################################################
+#                     Many sub-boxes in a single pass                         #
+###############################################################################
+
+
+def _centre_grid(centers, half_width, boxsize):
+    """
+    Bin sub-box centres on a periodic grid whose cells are at least as large
+    as a sub-box, so that a particle can only belong to sub-boxes centred in
+    its own or the neighbouring cells.
+    """
+    ncells = int(boxsize // (2 * half_width))
+    # With fewer than three cells the neighbours would repeat.
+    if ncells < 3:
+        ncells = 1
+
+    keys = _cell_keys(centers, ncells, boxsize)
+    offsets = numpy.zeros(ncells**3 + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(keys, minlength=ncells**3), out=offsets[1:])
+    return ncells, offsets, _counting_sort(keys, offsets)
+
 
-    # Periodic wrapping
-    pos -= center - box_size / 2
-    pos %= box_size
-    pos -= box_size / 2 - subbox_size / 2
+@jit(nopython=True, boundscheck=False)
+def _match_centres(x, y, z, centers, offsets, members, ncells, half_width,
+                   boxsize, buf):
+    """
+    Write indices of sub-boxes containing a particle to `buf` and return
+    their number.
+    """
+    cellsize = boxsize / ncells
+    nshift = 1 if ncells > 1 else 0
+    i0 = min(max(int(x / cellsize), 0), ncells - 1)
+    j0 = min(max(int(y / cellsize), 0), ncells - 1)
+    k0 = min(max(int(z / cellsize), 0), ncells - 1)
 
-    if not numpy.all(pos >= 0) and numpy.all(pos <= subbox_size):
-        raise ValueError("Particles are not within the sub-box.")
+    count = 0
+    for di in range(-nshift, nshift + 1):
+        i = (i0 + di) % ncells
+        for dj in range(-nshift, nshift + 1):
+            j = (j0 + dj) % ncells
+            for dk in range(-nshift, nshift + 1):
+                k = (i * ncells + j) * ncells + (k0 + dk) % ncells
+                for m in members[offsets[k]:offsets[k + 1]]:
+                    if in_box(x, y, z, centers[m, 0], centers[m, 1],
+                              centers[m, 2], half_width, boxsize):
+                        buf[count] = m
+                        count += 1
+    return count
 
-    field = numpy.zeros((ngrid, ngrid, ngrid), dtype=dtype)
-    MASL.MA(pos, field, subbox_size, MAS, verbose=verbose)
 
-    field *= mpart / (subbox_size / ngrid)**3
+@jit(nopython=True, fastmath=True, boundscheck=False, parallel=True)
+def _count_many(pos, centers, offsets, members, ncells, half_width, boxsize,
+                nchunks):
+    """Number of particles of each chunk of `pos` in each sub-box."""
+    counts = numpy.zeros((nchunks, len(centers)), dtype=numpy.int64)
+    chunk_size = (len(pos) + nchunks - 1) // nchunks
+    for ichunk in prange(nchunks):
+        buf = numpy.empty(len(centers), dtype=numpy.int64)
+        for n in range(ichunk * chunk_size,
+                       min((ichunk + 1) * chunk_size, len(pos))):
+            nmatch = _match_centres(pos[n, 0], pos[n, 1], pos[n, 2], centers,
+                                    offsets, members, ncells, half_width,
+                                    boxsize, buf)
+            for q in range(nmatch):
+                counts[ichunk, buf[q]] += 1
+    return counts
 
-    return field
+
+@jit(nopython=True, fastmath=True, boundscheck=False, parallel=True)
+def _fill_many(pos, centers, offsets, members, ncells, half_width, boxsize,
+               starts, counts, indxs):
+    """
+    Write indices of particles in each sub-box to `indxs`, where chunk
+    `i` writes the `counts[i, j]` particles of sub-box `j` starting at
+    `starts[i, j]`.
+    """
+    nchunks = starts.shape[0]
+    chunk_size = (len(pos) + nchunks - 1) // nchunks
+    for ichunk in prange(nchunks):
+        buf = numpy.empty(len(centers), dtype=numpy.int64)
+        fill = starts[ichunk].copy()
+        for n in range(ichunk * chunk_size,
+                       min((ichunk + 1) * chunk_size, len(pos))):
+            nmatch = _match_centres(pos[n, 0], pos[n, 1], pos[n, 2], centers,
+                                    offsets, members, ncells, half_width,
+                                    boxsize, buf)
+            for q in range(nmatch):
+                m = buf[q]
+                # Never write past the particles counted by `_count_many`.
+                if fill[m] < starts[ichunk, m] + counts[ichunk, m]:
+                    indxs[fill[m]] = n
+                    fill[m] += 1
+
+
+@jit(nopython=True, fastmath=True, boundscheck=False)
+def _deposit_many(pos, weights, centers, offsets, members, ncells,
+                  half_width, boxsize, p, fields):
+    """
+    Deposit the weights of each particle onto the channels of all sub-boxes
+    it belongs to. If `weights` has no rows, all particles have unit weight.
+    The sub-box coordinates follow `density_field_channels`.
+    """
+    nchannels, ngrid = fields.shape[1], fields.shape[2]
+    flat = fields.reshape(len(fields), nchannels, -1)
+    cell_inv = ngrid / (2 * half_width)
+    shift = boxsize / 2 - half_width
+    buf = numpy.empty(len(centers), dtype=numpy.int64)
+    wbuf = numpy.empty((3, 4), dtype=numpy.float64)
+    ibuf = numpy.empty((3, 4), dtype=numpy.int64)
+    for n in range(len(pos)):
+        x, y, z = pos[n, 0], pos[n, 1], pos[n, 2]
+        nmatch = _match_centres(x, y, z, centers, offsets, members, ncells,
+                                half_width, boxsize, buf)
+        for q in range(nmatch):
+            m = buf[q]
+            # Periodic shift such that the sub-box spans [0, subbox_size).
+            dx = (x - centers[m, 0] + boxsize / 2) % boxsize
+            dy = (y - centers[m, 1] + boxsize / 2) % boxsize
+            dz = (z - centers[m, 2] + boxsize / 2) % boxsize
+            _stencil(ngrid, (dx - shift) * cell_inv, (dy - shift) * cell_inv,
+                     (dz - shift) * cell_inv, p, wbuf, ibuf)
+            for k in range(nchannels):
+                weight = weights[n, k] if weights.shape[0] > 0 else 1.
+                _scatter(flat[m, k], ngrid, weight, p, wbuf, ibuf)
+
+
+def find_boxed_many(pos, centers, subbox_size, boxsize, return_indices=False):
+    """
+    Find positions of particles in boxes of size `subbox_size` centered on
+    each of `centers` in a single pass over the particles.
+
+    Parameters
+    ----------
+    pos : 2-dimensional array of shape (nsamples, 3)
+        Positions of all particles in the simulation.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Centers of the sub-boxes.
+    subbox_size : float
+        Size of the sub-boxes.
+    boxsize : float
+        Size of the simulation box.
+    return_indices : bool, optional
+        Whether to also return the indices of the particles in `pos`.
+
+    Returns
+    -------
+    pos : list of 2-dimensional arrays of shape (nsubsamples, 3)
+    indxs : list of 1-dimensional arrays of shape (nsubsamples,), optional
+    """
+    centers = numpy.asanyarray(centers, dtype=numpy.float64).reshape(-1, 3)
+    half_width = subbox_size / 2.
+    ncells, offsets, members = _centre_grid(centers, half_width, boxsize)
+
+    args = (pos, centers, offsets, members, ncells, half_width, boxsize)
+    counts = _count_many(*args, get_num_threads())
+
+    # Within each sub-box the particles of chunk `i` follow those of `i - 1`.
+    box_offsets = numpy.zeros(len(centers) + 1, dtype=numpy.int64)
+    numpy.cumsum(counts.sum(axis=0), out=box_offsets[1:])
+    starts = box_offsets[:-1] + numpy.cumsum(counts, axis=0) - counts
+
+    indxs = numpy.empty(box_offsets[-1], dtype=numpy.int64)
+    _fill_many(*args, starts, counts, indxs)
+
+    indxs = [indxs[box_offsets[i]:box_offsets[i + 1]]
+             for i in range(len(centers))]
+    out = [pos[indx] for indx in indxs]
+
+    if return_indices:
+        return out, indxs
+    return out
+
+
+def density_fields_many(ngrid, pos, centers, subbox_size, boxsize, MAS="PCS",
+                        mpart=1., weights=None, dtype=numpy.float32):
+    """
+    Calculate density fields of sub-boxes centered on each of `centers` in a
+    single pass over the particles, depositing each particle directly onto
+    the grids of the sub-boxes it falls in. The fields are held in memory,
+    so for many centers call this on batches of centers.
+
+    Parameters
+    ----------
+    ngrid : int
+        Number of grid cells per dimension.
+    pos : 2-dimensional array of shape (nsamples, 3)
+        Positions of all particles in the simulation.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Centers of the sub-boxes.
+    subbox_size : float
+        Size of the sub-boxes.
+    boxsize : float
+        Size of the simulation box.
+    MAS : str, optional
+        Mass assignment scheme. Must be one of `NGP`, `CIC`, `TSC` or `PCS`.
+    mpart : float, optional
+        Mass of a single particle.
+    weights : 2-dimensional array of shape (nsamples, nchannels), optional
+        Quantities of each particle deposited onto separate channels, see
+        :py:func:`density_field_channels`. If given, `mpart` is ignored.
+    dtype : type, optional
+        Data type to use for the output array.
+
+    Returns
+    -------
+    fields : 4-dimensional array of shape (ncenters, ngrid, ngrid, ngrid)
+        If `weights` are given, the shape is instead `(ncenters, nchannels,
+        ngrid, ngrid, ngrid)`.
+    """
+    p = _mas_order(MAS, ngrid)
+    centers = numpy.asanyarray(centers, dtype=numpy.float64).reshape(-1, 3)
+    half_width = subbox_size / 2.
+    ncells, offsets, members = _centre_grid(centers, half_width, boxsize)
+
+    if weights is None:
+        channels = numpy.empty((0, 1), dtype=numpy.float64)
+    else:
+        channels, mpart = _check_weights(weights, len(pos)), 1.
+
+    fields = numpy.zeros((len(centers), channels.shape[1], ngrid, ngrid,
+                          ngrid), dtype=dtype)
+    _deposit_many(pos, channels, centers, offsets, members, ncells,
+                  half_width, boxsize, p, fields)
+
+    fields *= mpart / (subbox_size / ngrid)**3
+    return fields if weights is not None else fields[:, 0]
+
+
+###############################################################################
+#                   Radial profiles around many centres                       #
+###############################################################################
+
+
+@jit(nopython=True, fastmath=True, boundscheck=False, parallel=True)
+def _profiles_many(pos, masses, vel, centers, center_vel, offsets, members,
+                   ncells, log_rmin, dlog, rmax, boxsize, counts, mass,
+                   momentum):
+    """
+    Bin particles in shells around all centres, each chunk of `pos` adding
+    to its own row of `counts`, `mass` and `momentum`, which have shape
+    (nchunks, ncenters, nbins + 1). Bin zero holds the particles within
+    the innermost shell. If `masses` or `vel` have no rows, all particles
+    have unit mass or the radial velocities are not binned.
+    """
+    nchunks, nbins = counts.shape[0], counts.shape[2] - 1
+    chunk_size = (len(pos) + nchunks - 1) // nchunks
+    for ichunk in prange(nchunks):
+        buf = numpy.empty(len(centers), dtype=numpy.int64)
+        for n in range(ichunk * chunk_size,
+                       min((ichunk + 1) * chunk_size, len(pos))):
+            x, y, z = pos[n, 0], pos[n, 1], pos[n, 2]
+            # The sphere of radius `rmax` is within the sub-box of
+            # half-width `rmax`, so the same centre grid is used.
+            nmatch = _match_centres(x, y, z, centers, offsets, members,
+                                    ncells, rmax, boxsize, buf)
+            for q in range(nmatch):
+                m = buf[q]
+                # Periodic displacement from the centre.
+                dx = (x - centers[m, 0] + boxsize / 2) % boxsize - boxsize / 2
+                dy = (y - centers[m, 1] + boxsize / 2) % boxsize - boxsize / 2
+                dz = (z - centers[m, 2] + boxsize / 2) % boxsize - boxsize / 2
+                r = numpy.sqrt(dx * dx + dy * dy + dz * dz)
+                if r >= rmax:
+                    continue
+
+                b = 0
+                if r > 0:
+                    b = int(numpy.floor((numpy.log(r) - log_rmin) / dlog)) + 1
+                    b = min(max(b, 0), nbins)
+
+                w = masses[n] if masses.shape[0] > 0 else 1.
+                counts[ichunk, m, b] += 1
+                mass[ichunk, m, b] += w
+                if vel.shape[0] > 0 and r > 0:
+                    vr = ((vel[n, 0] - center_vel[m, 0]) * dx
+                          + (vel[n, 1] - center_vel[m, 1]) * dy
+                          + (vel[n, 2] - center_vel[m, 2]) * dz) / r
+                    momentum[ichunk, m, b] += w * vr
+
+
+def radial_profiles(pos, centers, rmin, rmax, nbins, boxsize, mpart=1.,
+                    vel=None, center_vel=None):
+    """
+    Radial profiles in logarithmically spaced shells around each of
+    `centers`, binned in a single pass over the particles without selecting
+    the particles of each centre. The shells are periodic and each thread
+    bins its particles into its own profiles, which are summed at the end.
+
+    Parameters
+    ----------
+    pos : 2-dimensional array of shape (nsamples, 3)
+        Positions of all particles in the simulation.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Centers of the profiles.
+    rmin, rmax : float
+        Inner radius of the innermost and outer radius of the outermost
+        shell.
+    nbins : int
+        Number of shells.
+    boxsize : float
+        Size of the simulation box.
+    mpart : float or 1-dimensional array of shape (nsamples,), optional
+        Mass of a single particle or of each particle.
+    vel : 2-dimensional array of shape (nsamples, 3), optional
+        Particle velocities. If given, the mass-weighted mean radial
+        velocity in each shell is returned.
+    center_vel : 2-dimensional array of shape (ncenters, 3), optional
+        Velocities of the centers subtracted from the particle velocities,
+        by default zero.
+
+    Returns
+    -------
+    profiles : dict
+        With keys `edges` (nbins + 1,), the shell radii, `count` and `mass`
+        (ncenters, nbins), the number and mass of particles in each shell,
+        `inner_count` and `inner_mass` (ncenters,), those within `rmin`,
+        so that the enclosed mass is `inner_mass + cumsum(mass)`, and, if
+        `vel` is given, `vr` (ncenters, nbins), the mean radial velocity,
+        NaN in empty shells.
+    """
+    if not 0 < rmin < rmax:
+        raise ValueError("The radii must satisfy `0 < rmin < rmax`.")
+    if 2 * rmax > boxsize:
+        raise ValueError("The spheres must be smaller than the box.")
+
+    centers = numpy.asanyarray(centers, dtype=numpy.float64).reshape(-1, 3)
+    ncells, offsets, members = _centre_grid(centers, rmax, boxsize)
+
+    if numpy.ndim(mpart) > 0:
+        masses, mpart = _check_weights(mpart, len(pos))[:, 0], 1.
+    else:
+        masses = numpy.empty(0, dtype=numpy.float64)
+
+    if vel is None:
+        vel = numpy.empty((0, 3), dtype=numpy.float64)
+    elif len(vel) != len(pos):
+        raise ValueError("`vel` must have the same length as `pos`.")
+    if center_vel is None:
+        center_vel = numpy.zeros_like(centers)
+    center_vel = numpy.asanyarray(center_vel, dtype=numpy.float64).reshape(-1, 3)  # noqa
+
+    # Enough particles per thread to amortise clearing and summing its bins.
+    nchunks = max(min(get_num_threads(),
+                      len(pos) // max(len(centers) * (nbins + 1), 1)), 1)
+    shape = (nchunks, len(centers), nbins + 1)
+    counts = numpy.zeros(shape, dtype=numpy.int64)
+    mass = numpy.zeros(shape, dtype=numpy.float64)
+    momentum = numpy.zeros(shape, dtype=numpy.float64)
+
+    edges = numpy.geomspace(rmin, rmax, nbins + 1)
+    _profiles_many(pos, masses, vel, centers, center_vel, offsets, members,
+                   ncells, numpy.log(rmin), numpy.log(rmax / rmin) / nbins,
+                   rmax, boxsize, counts, mass, momentum)
+
+    counts, mass = counts.sum(axis=0), mass.sum(axis=0) * mpart
+    out = {"edges": edges, "count": counts[:, 1:], "mass": mass[:, 1:],
+           "inner_count": counts[:, 0], "inner_mass": mass[:, 0]}
+    if vel.shape[0] > 0:
+        momentum = momentum.sum(axis=0)[:, 1:] * mpart
+        with numpy.errstate(invalid="ignore", divide="ignore"):
+            out["vr"] = numpy.where(out["mass"] > 0,
+                                    momentum / out["mass"], numpy.nan)
+    return out
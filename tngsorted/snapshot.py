@@ -0,0 +1,245 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Direct access to the snapshot chunk files, without `illustris_python`.
+"""
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy
+from h5py import File
+
+
+def _read_block(fname, pkind, fields, start, stop):
+    """Read rows `start:stop` of the fields of a snapshot file."""
+    with File(fname, "r") as f:
+        grp = f[f"PartType{pkind}"]
+        return {field: grp[field][start:stop] for field in fields}
+
+
+class SnapshotReader:
+    """
+    Reader of the chunk files of a snapshot. The particle counts of all
+    files are read from their headers once, so a particle is addressed by
+    its global index in the snapshot of its type.
+
+    :py:meth:`iter_blocks` reads upcoming blocks on a thread pool while the
+    current block is processed. HDF5 calls are serialised by `h5py`, so the
+    threads do not read in parallel, but the reads overlap with compute in
+    the calling thread, e.g. numba or numpy operations releasing the GIL.
+
+    Parameters
+    ----------
+    files : list of str
+        Snapshot files ordered by their chunk number.
+    nthreads : int, optional
+        Number of threads reading blocks ahead.
+    prefetch : int, optional
+        Number of blocks read ahead of the current one.
+    """
+
+    def __init__(self, files, nthreads=1, prefetch=2):
+        if len(files) == 0:
+            raise ValueError("No snapshot files given.")
+        self.files = list(files)
+        self.nthreads = nthreads
+        self.prefetch = prefetch
+
+        counts = numpy.zeros((len(self.files), 6), dtype=numpy.int64)
+        for i, fname in enumerate(self.files):
+            with File(fname, "r") as f:
+                counts[i] = f["Header"].attrs["NumPart_ThisFile"]
+                if i == 0:
+                    self.header = dict(f["Header"].attrs.items())
+        self.counts = counts
+        self._offsets = numpy.zeros((len(self.files) + 1, 6),
+                                    dtype=numpy.int64)
+        self._offsets[1:] = numpy.cumsum(counts, axis=0)
+
+    @classmethod
+    def from_basepath(cls, basepath, snap, **kwargs):
+        """
+        Reader of a snapshot of a simulation directory, see
+        :py:func:`tngsorted.get_snapshot_files`.
+        """
+        from . import get_snapshot_files
+        return cls(get_snapshot_files(basepath, snap), **kwargs)
+
+    def offsets(self, pkind):
+        """
+        Offsets of particles of a type in each file, such that the
+        particles of the `i`-th file are `offsets[i]:offsets[i + 1]`.
+
+        Parameters
+        ----------
+        pkind : int
+            Particle type (0-5).
+
+        Returns
+        -------
+        offsets : 1-dimensional array of shape (nfiles + 1,)
+        """
+        return self._offsets[:, pkind]
+
+    def npart(self, pkind):
+        """Total number of particles of a type."""
+        return int(self._offsets[-1, pkind])
+
+    def field_info(self, pkind, field):
+        """
+        Shape of a single particle's value of a field and its data type,
+        read from the first file with particles of the type.
+
+        Parameters
+        ----------
+        pkind : int
+            Particle type (0-5).
+        field : str
+            Particle field.
+
+        Returns
+        -------
+        shape : tuple of int
+        dtype : numpy.dtype
+        """
+        i = numpy.where(self.counts[:, pkind] > 0)[0]
+        if len(i) == 0:
+            raise ValueError(f"Snapshot has no particles of type {pkind}.")
+        with File(self.files[i[0]], "r") as f:
+            dset = f[f"PartType{pkind}/{field}"]
+            return dset.shape[1:], dset.dtype
+
+    def _blocks(self, pkind, start, stop, block_size, files):
+        """Rows `(ifile, start, stop)` of the files overlapping a range."""
+        offsets = self.offsets(pkind)
+        stop = offsets[-1] if stop is None else min(stop, offsets[-1])
+        ifiles = range(len(self.files)) if files is None else files
+
+        blocks = []
+        for i in ifiles:
+            a = max(start, offsets[i]) - offsets[i]
+            b = min(stop, offsets[i + 1]) - offsets[i]
+            step = b - a if block_size is None else block_size
+            for j in range(a, b, max(step, 1)):
+                blocks.append((i, j, min(j + step, b)))
+        return blocks
+
+    def iter_blocks(self, pkind, fields, start=0, stop=None, block_size=None,
+                    files=None):
+        """
+        Iterate over blocks of particles in snapshot order, reading the next
+        `prefetch` blocks in the background.
+
+        Parameters
+        ----------
+        pkind : int
+            Particle type (0-5).
+        fields : list of str
+            Particle fields.
+        start, stop : int, optional
+            Range of global particle indices, by default all particles.
+        block_size : int, optional
+            Maximum number of particles per block. By default each file
+            within the range is a single block.
+        files : list of int, optional
+            Indices of the files to read, e.g. those assigned to an MPI rank.
+            By default all files.
+
+        Returns
+        -------
+        blocks : generator of `(ifile, slice, arrays)`
+            File index, global indices of the block's particles and a
+            dictionary of the fields' arrays.
+        """
+        fields = list(fields)
+        offsets = self.offsets(pkind)
+        blocks = self._blocks(pkind, start, stop, block_size, files)
+
+        executor = ThreadPoolExecutor(max_workers=self.nthreads)
+        queue = deque()
+        try:
+            for k, (i, a, b) in enumerate(blocks):
+                # Keep the current block and `prefetch` blocks in flight.
+                for (j, c, d) in blocks[k + len(queue):k + self.prefetch + 1]:
+                    queue.append(executor.submit(
+                        _read_block, self.files[j], pkind, fields, c, d))
+                arrays = queue.popleft().result()
+                yield i, slice(offsets[i] + a, offsets[i] + b), arrays
+        finally:
+            for future in queue:
+                future.cancel()
+            executor.shutdown(wait=True)
+
+    def read_into(self, pkind, field, out, start=0):
+        """
+        Read the particles `start:start + len(out)` of a field directly into
+        a preallocated array, without intermediate copies.
+
+        Parameters
+        ----------
+        pkind : int
+            Particle type (0-5).
+        field : str
+            Particle field.
+        out : numpy.ndarray
+            C-contiguous output array, whose data type may differ from the
+            snapshot's.
+        start : int, optional
+            Global index of the first particle.
+
+        Returns
+        -------
+        out : numpy.ndarray
+        """
+        stop = start + len(out)
+        if stop > self.npart(pkind):
+            raise ValueError(f"Cannot read {len(out)} particles from {start}, the snapshot has {self.npart(pkind)} particles of type {pkind}.")  # noqa
+
+        offsets = self.offsets(pkind)
+        for i, a, b in self._blocks(pkind, start, stop, None, None):
+            j = offsets[i] + a - start
+            with File(self.files[i], "r") as f:
+                f[f"PartType{pkind}/{field}"].read_direct(
+                    out, numpy.s_[a:b], numpy.s_[j:j + b - a])
+        return out
+
+    def read(self, pkind, fields, start=0, stop=None, dtype=None):
+        """
+        Read a range of particles of several fields into preallocated
+        arrays.
+
+        Parameters
+        ----------
+        pkind : int
+            Particle type (0-5).
+        fields : list of str
+            Particle fields.
+        start, stop : int, optional
+            Range of global particle indices, by default all particles.
+        dtype : type, optional
+            Output data type, by default that of the snapshot.
+
+        Returns
+        -------
+        data : dict of numpy.ndarray
+        """
+        stop = self.npart(pkind) if stop is None else stop
+        data = {}
+        for field in fields:
+            shape, field_dtype = self.field_info(pkind, field)
+            out = numpy.empty((stop - start,) + shape,
+                              dtype=field_dtype if dtype is None else dtype)
+            data[field] = self.read_into(pkind, field, out, start)
+        return data
@@ -12,8 +12,17 @@
 # You should have received a copy of the GNU General Public License along
 # with this program; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
-import numpy
+from collections import OrderedDict
+from os.path import join
+
+import h5py
 import illustris_python as il
+import numpy
+from tqdm import tqdm
+
+from . import get_snapshot_files
+from .instrument import RunMetrics
+from .snapshot import SnapshotReader
 
 
 def load_halo(hid, basepath, snap, pkind, fields):
@@ -44,3 +53,613 @@ def load_halo(hid, basepath, snap, pkind, fields):
     except OSError:
         return None
 
+
+def load_subhalo(sid, basepath, snap, pkind, fields):
+    """
+    Load subhalo particles from a TNG simulation.
+
+    Parameters
+    ----------
+    sid : int
+        Subhalo ID.
+    basepath : str
+        Path to the simulation output directory.
+    snap : int
+        Snapshot number.
+    pkind : int
+        Particle type (1-6).
+    fields : list of str
+        Particle fields to load.
+
+    Returns
+    -------
+    out : dict
+    """
+    if isinstance(fields, str):
+        fields = [fields]
+    try:
+        return il.snapshot.loadSubhalo(basepath, snap, sid, pkind,
+                                       fields=fields)
+    except OSError:
+        return None
+
+
+def halo_offsets(lengths):
+    """
+    Offsets of FoF haloes' particles of a single type in a snapshot. TNG
+    snapshots are ordered by FoF halo, so the particles of the `i`-th halo
+    are `offsets[i]:offsets[i + 1]`, with the particles outside of haloes
+    following the last halo.
+
+    Parameters
+    ----------
+    lengths : 1-dimensional array of shape (nhalos,)
+        Number of particles of a given type in each halo, i.e. a column of
+        `GroupLenType`.
+
+    Returns
+    -------
+    offsets : 1-dimensional array of shape (nhalos + 1,)
+    """
+    offsets = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def subhalo_offsets(hoffsets, grnr, lengths):
+    """
+    Offsets of subhaloes' particles of a single type in a snapshot. Within
+    each FoF halo the particles are ordered by subhalo, followed by the
+    particles not bound to any subhalo, and the subhaloes of a halo are
+    consecutive, so the particles of the `i`-th subhalo start at its halo's
+    offset plus the lengths of the preceding subhaloes of the same halo.
+
+    Parameters
+    ----------
+    hoffsets : 1-dimensional array of shape (nhalos + 1,)
+        Halo offsets returned by :py:func:`halo_offsets`.
+    grnr : 1-dimensional array of shape (nsubhalos,)
+        Parent halo of each subhalo, i.e. `SubhaloGrNr`, all below `nhalos`.
+    lengths : 1-dimensional array of shape (nsubhalos,)
+        Number of particles of a given type in each subhalo, i.e. a column
+        of `SubhaloLenType`.
+
+    Returns
+    -------
+    start, end : 1-dimensional arrays of shape (nsubhalos,)
+    """
+    cumlen = numpy.zeros(len(lengths) + 1, dtype=numpy.int64)
+    numpy.cumsum(lengths, out=cumlen[1:])
+    # Index of the first subhalo of each subhalo's halo.
+    first = numpy.searchsorted(grnr, grnr, side="left")
+    start = hoffsets[grnr] + cumlen[:-1] - cumlen[first]
+    return start, start + cumlen[1:] - cumlen[:-1]
+
+
+DEFAULT_FIELDS = ["Coordinates", "Velocities", "Potential"]
+
+
+def _field_dtype(dtype, float16_coords, field):
+    """Data type of a field in the sorted store."""
+    if field == "Coordinates" and float16_coords:
+        return numpy.float16
+    if numpy.issubdtype(dtype, numpy.floating):
+        return numpy.float32
+    return dtype
+
+
+def build_sorted_halos(basepath, snap, fout, minpart, pkinds=(1,),
+                       fields=None, float16_coords=False, comm=None,
+                       block_size=2**24, chunk_size=2**16, metrics=None,
+                       verbose=True):
+    """
+    Store particles of FoF haloes with more than `minpart` particles in an
+    HDF5 file. Since TNG snapshots are ordered by FoF halo, the haloes'
+    particles are a prefix of each particle type and are copied from the
+    snapshot files with large sequential reads into preallocated datasets.
+
+    Each field of each particle type is a separate chunked dataset, e.g.
+    `PartType1/Coordinates`, so that readers only fetch the fields they
+    need. The `PartTypeX/halomap` dataset holds rows of `(hid, start, end)`
+    such that the particles of type `X` of halo `hid` are `start:end`, and
+    the `PartTypeX/subhalomap` dataset holds rows of `(sid, hid, start, end)`
+    for the subhaloes `sid` of the stored haloes, whose particles are a
+    contiguous part of their halo `hid`. Floating point fields are stored as
+    single precision.
+
+    Parameters
+    ----------
+    basepath : str
+        Path to the simulation directory.
+    snap : int
+        Snapshot number.
+    fout : str
+        Output file name.
+    minpart : int
+        Minimum number of particles in a halo to be stored.
+    pkinds : list of int, optional
+        Particle types (0-5).
+    fields : list of str or dict, optional
+        Particle fields to store. Either a list used for all particle types
+        or a dictionary of lists keyed by particle type. By default
+        coordinates, velocities and potential.
+    float16_coords : bool, optional
+        Whether to store coordinates as half precision offsets from the
+        halo's `GroupPos`, wrapped periodically. Shrinks the coordinates
+        four times at a relative precision of about `1e-3` of the offset.
+    comm : mpi4py.MPI.Intracomm, optional
+        If given, the snapshot files are split between the ranks, which
+        requires `h5py` built with MPI support.
+    block_size : int, optional
+        Maximum number of particles copied at once.
+    chunk_size : int, optional
+        Number of particles per HDF5 chunk.
+    metrics : :py:class:`tngsorted.instrument.RunMetrics`, optional
+        Metrics to which the time spent reading and writing and the number
+        of particles and bytes copied by this rank are added.
+    verbose : bool, optional
+        Verbosity flag.
+
+    Returns
+    -------
+    None
+    """
+    if metrics is None:
+        metrics = RunMetrics("sort_by_halo", comm)
+    rank, size = (0, 1) if comm is None else (comm.Get_rank(),
+                                              comm.Get_size())
+    if fields is None:
+        fields = DEFAULT_FIELDS
+    if not isinstance(fields, dict):
+        fields = {pkind: fields for pkind in pkinds}
+
+    groups = il.groupcat.loadHalos(
+        join(basepath, "output"), snap,
+        fields=["GroupLen", "GroupLenType", "GroupPos"])
+    mask = groups["GroupLen"] > minpart
+    # Haloes are ordered by decreasing length, so the selection is a prefix.
+    nhalos = numpy.where(mask)[0][-1] + 1 if numpy.any(mask) else 0
+
+    subhalos = il.groupcat.loadSubhalos(
+        join(basepath, "output"), snap,
+        fields=["SubhaloGrNr", "SubhaloLenType"])
+    if subhalos["count"] > 0:
+        # Subhaloes are ordered by halo, so those of the stored haloes are
+        # also a prefix.
+        nsubhalos = numpy.searchsorted(subhalos["SubhaloGrNr"], nhalos)
+        grnr = subhalos["SubhaloGrNr"][:nsubhalos].astype(numpy.int64)
+    else:
+        nsubhalos = 0
+        grnr = numpy.zeros(0, dtype=numpy.int64)
+
+    reader = SnapshotReader(get_snapshot_files(basepath, snap))
+    boxsize = float(reader.header["BoxSize"])
+
+    hoffsets, foffsets, shapes = {}, {}, {}
+    for pkind in pkinds:
+        hoffsets[pkind] = halo_offsets(
+            groups["GroupLenType"][:nhalos, pkind])
+        foffsets[pkind] = reader.offsets(pkind)
+        shapes[pkind] = {field: reader.field_info(pkind, field)
+                         for field in fields[pkind]}
+
+    if verbose and rank == 0:
+        nbytes = sum(
+            int(hoffsets[p][-1]) * int(numpy.prod(shape))
+            * numpy.dtype(_field_dtype(dtype, float16_coords, field)).itemsize
+            for p in pkinds for field, (shape, dtype) in shapes[p].items())
+        print(f"Number of halos to be processed:   {nhalos}.")
+        print(f"Number of subhalos in the halos:   {nsubhalos}.")
+        for pkind in pkinds:
+            print(f"Number of particles of type {pkind}:    {hoffsets[pkind][-1]}.")  # noqa
+        print(f"Estimated size of the output file: {float('%.4g' % (nbytes / 1024**3))} GB.", flush=True)  # noqa
+
+    if size > 1:
+        f = h5py.File(fout, "w", driver="mpio", comm=comm)
+    else:
+        f = h5py.File(fout, "w")
+
+    with f:
+        f.attrs["BoxSize"] = boxsize
+        f.attrs["snap"] = snap
+        f.attrs["minpart"] = minpart
+        # With MPI dataset creation is collective, but only the zeroth rank
+        # writes the metadata.
+        dset = f.create_dataset("GroupPos", shape=(nhalos, 3),
+                                dtype=groups["GroupPos"].dtype)
+        if rank == 0:
+            dset[...] = groups["GroupPos"][:nhalos]
+
+        dsets = {}
+        for pkind in pkinds:
+            grp = f.create_group(f"PartType{pkind}")
+            npart = int(hoffsets[pkind][-1])
+            dset = grp.create_dataset("halomap", shape=(nhalos, 3),
+                                      dtype=numpy.int64)
+            if rank == 0:
+                dset[...] = numpy.vstack([numpy.arange(nhalos),
+                                          hoffsets[pkind][:-1],
+                                          hoffsets[pkind][1:]]).T
+            dset = grp.create_dataset("subhalomap", shape=(nsubhalos, 4),
+                                      dtype=numpy.int64)
+            if rank == 0 and nsubhalos > 0:
+                start, end = subhalo_offsets(
+                    hoffsets[pkind], grnr,
+                    subhalos["SubhaloLenType"][:nsubhalos, pkind])
+                dset[...] = numpy.vstack([numpy.arange(nsubhalos), grnr,
+                                          start, end]).T
+
+            for field, (shape, dtype) in shapes[pkind].items():
+                dtype = _field_dtype(dtype, float16_coords, field)
+                chunks = (max(min(chunk_size, npart), 1),) + shape
+                dsets[pkind, field] = grp.create_dataset(
+                    field, shape=(npart,) + shape, dtype=dtype,
+                    chunks=chunks)
+                if field == "Coordinates" and float16_coords:
+                    dsets[pkind, field].attrs["relative_to"] = "GroupPos"
+
+        # Assign files to ranks and only copy files holding halo particles.
+        # The next block is read while the current one is written.
+        ifiles = [i for i in range(len(reader.files))
+                  if any(foffsets[p][i] < hoffsets[p][-1] for p in pkinds)]
+        for pkind in pkinds:
+            blocks = reader.iter_blocks(pkind, fields[pkind],
+                                        stop=hoffsets[pkind][-1],
+                                        block_size=block_size,
+                                        files=ifiles[rank::size])
+            blocks = iter(tqdm(blocks, disable=not (verbose and rank == 0),
+                               desc=f"Copying particles of type {pkind}"))
+            while True:
+                with metrics.phase("read"):
+                    block = next(blocks, None)
+                if block is None:
+                    break
+                __, rows, arrays = block
+                metrics.count("particles_copied", rows.stop - rows.start)
+
+                for field, data in arrays.items():
+                    metrics.count("bytes_read", data.nbytes)
+                    if field == "Coordinates" and float16_coords:
+                        hid = numpy.searchsorted(
+                            hoffsets[pkind],
+                            numpy.arange(rows.start, rows.stop),
+                            side="right") - 1
+                        data = data - groups["GroupPos"][hid]
+                        data = (data + boxsize / 2) % boxsize
+                        data -= boxsize / 2
+                    with metrics.phase("write"):
+                        dsets[pkind, field][rows] = data
+                    metrics.count(
+                        "bytes_written",
+                        data.size * dsets[pkind, field].dtype.itemsize)
+
+
+class SortedHaloReader:
+    """
+    Random-access reader of the haloes and subhaloes stored by
+    :py:func:`build_sorted_halos`. The halo and subhalo maps are kept in
+    memory, so looking up an object is a single indexing operation, and
+    recently read objects are kept in an LRU cache limited by its size in
+    bytes. Objects that are not in the store are loaded from the snapshot
+    with :py:func:`load_halo` or :py:func:`load_subhalo` if `basepath` is
+    given.
+
+    Parameters
+    ----------
+    fname : str
+        File written by :py:func:`build_sorted_halos`.
+    basepath : str, optional
+        Path to the simulation directory, used for objects not in the store.
+    cache_bytes : int, optional
+        Maximum size of the cache in bytes.
+    """
+
+    def __init__(self, fname, basepath=None, cache_bytes=1024**3):
+        self._f = h5py.File(fname, "r")
+        self.basepath = basepath
+        self.cache_bytes = cache_bytes
+        self.boxsize = float(self._f.attrs["BoxSize"])
+        self.snap = int(self._f.attrs["snap"])
+        self._grouppos = self._f["GroupPos"][:]
+
+        # Particle ranges indexed by halo ID, with -1 for missing haloes,
+        # and those of subhaloes with their parent haloes. Stores written
+        # before the subhalo maps were added have no subhaloes.
+        self._ranges = {}
+        self._subranges = {}
+        self._subparents = {}
+        for key in self._f.keys():
+            if not key.startswith("PartType"):
+                continue
+            pkind = int(key[len("PartType"):])
+            halomap = self._f[key]["halomap"][:]
+            nhalos = halomap[:, 0].max() + 1 if len(halomap) > 0 else 0
+            ranges = numpy.full((nhalos, 2), -1, dtype=numpy.int64)
+            ranges[halomap[:, 0]] = halomap[:, 1:]
+            self._ranges[pkind] = ranges
+
+            if "subhalomap" in self._f[key]:
+                submap = self._f[key]["subhalomap"][:]
+            else:
+                submap = numpy.zeros((0, 4), dtype=numpy.int64)
+            nsub = submap[:, 0].max() + 1 if len(submap) > 0 else 0
+            ranges = numpy.full((nsub, 2), -1, dtype=numpy.int64)
+            ranges[submap[:, 0]] = submap[:, 2:]
+            self._subranges[pkind] = ranges
+            parents = numpy.full(nsub, -1, dtype=numpy.int64)
+            parents[submap[:, 0]] = submap[:, 1]
+            self._subparents[pkind] = parents
+
+        self._cache = OrderedDict()
+        self._cache_nbytes = 0
+
+    @property
+    def pkinds(self):
+        """Particle types in the store."""
+        return list(self._ranges.keys())
+
+    def fields(self, pkind):
+        """
+        Particle fields of a given type in the store.
+
+        Parameters
+        ----------
+        pkind : int
+            Particle type.
+
+        Returns
+        -------
+        fields : list of str
+        """
+        return [key for key in self._f[f"PartType{pkind}"].keys()
+                if key not in ("halomap", "subhalomap")]
+
+    def in_store(self, hid, pkind=1):
+        """
+        Check whether a halo is in the store.
+
+        Parameters
+        ----------
+        hid : int
+            Halo ID.
+        pkind : int, optional
+            Particle type.
+
+        Returns
+        -------
+        bool
+        """
+        ranges = self._ranges[pkind]
+        return 0 <= hid < len(ranges) and ranges[hid, 0] >= 0
+
+    def subhalo_in_store(self, sid, pkind=1):
+        """
+        Check whether a subhalo is in the store.
+
+        Parameters
+        ----------
+        sid : int
+            Subhalo ID.
+        pkind : int, optional
+            Particle type.
+
+        Returns
+        -------
+        bool
+        """
+        ranges = self._subranges[pkind]
+        return 0 <= sid < len(ranges) and ranges[sid, 0] >= 0
+
+    def parent(self, sid, pkind=1):
+        """
+        Parent halo ID of a subhalo in the store.
+
+        Parameters
+        ----------
+        sid : int
+            Subhalo ID.
+        pkind : int, optional
+            Particle type.
+
+        Returns
+        -------
+        hid : int
+        """
+        if not self.subhalo_in_store(sid, pkind):
+            raise KeyError(f"Subhalo {sid} of type {pkind} is not in the store.")  # noqa
+        return int(self._subparents[pkind][sid])
+
+    # The cache holds its own copies, so that in-place changes by callers,
+    # e.g. `pos -= center`, do not alter later hits.
+    def _cache_get(self, key):
+        val = self._cache.get(key)
+        if val is None:
+            return None
+        self._cache.move_to_end(key)
+        return val.copy()
+
+    def _cache_put(self, key, val):
+        if val.nbytes > self.cache_bytes:
+            return
+        if key in self._cache:
+            self._cache_nbytes -= self._cache.pop(key).nbytes
+        self._cache[key] = val.copy()
+        self._cache_nbytes += val.nbytes
+        while self._cache_nbytes > self.cache_bytes:
+            __, old = self._cache.popitem(last=False)
+            self._cache_nbytes -= old.nbytes
+
+    def _decode(self, hids, pkind, field, data):
+        """Undo the storage transformation of a field, if any."""
+        dset = self._f[f"PartType{pkind}/{field}"]
+        if dset.attrs.get("relative_to") != "GroupPos":
+            return data
+        data = data.astype(numpy.float32) + self._grouppos[hids]
+        return data % self.boxsize
+
+    def _load_fallback(self, hid, pkind, fields, subhalo=False):
+        kind = "Subhalo" if subhalo else "Halo"
+        if self.basepath is None:
+            raise KeyError(f"{kind} {hid} of type {pkind} is not in the store.")  # noqa
+
+        load = load_subhalo if subhalo else load_halo
+        data = load(hid, join(self.basepath, "output"), self.snap, pkind,
+                    fields)
+        if data is None:
+            raise KeyError(f"{kind} {hid} of type {pkind} could not be loaded.")  # noqa
+        if not isinstance(data, dict):
+            data = {fields[0]: data}
+
+        out = {}
+        for field in fields:
+            x = numpy.asarray(data[field])
+            if numpy.issubdtype(x.dtype, numpy.floating):
+                x = x.astype(numpy.float32)
+            out[field] = x
+        return out
+
+    def get(self, hid, pkind=1, fields=None):
+        """
+        Load particles of a single halo.
+
+        Parameters
+        ----------
+        hid : int
+            Halo ID.
+        pkind : int, optional
+            Particle type.
+        fields : list of str, optional
+            Particle fields. By default all fields in the store.
+
+        Returns
+        -------
+        out : dict
+        """
+        return self.get_many([hid], pkind, fields)[0]
+
+    def get_many(self, hids, pkind=1, fields=None):
+        """
+        Load particles of many haloes. Haloes that are adjacent in the store
+        are read with a single read.
+
+        Parameters
+        ----------
+        hids : 1-dimensional array
+            Halo IDs.
+        pkind : int, optional
+            Particle type.
+        fields : list of str, optional
+            Particle fields. By default all fields in the store.
+
+        Returns
+        -------
+        out : list of dict
+        """
+        return self._get_many(hids, pkind, fields, subhalo=False)
+
+    def get_subhalo(self, sid, pkind=1, fields=None):
+        """
+        Load particles of a single subhalo.
+
+        Parameters
+        ----------
+        sid : int
+            Subhalo ID.
+        pkind : int, optional
+            Particle type.
+        fields : list of str, optional
+            Particle fields. By default all fields in the store.
+
+        Returns
+        -------
+        out : dict
+        """
+        return self.get_many_subhalos([sid], pkind, fields)[0]
+
+    def get_many_subhalos(self, sids, pkind=1, fields=None):
+        """
+        Load particles of many subhaloes. Subhaloes that are adjacent in the
+        store, e.g. those of the same halo, are read with a single read.
+
+        Parameters
+        ----------
+        sids : 1-dimensional array
+            Subhalo IDs.
+        pkind : int, optional
+            Particle type.
+        fields : list of str, optional
+            Particle fields. By default all fields in the store.
+
+        Returns
+        -------
+        out : list of dict
+        """
+        return self._get_many(sids, pkind, fields, subhalo=True)
+
+    def _get_many(self, ids, pkind, fields, subhalo):
+        """Load particles of many haloes or subhaloes."""
+        if fields is None:
+            fields = self.fields(pkind)
+        if isinstance(fields, str):
+            fields = [fields]
+
+        if subhalo:
+            kind = "subhalo"
+            ranges = self._subranges[pkind]
+            parents = self._subparents[pkind]
+            in_store = self.subhalo_in_store
+        else:
+            kind = "halo"
+            ranges = self._ranges[pkind]
+            parents = None
+            in_store = self.in_store
+
+        ids = [int(i) for i in ids]
+        out = [{} for __ in ids]
+
+        for field in fields:
+            missing = []
+            for n, i in enumerate(ids):
+                val = self._cache_get((kind, pkind, i, field))
+                if val is not None:
+                    out[n][field] = val
+                elif in_store(i, pkind):
+                    missing.append(n)
+
+            # Merge objects whose particles are adjacent into single reads.
+            missing.sort(key=lambda n: ranges[ids[n], 0])
+            dset = self._f[f"PartType{pkind}/{field}"]
+            k = 0
+            while k < len(missing):
+                j = k + 1
+                while (j < len(missing) and ranges[ids[missing[j]], 0]
+                       <= ranges[ids[missing[j - 1]], 1]):
+                    j += 1
+
+                start = ranges[ids[missing[k]], 0]
+                stop = max(ranges[ids[n], 1] for n in missing[k:j])
+                block = dset[start:stop]
+                for n in missing[k:j]:
+                    i = ids[n]
+                    a, b = ranges[i] - start
+                    hid = i if parents is None else parents[i]
+                    val = self._decode(hid, pkind, field, block[a:b].copy())
+                    self._cache_put((kind, pkind, i, field), val)
+                    out[n][field] = val
+                k = j
+
+        for n, i in enumerate(ids):
+            if not in_store(i, pkind):
+                out[n] = self._load_fallback(i, pkind, fields, subhalo)
+
+        return out
+
+    def close(self):
+        """Close the store."""
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,202 @@
+# Copyright (C) 2023 Richard Stiskalek
+# This program is free software; you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 3 of the License, or (at your
+# option) any later version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General
+# Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+"""
+Tracking of subhaloes across snapshots along their SubLink merger trees.
+Each subhalo selected at a reference snapshot is followed along its main
+progenitor branch to earlier snapshots and its main descendant branch to
+later snapshots. The subfind IDs and positions at each snapshot are stored
+in a tracks file, from which `subbox_make.py --tracks` reads the centres of
+each snapshot, so that each snapshot's particles are loaded once for all
+tracked objects.
+"""
+from multiprocessing import Pool
+from os.path import join
+
+import illustris_python as il
+import numpy
+from h5py import File
+from tqdm import tqdm
+
+
+def follow_subhalo(basepath, snap, subhalo_id, snaps, tree="SubLink"):
+    """
+    Subfind IDs and positions of a subhalo at several snapshots, following
+    its main progenitor and main descendant branches.
+
+    Parameters
+    ----------
+    basepath : str
+        Path to the simulation directory.
+    snap : int
+        Snapshot of `subhalo_id`.
+    subhalo_id : int
+        Subfind ID at `snap`.
+    snaps : 1-dimensional array of shape (nsnaps,)
+        Snapshots to follow the subhalo to.
+    tree : str, optional
+        Merger tree name.
+
+    Returns
+    -------
+    ids : 1-dimensional array of shape (nsnaps,)
+        Subfind IDs, -1 where the subhalo is not in the tree.
+    pos : 2-dimensional array of shape (nsnaps, 3)
+        Positions, NaN where the subhalo is not in the tree.
+    """
+    snaps = numpy.asarray(snaps)
+    ids = numpy.full(len(snaps), -1, dtype=numpy.int64)
+    pos = numpy.full((len(snaps), 3), numpy.nan, dtype=numpy.float32)
+
+    fields = ["SnapNum", "SubfindID", "SubhaloPos"]
+    for branch in ("onlyMPB", "onlyMDB"):
+        if branch == "onlyMPB" and not numpy.any(snaps <= snap):
+            continue
+        if branch == "onlyMDB" and not numpy.any(snaps > snap):
+            continue
+
+        out = il.sublink.loadTree(join(basepath, "output"), snap,
+                                  int(subhalo_id), fields=fields,
+                                  treeName=tree, **{branch: True})
+        if out is None:
+            continue
+
+        for s, sid, x in zip(out["SnapNum"], out["SubfindID"],
+                             out["SubhaloPos"]):
+            k = numpy.where(snaps == s)[0]
+            if len(k) > 0:
+                ids[k[0]] = sid
+                pos[k[0]] = x
+
+    return ids, pos
+
+
+def _follow(args):
+    """Wrapper of :py:func:`follow_subhalo` for a process pool."""
+    return follow_subhalo(*args)
+
+
+def build_tracks(basepath, snap, subhalo_ids, snaps, tree="SubLink",
+                 nproc=1, verbose=True):
+    """
+    Follow subhaloes selected at a snapshot to several snapshots.
+
+    Parameters
+    ----------
+    basepath : str
+        Path to the simulation directory.
+    snap : int
+        Reference snapshot of `subhalo_ids`.
+    subhalo_ids : 1-dimensional array of shape (nobjects,)
+        Subfind IDs at `snap`.
+    snaps : 1-dimensional array of shape (nsnaps,)
+        Snapshots to follow the subhaloes to.
+    tree : str, optional
+        Merger tree name.
+    nproc : int, optional
+        Number of processes reading the merger trees.
+    verbose : bool, optional
+        Verbosity flag.
+
+    Returns
+    -------
+    ids : 2-dimensional array of shape (nobjects, nsnaps)
+        Subfind IDs, -1 where a subhalo is not in the tree.
+    pos : 3-dimensional array of shape (nobjects, nsnaps, 3)
+        Positions, NaN where a subhalo is not in the tree.
+    """
+    tasks = [(basepath, snap, sid, snaps, tree) for sid in subhalo_ids]
+    if nproc > 1:
+        with Pool(nproc) as pool:
+            results = list(tqdm(pool.imap(_follow, tasks), total=len(tasks),
+                                disable=not verbose, desc="Following trees"))
+    else:
+        results = [_follow(task) for task in tqdm(
+            tasks, disable=not verbose, desc="Following trees")]
+
+    ids = numpy.array([res[0] for res in results], dtype=numpy.int64)
+    pos = numpy.array([res[1] for res in results], dtype=numpy.float32)
+    return (ids.reshape(len(tasks), len(snaps)),
+            pos.reshape(len(tasks), len(snaps), 3))
+
+
+def write_tracks(fname, ref_ids, snaps, ids, pos, **attrs):
+    """
+    Write tracks returned by :py:func:`build_tracks`.
+
+    Parameters
+    ----------
+    fname : str
+        Output file name.
+    ref_ids : 1-dimensional array of shape (nobjects,)
+        Subfind IDs at the reference snapshot, which label the objects.
+    snaps : 1-dimensional array of shape (nsnaps,)
+        Snapshots.
+    ids : 2-dimensional array of shape (nobjects, nsnaps)
+        Subfind IDs at each snapshot.
+    pos : 3-dimensional array of shape (nobjects, nsnaps, 3)
+        Positions at each snapshot.
+    **attrs : dict
+        Attributes to store, e.g. the reference snapshot.
+
+    Returns
+    -------
+    None
+    """
+    with File(fname, "w") as f:
+        f.create_dataset("ref_ids", data=ref_ids)
+        f.create_dataset("snaps", data=snaps)
+        f.create_dataset("ids", data=ids)
+        f.create_dataset("pos", data=pos)
+        for key, val in attrs.items():
+            f.attrs[key] = val
+
+
+def read_tracks(fname, snap):
+    """
+    Objects of a tracks file present at a snapshot.
+
+    Parameters
+    ----------
+    fname : str
+        File written by :py:func:`write_tracks`.
+    snap : int
+        Snapshot.
+
+    Returns
+    -------
+    ref_ids : 1-dimensional array of shape (ncenters,)
+        Subfind IDs at the reference snapshot.
+    ids : 1-dimensional array of shape (ncenters,)
+        Subfind IDs at `snap`.
+    centers : 2-dimensional array of shape (ncenters, 3)
+        Positions at `snap`.
+    """
+    with File(fname, "r") as f:
+        snaps = f["snaps"][:]
+        if snap not in snaps:
+            raise ValueError(f"Snapshot {snap} is not in `{fname}`, available snapshots are {list(snaps)}.")  # noqa
+        k = numpy.where(snaps == snap)[0][0]
+        ref_ids = f["ref_ids"][:]
+        ids = f["ids"][:, k]
+        centers = f["pos"][:, k, :]
+
+    mask = ids >= 0
+    return ref_ids[mask], ids[mask], centers[mask]
+
+
+def tracked_snapshots(fname):
+    """Snapshots of a tracks file written by :py:func:`write_tracks`."""
+    with File(fname, "r") as f:
+        return f["snaps"][:]